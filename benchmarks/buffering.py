@@ -0,0 +1,63 @@
+
+import timeit
+import sys
+import os.path
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import stpl2
+
+
+class LegacyBufferingTemplate(stpl2.Template):
+    '''
+    Buffering template joining and slicing all pending data for every chunk,
+    as stpl2 did before.
+    '''
+    buffersize = 4096
+
+    def render(self, env=None):
+        buffsize = 0
+        cache = []
+        for line in stpl2.Template.render(self, env):
+            cache.append(line)
+            buffsize += len(line)
+            while buffsize > self.buffersize:
+                data = "".join(cache)
+                yield data[:self.buffersize]
+                data = data[self.buffersize:]
+                cache[:] = (data,) if data else ()
+                buffsize = len(data)
+        if cache:
+            yield "".join(cache)
+
+
+code = '''
+<html>
+<body>
+{{ !blob }}
+</body>
+</html>
+'''
+
+legacy_limit = 1 << 20 # legacy copying is quadratic, skip bigger outputs
+
+
+def render(template, env):
+    for chunk in template.render(env):
+        pass
+
+
+if __name__ == '__main__':
+    templates = stpl2.BufferingTemplate(code), LegacyBufferingTemplate(code)
+    print('%10s %14s %14s' % ('output', 'buffering', 'legacy'))
+    for size in (1 << 10, 1 << 15, 1 << 20, 10 << 20, 100 << 20):
+        env = {'blob': 'x' * size}
+        number = max(1, (1 << 22) // size)
+        times = [
+            min(timeit.repeat(lambda: render(template, env), number=number, repeat=3))
+            * 1e3 / number
+            if template is templates[0] or size <= legacy_limit else None
+            for template in templates
+            ]
+        print('%8dKB %12.3fms %14s' % (
+            size >> 10, times[0],
+            '%12.3fms' % times[1] if times[1] is not None else 'skipped'))
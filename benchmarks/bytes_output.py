@@ -0,0 +1,60 @@
+# -*- coding: UTF-8 -*-
+import timeit
+import time
+import sys
+import os.path
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import stpl2
+
+
+templates = {
+    # rows with several variables are encoded once per line, as with encode
+    'loop': '''
+<ul>
+% for row in rows:
+  <li class="{{ row % 2 and 'odd' or 'even' }}">{{ row }} {{ title }}</li>
+% end
+</ul>
+''',
+    'literals': '''
+% for row in rows:
+<p>Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod</p>
+<div class="row">{{ row }} tempor incididunt ut labore et dolore magna aliqua</div>
+% end
+''',
+    'unicode': '''
+% for row in rows:
+<p>吾輩は猫である。名前はまだ無い。どこで生れたかとんと見当がつかぬ。</p>
+<div class="row">{{ row }} 何でも薄暗いじめじめした所でニャーニャー泣いていた事だけは記憶している。</div>
+% end
+''',
+    }
+
+
+class BytesTemplate(stpl2.Template):
+    output_encoding = 'utf-8'
+
+
+def render_encode(template, env):
+    return [line.encode('utf-8') for line in template.render(env)]
+
+
+def render_bytes(template, env):
+    return list(template.render(env))
+
+
+if __name__ == '__main__':
+    number = 200
+    env = {'rows': range(100), 'title': '<title>'}
+    print('%10s %12s %12s %8s' % ('template', 'encode', 'bytes', 'speedup'))
+    for name, code in sorted(templates.items()):
+        text, binary = stpl2.Template(code), BytesTemplate(code)
+        assert b''.join(render_encode(text, env)) == b''.join(render_bytes(binary, env))
+        times = [
+            min(timeit.repeat(lambda: func(template, env), number=number, repeat=20, timer=time.process_time))
+            * 1e6 / number
+            for func, template in ((render_encode, text), (render_bytes, binary))
+            ]
+        print('%10s %10.2fus %10.2fus %7.2fx' % (
+            (name,) + tuple(times) + (times[0] / times[1],)))
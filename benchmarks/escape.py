@@ -0,0 +1,57 @@
+
+import timeit
+import time
+import html
+import sys
+import os.path
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import stpl2
+
+
+def legacy_escape_html_safe(data):
+    '''
+    Escape function used by stpl2 before type-dispatched shortcuts.
+    '''
+    return html.escape('%s' % data)
+
+
+class Markup(str):
+    def __html__(self):
+        return self
+
+
+mixes = {
+    'numbers': [i for i in range(500)] + [i * 0.25 for i in range(500)],
+    'text': ['user%d' % i for i in range(500)] + ['Lorem ipsum dolor sit amet'] * 500,
+    'special': ['<a href="/item/%d">Item & co.</a>' % i for i in range(1000)],
+    'markup': [Markup('<b>%d</b>' % i) for i in range(1000)],
+    'table': [
+        value
+        for i in range(200)
+        for value in (i, 'Product %d' % i, i * 1.5, i % 3 == 0, None)
+        ],
+    }
+
+
+def run(func, values):
+    for value in values:
+        func(value)
+
+
+if __name__ == '__main__':
+    number = 200
+    print('%8s %12s %12s %8s' % ('mix', 'legacy', 'current', 'speedup'))
+    for name, values in sorted(mixes.items()):
+        if name != 'markup':
+            assert (
+                [stpl2.escape_html_safe(value) for value in values] ==
+                [legacy_escape_html_safe(value) for value in values])
+        times = [
+            min(timeit.repeat(
+                lambda: run(func, values), number=number, repeat=10,
+                timer=time.process_time)) * 1e6 / number
+            for func in (legacy_escape_html_safe, stpl2.escape_html_safe)
+            ]
+        print('%8s %10.2fus %10.2fus %7.2fx' % (
+            (name,) + tuple(times) + (times[0] / times[1],)))
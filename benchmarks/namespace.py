@@ -0,0 +1,45 @@
+
+import timeit
+import sys
+import os.path
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import stpl2
+import stpl2.internal
+
+
+class CopyingTemplateContext(stpl2.internal.TemplateContext):
+    '''
+    Template context copying builtins into namespace on every reset, as
+    stpl2 did before namespace layering.
+    '''
+    def reset(self, full_reset=True):
+        stpl2.internal.TemplateContext.reset(self, full_reset)
+        self.owned_namespace.update(self.builtins)
+
+
+class CopyingTemplate(stpl2.Template):
+    template_context_class = CopyingTemplateContext
+
+
+def get_env(size):
+    return dict(('var%d' % i, i) for i in range(size))
+
+
+def render(template, env):
+    for line in template.render(env):
+        pass
+
+
+if __name__ == '__main__':
+    number = 20000
+    code = '{{ var0 }}'
+    print('%8s %12s %12s' % ('env size', 'layered', 'copying'))
+    for size in (1, 10, 100, 1000):
+        env = get_env(size)
+        times = [
+            timeit.timeit(lambda: render(template, env), number=number)
+            for template in (stpl2.Template(code), CopyingTemplate(code))
+            ]
+        print('%8d %10.2fus %10.2fus' % (
+            (size,) + tuple(t * 1e6 / number for t in times)))
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+'''
+Stpl2 pre-fork memory benchmark
+===============================
+Shared and private memory of forked worker processes rendering templates
+loaded by their parent process, as preloading web servers do, comparing a
+parent which only compiled templates (see TemplateManager.warmup) with a
+parent which froze its manager (see TemplateManager.freeze).
+
+Memory is read from /proc/self/smaps_rollup (or /proc/self/smaps), so this
+benchmark only runs on Linux.
+
+Usage:
+
+    python benchmarks/prefork.py
+    python benchmarks/prefork.py -t 500 -w 8 -r 20 -c 2
+
+'''
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import stpl2
+
+
+base = '''<html>
+<head><title>{{ title }}</title></head>
+<body>
+% block content
+% end
+% include footer
+</body>
+</html>
+'''
+
+footer = '''<footer>{{ title }}</footer>
+'''
+
+page = '''% extends base
+% block content
+<h1>Page {0}</h1>
+<ul>
+% for row in rows:
+  <li class="{{{{ row % 2 and 'odd' or 'even' }}}}">{{{{ row }}}} {{{{ title }}}}</li>
+% end
+</ul>
+% if len(rows) > {0}:
+<p>More than {0} rows</p>
+% end
+% end
+'''
+
+
+def write_templates(directory, number):
+    '''
+    Write base, footer and given number of page templates.
+    '''
+    sources = {'base.tpl': base, 'footer.tpl': footer}
+    for i in range(number):
+        sources['page%d.tpl' % i] = page.format(i)
+    for name, code in sources.items():
+        with open(os.path.join(directory, name), 'w') as f:
+            f.write(code)
+    return ['page%d' % i for i in range(number)]
+
+
+def memory_usage():
+    '''
+    Get shared and private memory of current process, in bytes.
+    '''
+    path = '/proc/self/smaps_rollup'
+    if not os.path.exists(path):
+        path = '/proc/self/smaps'
+    usage = {'shared': 0, 'private': 0}
+    with open(path) as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in ('Shared_Clean', 'Shared_Dirty'):
+                usage['shared'] += int(value.split()[0]) * 1024
+            elif key in ('Private_Clean', 'Private_Dirty'):
+                usage['private'] += int(value.split()[0]) * 1024
+    return usage
+
+
+def worker(manager, names, repeat, output):
+    '''
+    Render every template given number of times, writing memory usage
+    as json to given file descriptor.
+    '''
+    env = {'title': 'Title', 'rows': range(20)}
+    for i in range(repeat):
+        for name in names:
+            manager.render_string(name, env)
+    os.write(output, json.dumps(memory_usage()).encode('utf-8'))
+    os.close(output)
+
+
+def master(mode, directory, names, args, output):
+    '''
+    Load templates, freezing manager if mode is "freeze", and fork given
+    number of workers, writing their memory usage as json to given file
+    descriptor.
+    '''
+    manager = stpl2.TemplateManager(directory, flatten=args.flatten)
+    if mode == 'freeze':
+        manager.freeze(contexts=args.contexts, variants=('string',), processes=1)
+    else:
+        manager.warmup(processes=1)
+    pipes = []
+    for i in range(args.workers):
+        read, write = os.pipe()
+        pid = os.fork()
+        if not pid:
+            os.close(read)
+            try:
+                worker(manager, names, args.repeat, write)
+            finally:
+                os._exit(0)
+        os.close(write)
+        pipes.append((pid, read))
+    results = []
+    for pid, read in pipes:
+        with os.fdopen(read, 'rb') as f:
+            results.append(json.loads(f.read().decode('utf-8')))
+        os.waitpid(pid, 0)
+    os.write(output, json.dumps(results).encode('utf-8'))
+    os.close(output)
+
+
+def run(mode, directory, names, args):
+    '''
+    Run master on a child process, so every mode starts from a clean
+    interpreter state.
+    '''
+    read, write = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(read)
+        try:
+            master(mode, directory, names, args, write)
+        finally:
+            os._exit(0)
+    os.close(write)
+    with os.fdopen(read, 'rb') as f:
+        results = json.loads(f.read().decode('utf-8'))
+    os.waitpid(pid, 0)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Stpl2 pre-fork memory benchmark')
+    parser.add_argument(
+        '-t', '--templates', type=int, default=200, help='page templates')
+    parser.add_argument(
+        '-w', '--workers', type=int, default=4, help='forked workers')
+    parser.add_argument(
+        '-r', '--repeat', type=int, default=10, help='renders per template')
+    parser.add_argument(
+        '-c', '--contexts', type=int, default=1,
+        help='idle contexts per template created on freeze')
+    parser.add_argument(
+        '-f', '--flatten', action='store_true', help='render flattened templates')
+    args = parser.parse_args(argv)
+    if not hasattr(os, 'fork') or not os.path.exists('/proc/self/smaps'):
+        parser.error('requires fork and /proc/self/smaps (Linux)')
+    directory = tempfile.mkdtemp()
+    try:
+        names = write_templates(directory, args.templates)
+        print('%8s %8s %12s %12s' % ('mode', 'worker', 'shared', 'private'))
+        for mode in ('warmup', 'freeze'):
+            results = run(mode, directory, names, args)
+            for i, usage in enumerate(results):
+                print('%8s %8d %10.1fMB %10.1fMB' % (
+                    mode, i, usage['shared'] / 1048576., usage['private'] / 1048576.))
+            print('%8s %8s %10.1fMB %10.1fMB' % (
+                mode, 'mean',
+                sum(usage['shared'] for usage in results) / 1048576. / len(results),
+                sum(usage['private'] for usage in results) / 1048576. / len(results)))
+    finally:
+        shutil.rmtree(directory)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
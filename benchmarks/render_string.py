@@ -0,0 +1,40 @@
+
+import timeit
+import sys
+import os.path
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import stpl2
+
+
+code = '''
+<ul>
+% for row in rows:
+  <li class="{{ row % 2 and 'odd' or 'even' }}">{{ row }} {{ title }}</li>
+% end
+</ul>
+'''
+
+
+def render_join(template, env):
+    return ''.join(template.render(env))
+
+
+def render_string(template, env):
+    return template.render_string(env)
+
+
+if __name__ == '__main__':
+    template = stpl2.Template(code)
+    print('%8s %12s %12s %8s' % ('rows', 'join', 'string', 'speedup'))
+    for size in (10, 100, 1000, 10000):
+        env = {'rows': range(size), 'title': '<title>'}
+        assert render_join(template, env) == render_string(template, env)
+        number = max(10, 100000 // size)
+        times = [
+            min(timeit.repeat(lambda: func(template, env), number=number, repeat=5))
+            * 1e6 / number
+            for func in (render_join, render_string)
+            ]
+        print('%8d %10.2fus %10.2fus %7.2fx' % (
+            (size,) + tuple(times) + (times[0] / times[1],)))
@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+'''
+Stpl2 benchmark suite
+=====================
+Render, compile and cold start scenarios, run with warmup and repeated
+measurements, against stpl2 and, if importable, bottle's SimpleTemplate.
+
+Usage:
+
+    python benchmarks/suite.py run -o before.json
+    python benchmarks/suite.py run -o after.json
+    python benchmarks/suite.py compare before.json after.json
+
+'''
+
+import argparse
+import collections
+import json
+import math
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import os.path
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import stpl2
+
+try:
+    import bottle
+except ImportError:
+    bottle = None
+
+
+sources = {
+    'basic': (
+        '<html>\n'
+        '<head><title>{{ title }}</title></head>\n'
+        '<body>\n'
+        '<h1>{{ title }}</h1>\n'
+        '<ul>\n'
+        '% for item in items:\n'
+        '  <li>{{ item }}</li>\n'
+        '% end\n'
+        '</ul>\n'
+        '</body>\n'
+        '</html>\n'
+        ),
+    'includes': (
+        '<html>\n'
+        '% include(\'header\', title=title)\n'
+        '% include(\'menu\', items=items)\n'
+        '<p>Content</p>\n'
+        '% include(\'menu\', items=items)\n'
+        '% include(\'footer\', title=title)\n'
+        '</html>\n'
+        ),
+    'header': '<head><title>{{ title }}</title></head>\n',
+    'menu': (
+        '<ul>\n'
+        '% for item in items:\n'
+        '  <li>{{ item }}</li>\n'
+        '% end\n'
+        '</ul>\n'
+        ),
+    'footer': '<footer>{{ title }}</footer>\n',
+    'rebase': (
+        '% rebase(\'layout\', title=title)\n'
+        '<h1>{{ title }}</h1>\n'
+        '% include(\'menu\', items=items)\n'
+        ),
+    'layout': (
+        '<html>\n'
+        '<head><title>{{ title }}</title></head>\n'
+        '<body>{{!base}}</body>\n'
+        '</html>\n'
+        ),
+    'extends0': (
+        '<html>\n'
+        '% block head\n'
+        '<head><title>{{ title }}</title></head>\n'
+        '% end\n'
+        '% block body\n'
+        '<body></body>\n'
+        '% end\n'
+        '</html>\n'
+        ),
+    'extends1': '% extends extends0\n% block body\n<body>1 {{!block.super}}</body>\n% end\n',
+    'extends2': '% extends extends1\n% block head\n<head>2 {{ title }}</head>\n% end\n',
+    'extends3': '% extends extends2\n% block body\n<body>3 {{!block.super}}</body>\n% end\n',
+    'extends4': (
+        '% extends extends3\n'
+        '% block body\n'
+        '% for item in items:\n'
+        '<p>{{ item }}</p>\n'
+        '% end\n'
+        '{{!block.super}}\n'
+        '% end\n'
+        ),
+    'loop': (
+        '<table>\n'
+        '% for row in rows:\n'
+        '<tr><td>{{ row[0] }}</td><td>{{ row[1] }}</td><td>{{ row[2] }}</td></tr>\n'
+        '% end\n'
+        '</table>\n'
+        ),
+    'escaping': (
+        '% for text in texts:\n'
+        '<p title="{{ text }}">{{ text }} {{ text }}</p>\n'
+        '% end\n'
+        ),
+    }
+
+envs = {
+    'basic': {'title': 'Basic & simple', 'items': ['Item %d' % i for i in range(10)]},
+    'loop': {'rows': [(i, 'Row %d' % i, i * 0.5) for i in range(1000)]},
+    'escaping': {'texts': ['<a href="/%d?a=1&b=2">\'Quoted\'</a>' % i for i in range(500)]},
+    }
+envs['includes'] = envs['rebase'] = envs['extends4'] = envs['basic']
+
+
+class Stpl2Engine(object):
+    name = 'stpl2'
+    version = stpl2.__version__
+    features = frozenset(('extends', 'buffering'))
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.manager = stpl2.TemplateManager(directory)
+        self.buffering_manager = stpl2.TemplateManager(directory)
+        self.buffering_manager.template_class = stpl2.BufferingTemplate
+
+    def render(self, name, env):
+        return ''.join(self.manager.render(name, env))
+
+    def render_buffered(self, name, env):
+        return ''.join(self.buffering_manager.render(name, env))
+
+    def compile(self, source):
+        return stpl2.Template(source)
+
+    def render_cold(self, name, env):
+        return ''.join(stpl2.TemplateManager(self.directory).render(name, env))
+
+
+class BottleEngine(object):
+    name = 'bottle'
+    version = getattr(bottle, '__version__', None)
+    features = frozenset()
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.templates = {}
+
+    def render(self, name, env):
+        template = self.templates.get(name)
+        if template is None:
+            template = self.templates[name] = bottle.SimpleTemplate(
+                name=name, lookup=[self.directory])
+        return template.render(**env)
+
+    def compile(self, source):
+        return bottle.SimpleTemplate(source=source).co
+
+    def render_cold(self, name, env):
+        return bottle.SimpleTemplate(
+            name=name, lookup=[self.directory]).render(**env)
+
+
+def render_scenario(name, method='render', requires=None):
+    def setup(engine):
+        if requires and requires not in engine.features:
+            return None
+        func = getattr(engine, method)
+        env = envs[name]
+        return lambda: func(name, env)
+    return setup
+
+
+def compile_scenario(engine):
+    source = sources['loop'] + sources['escaping'] + sources['basic']
+    return lambda: engine.compile(source)
+
+
+scenarios = collections.OrderedDict((
+    ('basic', render_scenario('basic')),
+    ('includes', render_scenario('includes')),
+    ('deep_extends', render_scenario('extends4', requires='extends')),
+    ('rebase', render_scenario('rebase')),
+    ('big_loop', render_scenario('loop')),
+    ('escaping', render_scenario('escaping')),
+    ('buffered', render_scenario('loop', 'render_buffered', 'buffering')),
+    ('compile', compile_scenario),
+    ('cold_start', render_scenario('includes', 'render_cold')),
+    ))
+
+
+def get_engines():
+    engines = [Stpl2Engine]
+    if bottle is not None:
+        engines.append(BottleEngine)
+    return engines
+
+
+def calibrate(func, min_time):
+    '''
+    Get number of calls taking at least min_time seconds.
+    '''
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for i in range(number):
+            func()
+        if time.perf_counter() - start >= min_time:
+            return number
+        number *= 2
+
+
+def measure(func, number, repeat, warmup):
+    '''
+    Get per-call times in seconds of repeat batches of given calls, after
+    given number of discarded warmup batches.
+    '''
+    samples = []
+    for i in range(warmup + repeat):
+        start = time.perf_counter()
+        for j in range(number):
+            func()
+        samples.append((time.perf_counter() - start) / number)
+    return samples[warmup:]
+
+
+def get_statistics(samples):
+    samples = sorted(samples)
+    size = len(samples)
+    mean = sum(samples) / size
+    middle = size // 2
+    median = (
+        samples[middle] if size % 2 else
+        (samples[middle - 1] + samples[middle]) / 2
+        )
+    variance = (
+        sum((sample - mean) ** 2 for sample in samples) / (size - 1)
+        if size > 1 else 0.
+        )
+    return {
+        'min': samples[0],
+        'max': samples[-1],
+        'median': median,
+        'mean': mean,
+        'stdev': math.sqrt(variance),
+        }
+
+
+def run(args):
+    directory = tempfile.mkdtemp()
+    try:
+        for name, source in sources.items():
+            with open(os.path.join(directory, name + '.tpl'), 'w') as f:
+                f.write(source)
+        results = collections.OrderedDict()
+        engines = [engine_class(directory) for engine_class in get_engines()]
+        for scenario, setup in scenarios.items():
+            if args.filter and not any(word in scenario for word in args.filter):
+                continue
+            for engine in engines:
+                func = setup(engine)
+                if func is None:
+                    continue
+                number = calibrate(func, args.min_time)
+                result = get_statistics(
+                    measure(func, number, args.repeat, args.warmup))
+                result.update(number=number, repeat=args.repeat)
+                key = '%s.%s' % (engine.name, scenario)
+                results[key] = result
+                print('%-24s %10.2fus %10.2fus +- %5.1f%%' % (
+                    key, result['min'] * 1e6, result['median'] * 1e6,
+                    result['stdev'] * 100 / result['mean']))
+    finally:
+        shutil.rmtree(directory)
+    if args.output:
+        data = {
+            'meta': {
+                'python': '%s %s' % (
+                    platform.python_implementation(),
+                    platform.python_version()),
+                'platform': platform.platform(),
+                'engines': dict(
+                    (engine.name, engine.version) for engine in engines),
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                },
+            'results': results,
+            }
+        with open(args.output, 'w') as f:
+            json.dump(data, f, indent=2)
+    return 0
+
+
+def compare(args):
+    results = []
+    for path in (args.old, args.new):
+        with open(path) as f:
+            results.append(json.load(f)['results'])
+    old, new = results
+    regressions = 0
+    print('%-24s %12s %12s %8s' % ('scenario', 'old', 'new', 'change'))
+    for key in old:
+        if key not in new:
+            continue
+        before = old[key][args.statistic]
+        after = new[key][args.statistic]
+        change = after / before - 1
+        mark = ''
+        if change > args.threshold:
+            mark = 'slower'
+            regressions += 1
+        elif change < -args.threshold:
+            mark = 'faster'
+        print('%-24s %10.2fus %10.2fus %+7.1f%% %s' % (
+            key, before * 1e6, after * 1e6, change * 100, mark))
+    for key in sorted(set(old).symmetric_difference(new)):
+        print('%-24s only in %s' % (key, args.old if key in old else args.new))
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Stpl2 benchmark suite')
+    subparsers = parser.add_subparsers(dest='command')
+    run_parser = subparsers.add_parser('run', help='run scenarios')
+    run_parser.add_argument('-o', '--output', help='JSON result file')
+    run_parser.add_argument(
+        '-r', '--repeat', type=int, default=10, help='measured batches')
+    run_parser.add_argument(
+        '-w', '--warmup', type=int, default=2, help='discarded batches')
+    run_parser.add_argument(
+        '-t', '--min-time', type=float, default=0.05,
+        help='minimum batch duration in seconds')
+    run_parser.add_argument(
+        'filter', nargs='*', help='run only scenarios containing any of these')
+    compare_parser = subparsers.add_parser(
+        'compare', help='compare two result files')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument(
+        '--threshold', type=float, default=0.05,
+        help='relative change considered significant')
+    compare_parser.add_argument(
+        '--statistic', default='median', choices=('min', 'median', 'mean'))
+    args = parser.parse_args(argv)
+    if args.command == 'compare':
+        return compare(args)
+    if args.command == 'run':
+        return run(args)
+    parser.print_help()
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
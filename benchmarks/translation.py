@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+'''
+Stpl2 translation benchmark
+===========================
+Template to python code translation time over synthetic report templates
+of growing size, which should grow linearly with template lines.
+
+Usage:
+
+    python benchmarks/translation.py
+    python benchmarks/translation.py -s 100 1000 -r 10 -q 8
+
+'''
+
+import argparse
+import sys
+import time
+import os.path
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from stpl2.internal import CodeTranslator
+
+
+block = (
+    '% for row in section{0}:\n'
+    '<tr class="{{{{ row.get(\'class\', "plain") }}}}">\n'
+    '  <td>{{{{ row[\'name\'] }}}}</td><td>{{{{ \'%.2f\' % row["value"] }}}}</td>\n'
+    '  % if row.get("note", \'\') == \'it\\\'s "quoted"\':\n'
+    '  <td title="{{{{ \' \'.join(["a", \'b\', "c"]) }}}}">It\'s "{{{{ row[\'note\'] }}}}" 100%</td>\n'
+    '  % else:\n'
+    '  <td>{{{{! row.get("raw", \'<br/>\') }}}} {{{{ \'{{{{\' }}}} \'unbalanced "quotes\'</td>\n'
+    '  % end\n'
+    '  % include(\'cell\', value=row["value"], label=\'a, b\')\n'
+    '</tr>\n'
+    '% end\n'
+    )
+
+
+def generate(lines, quotes=0):
+    '''
+    Get synthetic report template source with given number of lines, with
+    an additional line per row containing an unclosed variable followed by
+    given number of string literals.
+    '''
+    source = block
+    if quotes:
+        source = source.replace('</tr>\n', '<td>{{{{ %s</td></tr>\n' % ' '.join(
+            '\'s\'' if i % 2 else '"s"' for i in range(quotes)))
+    parts = []
+    for i in range(lines // source.count('\n') + 1):
+        parts.append(source.format(i))
+    return ''.join(''.join(parts).splitlines(True)[:lines])
+
+
+def measure(source, mode, repeat):
+    '''
+    Get minimum translation time in seconds of given repeats.
+    '''
+    best = None
+    for i in range(repeat):
+        translator = CodeTranslator(mode)
+        start = time.perf_counter()
+        for line in translator.translate_code(source):
+            pass
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Stpl2 translation benchmark')
+    parser.add_argument(
+        '-s', '--sizes', type=int, nargs='+',
+        default=[100, 1000, 10000, 100000], help='template lines')
+    parser.add_argument(
+        '-r', '--repeat', type=int, default=5, help='measured translations')
+    parser.add_argument(
+        '-m', '--mode', default='stream', choices=CodeTranslator.modes,
+        help='translation mode')
+    parser.add_argument(
+        '-q', '--quotes', type=int, default=0,
+        help='string literals after unclosed variables, exposing backtracking')
+    args = parser.parse_args(argv)
+    print('%10s %12s %12s' % ('lines', 'total', 'per line'))
+    for size in args.sizes:
+        source = generate(size, args.quotes)
+        repeat = max(1, min(args.repeat, args.repeat * 1000 // size))
+        elapsed = measure(source, args.mode, repeat)
+        print('%10d %10.2fms %10.2fus' % (size, elapsed * 1e3, elapsed * 1e6 / size))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
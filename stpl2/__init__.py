@@ -50,9 +50,13 @@ output
 from .internal import (
     # Template
     BufferingTemplate, TemplateManager, Template,
+    # Caching
+    BytecodeCache,
+    # Loaders
+    TemplateLoader, FileSystemLoader, ZipLoader, ResourceLoader, DictLoader,
     # Exceptions
     TemplateContextError, TemplateNotFoundError, TemplateRuntimeError,
-    TemplateSyntaxError, TemplateValueError,
+    TemplateSyntaxError, TemplateValueError, TemplateFrozenError,
     # Public functions
     escape_html_safe, tostr_safe,
     )
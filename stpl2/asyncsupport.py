@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+'''
+Stpl2 asyncio support
+=====================
+Asynchronous generators used by "async" template code variant, kept apart
+from :py:mod:stpl2.internal as they require python 3.6 syntax.
+
+'''
+
+import asyncio
+import inspect
+import time
+
+
+async def aiter_lines(iterable):
+    '''
+    Iterate over either asynchronous or regular iterable.
+
+    :param iterable: async iterable (as async template functions) or iterable
+    :yield str: lines from given iterable
+    '''
+    if hasattr(iterable, '__aiter__'):
+        async for line in iterable:
+            yield line
+    else:
+        for line in iterable:
+            yield line
+
+
+async def capture_lines(iterable, callback):
+    '''
+    Iterate over either asynchronous or regular iterable, calling given
+    function with all lines once exhausted (see FragmentGenerator).
+
+    :param iterable: async iterable (as async template functions) or iterable
+    :param callable callback: function receiving list of lines
+    :yield str: lines from given iterable
+    '''
+    lines = []
+    async for line in aiter_lines(iterable):
+        lines.append(line)
+        yield line
+    callback(lines)
+
+
+async def auto_await(value):
+    '''
+    Await given value if awaitable, or consume it if async iterable (as
+    includes and blocks used as variables).
+
+    :param value: any python object
+    :returns: resolved value
+    '''
+    if inspect.isawaitable(value):
+        return await value
+    if hasattr(value, '__aiter__'):
+        return ''.join([line async for line in aiter_lines(value)])
+    return value
+
+
+async def render_template(template, env=None, stats=None):
+    '''
+    Render template asynchronously (see :py:meth:Template.render_async),
+    recording it on given stats, if any, once exhausted or closed (see
+    :py:meth:Template.iter_render).
+
+    :param Template template: template object
+    :param dict env: environment dictionary
+    :param TemplateStats stats: optional stats recording this render
+    :yield str: lines from rendered template
+    '''
+    start = None if stats is None else time.perf_counter()
+    size = 0
+    failed = False
+    try:
+        if template.static:
+            if template.static_output:
+                size = len(template.static_output)
+                yield template.static_output
+            return
+        pool = template.get_pool('async')
+        if len(pool):
+            context = template.get_context(env, 'async', pool)
+        else:
+            # New contexts load related templates
+            context = await asyncio.get_event_loop().run_in_executor(
+                None, template.get_context, env, 'async', pool)
+        try:
+            if start is None:
+                async for line in context.template():
+                    yield line
+            else:
+                async for line in context.template():
+                    size += len(line)
+                    yield line
+        except BaseException:
+            error = template.get_runtime_error(context)
+            if error is None:
+                raise
+            raise error
+        finally:
+            template.release_context(context, pool)
+    except Exception:
+        failed = True
+        raise
+    finally:
+        if start is not None:
+            stats.add_render(template, time.perf_counter() - start, size, failed)
+
+
+async def render_manager_template(manager, name, env=None):
+    '''
+    Render template asynchronously (see :py:meth:TemplateManager.render_async).
+
+    :param TemplateManager manager: template manager
+    :param str name: name or path for template
+    :param dict env: optional variable dictionary
+    :yield str: lines from rendered template
+    '''
+    getter = manager.get_flattened_template if manager.flatten else manager.get_template
+    if manager.is_template_loaded(name):
+        template = getter(name)
+    else:
+        template = await asyncio.get_event_loop().run_in_executor(None, getter, name)
+    async for line in render_template(template, env, template.stats):
+        yield line
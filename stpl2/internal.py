@@ -9,57 +9,138 @@ Please note only stuff exposed though __init__ module is considered public API
 
 import re
 import sys
+import array
+import bisect
 import zlib
+import marshal
+import hashlib
+import tempfile
 import collections
+import errno
 import os
 import os.path
 import functools
+import itertools
+import codecs
+import time
+import types
+import weakref
+import threading
+import inspect
+import multiprocessing
+import logging
+import gc
+import pkgutil
+import zipfile
 
 # Py3k fixes
 py3k = sys.version > '3'
 if py3k:
     import builtins
     import html
+    import importlib
+    import importlib.util
+    from collections.abc import MutableMapping
+    try:
+        from importlib.resources import files as resource_files
+    except ImportError: # python 3.8 or older
+        resource_files = None
     xrange = range
     iteritems = dict.items
     itervalues = dict.values
     unicode_prefix = ''
     base_notfounderror = FileNotFoundError
     yield_from_supported = sys.version_info.minor > 2
+    async_supported = sys.version_info >= (3, 6)
+    bytes_supported = sys.version_info >= (3, 5) # bytes formatting
+    scandir = getattr(os, "scandir", None) # python 3.5 or newer
     maxint = sys.maxsize
     native_string_bases = (str,)
+    python_magic = importlib.util.MAGIC_NUMBER
+    CO_GENERATOR = inspect.CO_GENERATOR
+    replace_file = os.replace
     tostr_safe = str
+    timer = time.perf_counter
 
-    def escape_html_safe(data):
+    def get_module_code(name):
         '''
-        Parse given data to string and apply escape_html
+        Get code object of given module without importing it.
 
-        :param obj: any python object
-        :return str: escaped html string
+        :param str name: absolute module name
+        :return code: module code object
         '''
-        return html.escape('%s' % data)
+        return importlib.util.find_spec(name).loader.get_code(name)
+
+    escape_text_types = frozenset((str,))
+    escape_skip_types = frozenset((int, float, bool, type(None)))
+    escape_html_text = html.escape
+
+    if async_supported:
+        from .asyncsupport import aiter_lines, auto_await, capture_lines, \
+            render_template, render_manager_template
 else:
     import __builtin__ as builtins
     import cgi
+    import imp
+    import importlib
+    from collections import MutableMapping
+    resource_files = None
     iteritems = dict.iteritems
     itervalues = dict.itervalues
     unicode_prefix = 'u'
     base_notfounderror = IOError
     yield_from_supported = False
+    async_supported = False
+    bytes_supported = False
+    scandir = None
     maxint = sys.maxint
     native_string_bases = (basestring,)
+    python_magic = imp.get_magic()
+    CO_GENERATOR = inspect.CO_GENERATOR
+    replace_file = os.rename
+    timer = time.time
+
+    def get_module_code(name):
+        '''
+        Get code object of given module without importing it.
+
+        :param str name: absolute module name
+        :return code: module code object
+        '''
+        return pkgutil.get_loader(name).get_code(name)
 
     def tostr_safe(data):
         return '%s' % data
 
-    def escape_html_safe(data):
-        '''
-        Parse given data to string and apply escape_html
+    escape_text_types = frozenset((str, unicode))
+    escape_skip_types = frozenset((int, long, float, bool, type(None)))
 
-        :param obj: any python object
-        :return str: escaped html string
-        '''
-        return cgi.escape('%s' % data, quote=True).replace("'", "&apos;")
+    def escape_html_text(data):
+        return cgi.escape(data, quote=True).replace("'", "&apos;")
+
+
+def escape_html_safe(data):
+    '''
+    Parse given data to string and apply escape_html.
+
+    Strings without special characters are returned as they are, numbers,
+    booleans and None are not escaped, and objects implementing __html__
+    markup-safe protocol are not escaped either.
+
+    :param obj: any python object
+    :return str: escaped html string
+    '''
+    cls = type(data)
+    if cls in escape_text_types:
+        if '&' in data or '<' in data or '>' in data or '"' in data or "'" in data:
+            return escape_html_text(data)
+        return data
+    if cls in escape_skip_types:
+        return '%s' % data
+    markup = getattr(data, '__html__', None)
+    if markup is not None:
+        return markup()
+    return escape_html_text('%s' % data)
 
 
 class TemplateSyntaxError(SyntaxError):
@@ -79,12 +160,15 @@ class TemplateValueError(ValueError):
 
 
 class TemplateRuntimeError(RuntimeError):
-    def __init__(self, error, code=None, lineno=None, pycode=None, pylineno=None):
+    def __init__(self, error, code=None, lineno=None, pycode=None, pylineno=None,
+                 template=None, variant="stream"):
         self.error = error
         self.code = code
         self.lineno = lineno
-        self.pycode = pycode
         self.pylineno = pylineno
+        self.template = template
+        self.variant = variant
+        self._pycode = pycode
 
         context = []
         if code:
@@ -118,6 +202,16 @@ class TemplateRuntimeError(RuntimeError):
             error = "%s\n%s" % (error, "\n".join(context))
         RuntimeError.__init__(self, error)
 
+    @property
+    def pycode(self):
+        '''
+        Lines of generated python code, retrieved from template on first
+        access.
+        '''
+        if self._pycode is None and self.template is not None:
+            self._pycode = self.template.get_pycode(self.variant).splitlines()
+        return self._pycode
+
 
 class CodeTranslator(object):
     '''
@@ -136,24 +230,54 @@ class CodeTranslator(object):
 
     indent_tokens = ("class", "def", "with", "if", "for", "while")
     redent_tokens = ("else", "elif", "except", "finally")
-    custom_tokens = ("block", "block.super", "end", "extends", "include", "rebase", "base")
+    custom_tokens = ("block", "block.super", "end", "extends", "include", "rebase", "base", "cache")
+
+    modes = ("stream", "string", "async", "bytes")
+
+    # escape sensitive string literal, unambiguous so never backtracks
+    re_string = re.compile(r"""'(?:\\.|[^'\\])*'|"(?:\\.|[^"\\])*\"""", re.DOTALL)
+    re_quote = re.compile("['\"]")
+
+    def __init__(self, mode="stream", encoding="utf-8"):
+        '''
+        :param str mode: generated code mode, either "stream" for generator
+                         functions yielding strings, "string" for functions
+                         returning lists of strings, "async" for
+                         asynchronous generator functions (python 3.6+) or
+                         "bytes" for generator functions yielding bytes
+                         (python 3.5+).
+        :param str encoding: ASCII-compatible encoding for literals on
+                             "bytes" mode
+        '''
+        if not mode in self.modes:
+            raise self.value_error_class("Unsupported translation mode %r." % mode)
+        if mode == "async" and not async_supported:
+            raise self.value_error_class("Translation mode 'async' requires python 3.6 or newer.")
+        if mode == "bytes":
+            if not bytes_supported:
+                raise self.value_error_class("Translation mode 'bytes' requires python 3.5 or newer.")
+            if "%s".encode(encoding) != b"%s":
+                raise self.value_error_class("Encoding %r is not ASCII-compatible." % encoding)
+        self.mode = mode
+        self.encoding = encoding
+        # encoding every rendered line is the main cost of bytes mode on
+        # loops, and str.encode is faster without arguments
+        self.encode_suffix = (
+            ".encode()" if mode != "bytes" or codecs.lookup(encoding).name == "utf-8" else
+            ".encode(%r)" % encoding
+            )
+        if mode == "string":
+            self.yield_from = self.yield_from_string
+        elif mode == "async":
+            self.yield_from = self.yield_from_async
 
-    def __init__(self):
         # compile regexps
         indent = r"((?P<indent>(%s))(?!\w))" % "|".join(re.escape(i) for i in self.indent_tokens)
         redent = r"((?P<redent>(%s))(?!\w))" % "|".join(re.escape(i) for i in self.redent_tokens)
         custom = r"((?P<custom>(%s))(?!\w)\s*(?P<params>((\s+.*)|(\(.*\)))\s*)?$)" % "|".join(re.escape(i) for i in self.custom_tokens)
 
-        redict = {
-            'string': r"(\'((\\.)|[^\'])*?\')|(\"((\\.)|[^\"])*?\")", # massive nongreedy string and escape sensitive dotall regexp
-            'var_open': re.escape(self.variable_open),
-            'var_close': re.escape(self.variable_close),
-        }
-
         # regexp precompilation
         self.re_tokens = re.compile("^(%s)" % "|".join((indent, redent, custom)))
-        self.re_var = re.compile("(%(var_open)s(?P<var>(%(string)s|.)*?)%(var_close)s)|(?P<escape>%%)" % redict)
-        self.re_inline = re.compile("(\{(%(string)s)\}|(%(string)s)|.)*?:(?P<inline>.*)" % redict)
 
         self.code_line_prefix_length = len(self.code_line_prefix)
 
@@ -180,7 +304,20 @@ class CodeTranslator(object):
         quoted = None
         escaped = False
         key = None
-        for p, char in enumerate(params):
+        # runs of characters with no special meaning are taken at once
+        special = "".join(set(seps).union(valuesep, strip, quote, escape))
+        re_plain = re.compile("[^%s]+" % re.escape(special)) if special else None
+        p = -1
+        size = len(params)
+        while p + 1 < size:
+            p += 1
+            if not escaped and re_plain:
+                match = re_plain.match(params, p)
+                if match:
+                    (kwargs[key] if key else args[-1]).append(match.group())
+                    p = match.end() - 1
+                    continue
+            char = params[p]
             if escaped:
                 escaped = False
                 (kwargs[key] if key else args[-1]).append(char)
@@ -249,11 +386,124 @@ class CodeTranslator(object):
         :param string line: line of code with indent token
         :returns bool: True if line contains no inline code so must indent.
         '''
-        match = self.re_inline.match(line)
-        if match:
-            stripped = match.groupdict().get("inline", "").strip()
-            return not stripped or stripped.startswith("#")
-        return True
+        last = line.rfind(":")
+        if last < 0:
+            return True
+        colon = self.find_unquoted(line, ":", 0, last, braces=True)
+        stripped = line[colon + 1:].strip()
+        return not stripped or stripped.startswith("#")
+
+    def skip_string(self, data, start, last, brace=False):
+        '''
+        Get end of string literal starting at given position, preferring
+        escape-aware literals over those taking backslashes as regular
+        characters, as long as literal ends before last position.
+
+        :param str data: single line of text
+        :param int start: string literal opening quote position
+        :param int last: maximum position for literal end
+        :param bool brace: whether literal must be followed by a closing brace
+        :returns int: position after string literal or -1 if not found
+        '''
+        if brace:
+            accept = lambda end: end < last and data[end] == "}"
+        else:
+            accept = lambda end: end <= last
+        match = self.re_string.match(data, start)
+        if match and accept(match.end()):
+            return match.end()
+        # Unclosed or rejected literal, resolved backwards from last position
+        quote = data[start]
+        ends = [-1] * (last - start + 1)
+        for i in range(last - 1, start, -1):
+            char = data[i]
+            end = -1
+            if char == quote:
+                if accept(i + 1):
+                    end = i + 1
+            else:
+                if char == "\\" and i + 2 < last:
+                    end = ends[i + 2 - start]
+                if end < 0:
+                    end = ends[i + 1 - start]
+            ends[i - start] = end
+        return ends[1]
+
+    def find_unquoted(self, data, target, pos, last, braces=False):
+        '''
+        Find first occurrence of target outside string literals, scanning
+        forward without backtracking.
+
+        String literals are skipped only when followed by another target
+        occurrence, otherwise their quotes are taken as regular characters.
+
+        :param str data: single line of text
+        :param str target: substring to look for
+        :param int pos: scan start position
+        :param int last: position of last target occurrence in data, must be
+                         greater or equal than pos
+        :param bool braces: whether string literals enclosed in braces are
+                            skipped along with their braces
+        :returns int: target position
+        '''
+        found = data.find(target, pos)
+        while True:
+            match = self.re_quote.search(data, pos, found)
+            if match is None:
+                return found
+            quote = match.start()
+            end = -1
+            if braces and quote > pos and data[quote - 1] == "{":
+                end = self.skip_string(data, quote, last, True)
+                if end > -1:
+                    end += 1
+            if end < 0:
+                end = self.skip_string(data, quote, last)
+            pos = quote + 1 if end < 0 else end
+            if pos > found:
+                found = data.find(target, pos)
+
+    def iter_var_spans(self, data):
+        '''
+        Scan a template line for variable substitutions in a single pass.
+
+        :param str data: single line of template
+        :yield tuple: start and end positions of every variable, delimiters
+                      included
+        '''
+        open_length = len(self.variable_open)
+        close_length = len(self.variable_close)
+        last = data.rfind(self.variable_close)
+        pos = 0
+        while True:
+            start = data.find(self.variable_open, pos)
+            if start < 0 or start + open_length > last:
+                return
+            pos = self.find_unquoted(
+                data, self.variable_close, start + open_length, last
+                ) + close_length
+            yield start, pos
+
+    def translate_vars(self, data):
+        '''
+        Replace variables on template line by string substitutions (see
+        :py:meth:translate_var) escaping any other '%' character.
+
+        :param str data: single line of template
+        :returns str: line as format string
+        '''
+        open_length = len(self.variable_open)
+        close_length = len(self.variable_close)
+        if not self.variable_open in data:
+            return data.replace("%", "%%")
+        parts = []
+        pos = 0
+        for start, end in self.iter_var_spans(data):
+            parts.append(data[pos:start].replace("%", "%%"))
+            parts.append(self.translate_var(data[start + open_length:end - close_length]))
+            pos = end
+        parts.append(data[pos:].replace("%", "%%"))
+        return "".join(parts)
 
     @property
     def indent(self):
@@ -266,10 +516,66 @@ class CodeTranslator(object):
 
     @property
     def dopass(self):
-        if self.level == self.minlevel or self.block_stack and self.level == self.block_stack[-1][0]:
+        if self.mode != "string" and (self.level == self.minlevel or self.block_stack and self.level == self.block_stack[-1][0] or self.fragment_stack and self.level == self.fragment_stack[-1][0]):
             return "%sreturn; yield" % self.indent
         return "%spass" % self.indent
 
+    @property
+    def function_keyword(self):
+        return "async def" if self.mode == "async" else "def"
+
+    def function_start(self):
+        '''
+        :yield basestring: lines initializing function output (string mode)
+        '''
+        if self.mode == "string":
+            yield "%s__output__ = []; _append = __output__.append; _extend = __output__.extend" % self.indent
+
+    def function_finish(self):
+        '''
+        :yield basestring: lines returning function output (string mode)
+        '''
+        if self.mode == "string":
+            yield "%sreturn __output__" % self.indent
+        elif self.mode == "async":
+            # ensure an asynchronous generator is defined
+            yield "%sreturn; yield" % self.indent
+
+    def literal(self, data):
+        '''
+        :param str data: literal text
+        :returns str: python literal for given text, see :py:meth:encode_chunk
+                      for bytes mode
+        '''
+        if self.mode == "bytes":
+            self.chunk_literals.append((repr(data), data))
+        return repr(data)
+
+    def encode_chunk(self, part):
+        '''
+        On bytes mode, retain lines of current string yield until finished,
+        then encode their literals if :py:meth:yield_string_finish chose to.
+
+        :param str part: line of code
+        :yield str: lines of code
+        '''
+        if self.mode != "bytes":
+            yield part
+            return
+        if not self.first_string_line:
+            self.chunk_parts.append(part)
+            return
+        literals = iter(self.chunk_literals)
+        literal = next(literals, None)
+        for chunk_part in self.chunk_parts:
+            if self.chunk_encode and literal and chunk_part.lstrip().startswith(literal[0]):
+                chunk_part = chunk_part.replace(
+                    literal[0], repr(literal[1].encode(self.encoding)), 1)
+                literal = next(literals, None)
+            yield chunk_part
+        del self.chunk_parts[:]
+        del self.chunk_literals[:]
+        yield part
 
     def yield_string_start(self):
         '''
@@ -278,7 +584,12 @@ class CodeTranslator(object):
         if self.first_string_line:
             self.level_touched = True
             self.first_string_line = False
-            yield "%syield (" % self.indent
+            if self.mode == "string":
+                yield "%s_append((" % self.indent
+            elif self.mode == "bytes":
+                yield "%syield ((" % self.indent
+            else:
+                yield "%syield (" % self.indent
             self.level += 1
 
     def yield_string_finish(self):
@@ -288,13 +599,26 @@ class CodeTranslator(object):
         if not self.first_string_line:
             self.level_touched = True
             self.first_string_line = True
+            close = ")" if self.mode == "string" else ""
+            if self.mode == "bytes":
+                # Encoding every variable is cheaper than encoding the whole
+                # string only for a single one, raw variables are bytes.
+                self.chunk_encode = self.chunk_raw or len(self.string_vars) < 2
+                if self.chunk_encode:
+                    close = ")"
+                    for index in self.chunk_escaped:
+                        self.string_vars[index] += self.encode_suffix
+                else:
+                    close = ")%s" % self.encode_suffix
+                self.chunk_raw = False
+                del self.chunk_escaped[:]
             if self.string_vars:
                 rtup = ", ".join(self.string_vars)
                 suffix = "" if "," in rtup else ","
-                yield "%s) %% (%s%s)" % (self.indent, rtup, suffix)
+                yield "%s) %% (%s%s)%s" % (self.indent, rtup, suffix, close)
                 del self.string_vars[:]
             else:
-                yield "%s)" % self.indent
+                yield "%s)%s" % (self.indent, close)
             self.level -= 1
 
     def yield_from_native(self, param):
@@ -305,29 +629,55 @@ class CodeTranslator(object):
 
     def yield_from_legacy(self, param):
         '''
-        :yield basestring: lines with for line in... yield line for legacy python versions
+        :yield basestring: lines with for __line__ in... yield __line__ for
+                           legacy python versions, so user variables are
+                           left untouched
+        '''
+        yield "%sfor __line__ in %s:" % (self.indent, param)
+        self.level += 1
+        yield "%syield __line__" % self.indent
+        self.level -= 1
+
+    def yield_from_async(self, param):
+        '''
+        :yield basestring: lines with async for __line__ in... yield __line__
+                           (async mode)
         '''
-        yield "%sfor line in %s:" % (self.indent, param)
+        yield "%sasync for __line__ in _aiter(%s):" % (self.indent, param)
         self.level += 1
-        yield "%syield line" % self.indent
+        yield "%syield __line__" % self.indent
         self.level -= 1
 
+    def yield_from_string(self, param):
+        '''
+        :yield basestring: line extending function output (string mode)
+        '''
+        yield "%s_extend(%s)" % (self.indent, param)
+
     yield_from = yield_from_native if yield_from_supported else yield_from_legacy
 
-    def translate_var(self, match):
+    def translate_var(self, var):
         '''
-        Get variable string substitution (for re.sub) and store variable code.
+        Get variable string substitution and store variable code.
+        :param str var: variable code, without delimiters
         :return str: positional variable string substitution '%s'
         '''
-        group = match.groupdict()
-        if group.get('escape', None):
-            return '%%'
-        var = group.get('var', None)
-        if var is None:
-            return ''
         var = var.strip()
+        self.static = False
         # STPL awful bang ('!') modifier
-        var = var[1:].lstrip() if var[0] == '!' else '_escape(%s)' % var
+        escape = var[0] != '!'
+        if not escape:
+            var = var[1:].lstrip()
+        if self.mode == "async":
+            # Awaitables and async iterables are resolved
+            var = "(await _await(%s))" % var
+        if escape:
+            var = '_escape(%s)' % var
+            if self.mode == "bytes":
+                self.chunk_escaped.append(len(self.string_vars))
+        elif self.mode == "bytes":
+            var = '_str(%s)' % var
+            self.chunk_raw = True
         self.string_vars.append(var)
         return "%s"
 
@@ -338,8 +688,17 @@ class CodeTranslator(object):
         '''
         if not self.level_touched:
             yield self.dopass
+        fragment = None
+        if self.fragment_stack and self.level == self.fragment_stack[-1][0]:
+            fragment = self.fragment_stack.pop()
+            for line in self.function_finish():
+                yield line
         self.level -= 1
         self.level_touched = True # level already touched by indent token
+        if fragment:
+            level, name, params = fragment
+            for line in self.yield_from("_fragment(%s, %s)" % (name, params)):
+                yield line
         if self.level < self.minlevel:
             if self.block_stack:
                 # level below minimum cos we're ending current block
@@ -391,6 +750,28 @@ class CodeTranslator(object):
         for line in self.yield_from("block.super"):
             yield line
 
+    def translate_token_cache(self, params=None):
+        '''
+        Start a cached fragment, defined as a nested function which will be
+        yielded through template context fragment cache on 'end' token.
+        Params are python arguments for :py:meth:TemplateContext.get_fragment
+        (key and optional ttl).
+        :yield: lines defining fragment function
+        '''
+        params = params.strip() if params else ""
+        if params.startswith("(") and params.endswith(")"):
+            params = params[1:-1].strip()
+        if not params:
+            raise self.value_error_class("Token 'cache' receives at least one argument: key (line %d)." % self.linenum)
+        name = "__fragment%d__" % len(self.fragments)
+        self.fragments.append(name)
+        yield "%s%s %s():" % (self.indent, self.function_keyword, name)
+        self.level += 1
+        self.level_touched = False
+        self.fragment_stack.append((self.level, name, params))
+        for line in self.function_start():
+            yield line
+
     def translate_token_include(self, params=None):
         '''
         Generate lines for yielding for other template with given name.
@@ -428,6 +809,7 @@ class CodeTranslator(object):
         Translate a template line with inline python code
         '''
         # Code line
+        self.static = False
         lstripped = data[self.code_line_prefix_length:].lstrip()
         try:
             group = self.re_tokens.match(lstripped).groupdict()
@@ -459,14 +841,14 @@ class CodeTranslator(object):
         '''
         # String
         if data.strip():
-            data = self.re_var.sub(self.translate_var, data)
+            data = self.translate_vars(data)
             for i in self.yield_string_start():
                 yield i
-            yield '%s%r' % (self.indent, data)
+            yield '%s%s' % (self.indent, self.literal(data))
         elif not self.inline:
             for i in self.yield_string_start():
                 yield i
-            yield '%s%r' % (self.indent, data)
+            yield '%s%s' % (self.indent, self.literal(data))
 
     def translate_literal_line(self, data):
         '''
@@ -495,13 +877,13 @@ class CodeTranslator(object):
                 for i in self.yield_string_start():
                     yield i
                 if self.previous_indent:
-                    yield "%s%r" % (self.indent, " " * self.previous_indent)
+                    yield "%s%s" % (self.indent, self.literal(" " * self.previous_indent))
                 for line in self.translate_line(template_data):
                     yield line
             elif self.previous_string:
                 for i in self.yield_string_start():
                     yield i
-                yield "%s%r" % (self.indent, self.linesep)
+                yield "%s%s" % (self.indent, self.literal(self.linesep))
 
     def translate_template_line(self, data):
         '''
@@ -514,6 +896,7 @@ class CodeTranslator(object):
         if self.literal_open in data:
             data, literal_data = data.split(self.literal_open, 1)
             self.inline = True
+            self.static = False
         lstripped = data.lstrip()
         if lstripped.startswith(self.code_line_prefix):
             for line in self.yield_string_finish():
@@ -537,55 +920,90 @@ class CodeTranslator(object):
             for line in self.translate_line(literal_data):
                 yield line
 
-    def translate_code(self, data):
+    def annotate(self, part, lineno):
+        '''
+        :param str part: line of python code
+        :param int lineno: template line number
+        :returns str: line of python code with template line annotation
+        '''
+        margin = 67 - len(part) - len("%d" % lineno)
+        return part + ("#lineno:%d#" % lineno).rjust(margin)
+
+    def translate_code(self, data, chunk_breaks=()):
         '''
         Resets object state (see :py:method:reset) and generate python code
         that yields given data.
 
         :param str data: template string
+        :param chunk_breaks: optional line numbers whose text must not be
+                             yielded along previous lines
         :yields str: generated lines of python code with endings
         '''
         self.reset()
 
         # Yield lines
         yield "# -*- coding: UTF-8 -*-%s" % self.linesep
-        yield "def __template__():%s" % self.linesep
+        yield "%s __template__():%s" % (self.function_keyword, self.linesep)
+        for line in self.function_start():
+            yield line + self.linesep
         oneline = False
         annotated = False
+        chunk_linenum = 0 # last line of current string yield
         for self.linenum, line in enumerate(data.splitlines(True), 1):
             annotated = False
-            for part in self.translate_line(line):
+            chunk_open = not self.first_string_line
+            parts = self.translate_line(line)
+            if chunk_open and self.linenum in chunk_breaks:
+                parts = itertools.chain(self.yield_string_finish(), parts)
+            for part in parts:
                 if part.endswith(self.linesep):
                     # needed for annotations, removes extra whitelines
                     part = part[:-1]
-                if not annotated:
+                if chunk_open and self.first_string_line:
+                    # string yield finish, with variables from previous lines
+                    chunk_open = False
+                    part = self.annotate(part, chunk_linenum)
+                elif not annotated:
                     annotated = True
-                    margin = 67 - len(part) - len("%d" % self.linenum)
-                    part += ("#lineno:%d#" % self.linenum).rjust(margin)
-                if self.block_stack:
-                    block_line, block_name = self.block_stack[-1]
-                    self.block_content[block_name].append(part)
-                    continue
-                oneline |= True
-                yield part + self.linesep
+                    part = self.annotate(part, self.linenum)
+                for part in self.encode_chunk(part):
+                    if self.block_stack:
+                        block_line, block_name = self.block_stack[-1]
+                        self.block_content[block_name].append(part)
+                        continue
+                    oneline |= True
+                    yield part + self.linesep
+            if not self.first_string_line:
+                chunk_linenum = self.linenum
+        if self.fragment_stack:
+            raise self.syntax_error_class("Unmatched 'cache' token, 'end' is missing.")
         self.level = self.minlevel # Reset level
-        if not oneline:
+        if not oneline and not self.chunk_parts:
             # empty template, pass
             yield self.dopass + self.linesep
         else:
             for line in self.yield_string_finish():
-                yield line + self.linesep
+                line = self.annotate(line, chunk_linenum)
+                for part in self.encode_chunk(line):
+                    yield part + self.linesep
             del self.string_vars[:]
+        self.level = self.minlevel
+        for line in self.function_finish():
+            yield line + self.linesep
         # Yield blocks
         yield "__blocks__ = {}%s" % self.linesep
         for name, lines in iteritems(self.block_content):
-            yield "def __block__(block):%s" % self.linesep
+            yield "%s __block__(block):%s" % (self.function_keyword, self.linesep)
+            for line in self.function_start():
+                yield line + self.linesep
             oneline = False
             for linenum, line in enumerate(lines, 1):
                 oneline |= True
                 yield line + self.linesep
             if not oneline:
                 yield self.dopass + self.linesep
+            for line in self.function_finish():
+                yield line + self.linesep
             yield "__blocks__[%r] = __block__%s" % (name, self.linesep)
 
         # Yield metadata fields
@@ -616,27 +1034,48 @@ class CodeTranslator(object):
         self.string_vars = []
         self.block_stack = [] # list of block levels as (base, name)
         self.block_content = collections.defaultdict(list)
+        self.fragment_stack = [] # list of cache tokens as (level, name, params)
+        self.fragments = []
         self.level_touched = False
+        self.static = True # False if any variable, code line or code block
+        # bytes mode, see encode_chunk
+        self.chunk_parts = []
+        self.chunk_literals = []
+        self.chunk_escaped = []
+        self.chunk_raw = False
+        self.chunk_encode = True
 
 
 class StringGenerator(object):
     '''
     Generic generator wrapper which receives a generator factory function and
     arguments and allows iteration.
+
+    Generators of "bytes" code variant contexts have :py:attr:encoding set,
+    as their lines are bytes.
     '''
-    __slots__ = ('_iterfunc', '_args', '_kwargs')
+    __slots__ = ('_iterfunc', '_args', '_kwargs', 'encoding')
 
     def __init__(self, iterfunc=None, *args, **kwargs):
         self._iterfunc = iterfunc
         self._args = args
         self._kwargs = kwargs
+        self.encoding = None
 
-    def __iter__(self):
+    def _generate(self):
         if self._iterfunc:
             return self._iterfunc(*self._args, **self._kwargs)
         return ()
 
+    def __iter__(self):
+        return iter(self._generate())
+
+    def __aiter__(self):
+        return aiter_lines(self._generate())
+
     def __str__(self):
+        if self.encoding:
+            return b"".join(self).decode(self.encoding)
         return "".join(self)
 
 
@@ -668,11 +1107,102 @@ class BlockGenerator(StringGenerator):
         self._name = name
         self._superfunc = superfunc
 
-    def __iter__(self):
+    def _generate(self):
         local_block = self.local_block_class(self._superfunc, self._name, self.local_block_class)
+        local_block.encoding = local_block.super.encoding = self.encoding
         return self._iterfunc(local_block)
 
 
+class FragmentGenerator(StringGenerator):
+    '''
+    Object retrieved by fragment function (see cache token), yielding
+    cached output or, if not cached, function output while capturing it.
+
+    Output is cached as text, so it is shared by all code variants.
+    '''
+    __slots__ = ('_cache', '_key', '_ttl')
+
+    def __init__(self, iterfunc, cache, key, ttl=None):
+        StringGenerator.__init__(self, iterfunc)
+        self._cache = cache
+        self._key = key
+        self._ttl = ttl
+
+    def _get(self):
+        value = self._cache.get(self._key)
+        if value and self.encoding:
+            return value.encode(self.encoding)
+        return value
+
+    def _set(self, lines):
+        value = lines[0][:0].join(lines) if lines else ""
+        if self.encoding:
+            value = value.decode(self.encoding)
+        self._cache.set(self._key, value, self._ttl)
+
+    def _capture(self, lines):
+        captured = []
+        for line in lines:
+            captured.append(line)
+            yield line
+        self._set(captured)
+
+    def _generate(self):
+        value = self._get()
+        if value is None:
+            return self._capture(self._iterfunc())
+        return (value,) if value else ()
+
+    def __aiter__(self):
+        value = self._get()
+        if value is None:
+            return capture_lines(self._iterfunc(), self._set)
+        return aiter_lines((value,) if value else ())
+
+
+class TemplateGlobals(dict):
+    '''
+    Dictionary of template globals (see :py:attr:TemplateManager.globals),
+    counting its changes on :py:attr:version so template contexts notice
+    them (see :py:meth:TemplateContext.check_globals).
+    '''
+    version = 0
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self.version += 1
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.version += 1
+
+    def clear(self):
+        dict.clear(self)
+        self.version += 1
+
+    def pop(self, *args):
+        try:
+            return dict.pop(self, *args)
+        finally:
+            self.version += 1
+
+    def popitem(self):
+        try:
+            return dict.popitem(self)
+        finally:
+            self.version += 1
+
+    def setdefault(self, key, default=None):
+        try:
+            return dict.setdefault(self, key, default)
+        finally:
+            self.version += 1
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self.version += 1
+
+
 class TemplateContext(object):
     '''
     Template namespace boilerplate, interpret, manages context, inheritance and
@@ -683,6 +1213,7 @@ class TemplateContext(object):
     block_class = BlockGenerator
     base_class = StringGenerator
     include_class = StringGenerator
+    fragment_class = FragmentGenerator
     context_error_class = TemplateContextError
     escape_html = staticmethod(escape_html_safe)
     tostr = staticmethod(tostr_safe)
@@ -761,13 +1292,26 @@ class TemplateContext(object):
             yield descendant
             descendant = descendant.child
 
-    def __init__(self, code, manager=None):
+    def __init__(self, code, manager=None, variant="stream", encoding="utf-8",
+                 template=None):
         '''
         Create environment, evaluates given code object and set up context.
+
+        :param code: template code object
+        :param TemplateManager manager: optional template manager
+        :param str variant: code variant (see :py:meth:Template.get_variant),
+                            also used for related template contexts
+        :param str encoding: output encoding for "bytes" variant
+        :param Template template: optional template object owning code,
+                                  weakly referenced by :py:attr:template_ref
         '''
         self.manager = manager
+        self.variant = variant
+        self.template_ref = None if template is None else weakref.ref(template)
+        self.encoding = encoding if variant == "bytes" else None
 
         self.includes_cache = {}
+        self.static_includes = {} # static templates, included without context
 
         # Relations for rebase
         self.rebased = None
@@ -781,6 +1325,46 @@ class TemplateContext(object):
         self.owned_context = {}
         self.owned_namespace = {}
 
+        # Template globals are looked up on owned_namespace, containing only
+        # render variables, and then on builtins (python builtins, manager
+        # globals and context functions), which are never copied to
+        # namespaces. Manager globals are updated on builtins when changed
+        # (see check_globals).
+        self.builtins = {}
+        self.builtins.update(builtins.__dict__)
+        self.globals_state = None # manager globals and their version
+        self.globals_names = frozenset()
+        context_builtins = {
+            # Backwards-compatible ugly vars
+            "_stdout": None,
+            "_printlist": None,
+            "_rebase": None,
+            "_str": self.tostr,
+            "_escape": self.escape_html,
+            # Global functions
+            "include": self.get_include,
+            "block": self.get_block,
+            "_fragment": self.get_fragment,
+            # Namespace methods
+            "defined": self.defined,
+            "get": self.get,
+            "setdefault": self.setdefault,
+            # Updated by related TemplateContexts
+            "base": None,
+            }
+        if async_supported:
+            context_builtins.update({
+                "_aiter": aiter_lines,
+                "_await": auto_await,
+                })
+        if self.encoding:
+            context_builtins["_str"] = self.tostr_bytes
+        self.builtins.update(context_builtins)
+        self.context_builtin_names = frozenset(context_builtins)
+        if manager is not None:
+            self.check_globals()
+        self.owned_namespace["__builtins__"] = self.builtins
+
         eval(code, self.owned_namespace)
         self.owned_template = self.owned_namespace["__template__"]
 
@@ -793,55 +1377,127 @@ class TemplateContext(object):
         if self.manager is None and (self.includes or self.extends or self.rebase):
             raise self.context_error_class("TemplateContext's extends, include and rebase require a template manager.")
 
-        if self.includes:
-            self.includes_cache.update(
-                (name, self.manager.get_template(name).get_context())
-                for name in self.includes
-                )
+        for name in self.includes:
+            template = self.manager.get_template(name)
+            if template.static:
+                self.static_includes[name] = template
+            else:
+                self.includes_cache[name] = template.get_context(variant=self.variant)
 
         if self.extends:
-            self.parent = self.manager.get_template(self.extends).get_context()
+            self.parent = self.manager.get_template(self.extends).get_context(variant=self.variant)
             self.parent.child = self
 
         if self.rebase:
-            self.rebased = self.manager.get_template(self.rebase).get_context()
-            self.rebased.builtins['base'] = self.base_class(self.iter_base)
-
-        self.builtins = {}
-        self.builtins.update(builtins.__dict__)
-        self.builtins.update({
-            # Ctx reference for debugging
-            "__ctx__": self,
-            # Backwards-compatible ugly vars
-            "_stdout": None,
-            "_printlist": None,
-            "_rebase": None,
-            "_str": self.tostr,
-            "_escape": self.escape_html,
-            # Global functions
-            "include": self.get_include,
-            "block": self.get_block,
-            # Namespace methods
-            "defined": self.owned_namespace.__contains__,
-            "get": self.owned_namespace.get,
-            "setdefault": self.owned_namespace.setdefault,
-            # Updated by related TemplateContexts
-            "base": None,
-            })
+            self.rebased = self.manager.get_template(self.rebase).get_context(variant=self.variant)
+            base = self.rebased.builtins['base'] = self.base_class(self.iter_base)
+            base.encoding = self.encoding
 
         self.reset()
 
+    def check_globals(self):
+        '''
+        Update builtins with manager globals if they changed since last
+        check (see :py:class:TemplateGlobals), along with related contexts
+        (includes, extended and rebased), so globals changed after rendering
+        are seen by pooled contexts. Called when taken from pool.
+        '''
+        manager_globals = self.manager._globals
+        state = self.globals_state
+        if state is not None and state[0] is manager_globals and state[1] == manager_globals.version:
+            return
+        names = frozenset(manager_globals) - self.context_builtin_names
+        for name in self.globals_names - names:
+            if name in builtins.__dict__:
+                self.builtins[name] = builtins.__dict__[name]
+            else:
+                self.builtins.pop(name, None)
+        for name in names:
+            self.builtins[name] = manager_globals[name]
+        self.globals_names = names
+        self.globals_state = (manager_globals, manager_globals.version)
+        for context in itervalues(self.includes_cache):
+            context.check_globals()
+        if self.parent:
+            self.parent.check_globals()
+        if self.rebased:
+            self.rebased.check_globals()
+
+    def tostr_bytes(self, data):
+        '''
+        Get given data as bytes, encoding it if necessary ("bytes" variant).
+        '''
+        if isinstance(data, bytes):
+            return data
+        if isinstance(data, StringGenerator):
+            return b"".join(data)
+        return self.tostr(data).encode(self.encoding)
+
+    def defined(self, name):
+        '''
+        Get if given variable name is defined in template namespace.
+        '''
+        return name in self.owned_namespace or name in self.builtins
+
+    def get(self, name, default=None):
+        '''
+        Get variable from template namespace, or default if not defined.
+        '''
+        if name in self.owned_namespace:
+            return self.owned_namespace[name]
+        return self.builtins.get(name, default)
+
+    def setdefault(self, name, default=None):
+        '''
+        Get variable from template namespace, defining it with given default
+        value if not defined.
+        '''
+        if name in self.builtins and not name in self.owned_namespace:
+            return self.builtins[name]
+        return self.owned_namespace.setdefault(name, default)
+
     def get_include(self, name, **environ):
         '''
         Get include iterable based on :py:cvar:include_class
         '''
-        if not name in self.includes_cache:
-            self.includes_cache[name] = self.manager.get_template(name).get_context()
-        context = self.includes_cache[name]
-        context.reset(False)
-        context.update(self.context)
-        context.owned_namespace.update(environ)
-        return self.include_class(self.includes_cache[name].template)
+        if not name in self.static_includes and not name in self.includes_cache:
+            template = self.manager.get_template(name)
+            if template.static:
+                self.static_includes[name] = template
+            else:
+                self.includes_cache[name] = template.get_context(variant=self.variant)
+        if name in self.static_includes:
+            include = self.include_class(self.static_includes[name].iter_static, self.encoding)
+        else:
+            context = self.includes_cache[name]
+            context.reset(False)
+            context.update(self.context)
+            context.owned_namespace.update(environ)
+            include = self.include_class(context.template)
+        include.encoding = self.encoding
+        return include
+
+    def get_fragment(self, func, *key, **options):
+        '''
+        Get cached fragment iterable based on :py:cvar:fragment_class, using
+        template manager fragment cache (see :py:class:FragmentCache).
+
+        :param callable func: fragment function
+        :param key: hashable cache key, a tuple if many values are given
+        :param float ttl: optional time-to-live in seconds (keyword-only)
+        '''
+        if self.manager is None:
+            raise self.context_error_class("TemplateContext's cache requires a template manager.")
+        ttl = options.pop("ttl", None)
+        if options:
+            raise self.context_error_class("Unexpected cache options: %s." % ", ".join(options))
+        key = key[0] if len(key) == 1 else key
+        template = self.template_ref() if self.template_ref else None
+        if template is not None:
+            key = (template.fragment_namespace, key)
+        fragment = self.fragment_class(func, self.manager.fragment_cache, key, ttl)
+        fragment.encoding = self.encoding
+        return fragment
 
     def get_block(self, name, **environ):
         '''
@@ -859,7 +1515,9 @@ class TemplateContext(object):
             context.reset(False)
             context.owned_namespace.update(self.context)
             context.owned_namespace.update(environ)
-            return context.block_class(context.blocks[name], context.iter_super, name)
+            block = context.block_class(context.blocks[name], context.iter_super, name)
+            block.encoding = self.encoding
+            return block
 
     def iter_base(self, **environ):
         '''
@@ -888,6 +1546,19 @@ class TemplateContext(object):
             return context.blocks[name](local_block_class(context.iter_super, name, local_block_class))
         return ()
 
+    def memory_usage(self):
+        '''
+        Estimate memory used by this context, excluding shared objects as
+        builtins, code objects and related contexts.
+
+        :returns int: size in bytes
+        '''
+        seen = set(id(value) for value in itervalues(builtins.__dict__))
+        return estimate_size(
+            (self.__dict__, self.owned_namespace, self.owned_context,
+             self.builtins, self.includes_cache),
+            seen)
+
     def reset(self, full_reset=True):
         '''
         Clears and repopulate template namespace
@@ -899,8 +1570,11 @@ class TemplateContext(object):
             if self.rebased:
                 self.rebased.reset()
             self.base_context.clear()
-        self.owned_namespace.clear()
-        self.owned_namespace.update(self.builtins)
+        namespace = self.owned_namespace
+        namespace.clear()
+        namespace["__builtins__"] = self.builtins
+        # Ctx reference for debugging
+        namespace["__ctx__"] = self
 
     def update(self, v):
         '''
@@ -909,172 +1583,2741 @@ class TemplateContext(object):
         self.context.update(v)
         self.namespace.update(v)
 
+    def close(self):
+        '''
+        Break reference cycles of this context (namespace functions, bound
+        methods on builtins and related contexts) so it is freed as soon as
+        discarded, instead of waiting for the garbage collector. Related
+        contexts are returned to their pools. Context cannot be used anymore.
+        '''
+        related = list(itervalues(self.includes_cache))
+        if self.parent:
+            self.parent.child = None
+            related.append(self.parent)
+        if self.rebased:
+            self.rebased.builtins["base"] = None
+            related.append(self.rebased)
+        self.includes_cache.clear()
+        self.static_includes.clear()
+        self.parent = self.child = self.rebased = None
+        self.owned_namespace.clear()
+        self.owned_context.clear()
+        self.builtins.clear()
+        self.owned_template = self.blocks = None
+        for context in related:
+            template = context.template_ref() if context.template_ref else None
+            if template is None:
+                context.close()
+            else:
+                template.release_context(context)
+
 
-class Template(object):
+class TemplateContextFreeList(list):
     '''
-    Template class using a template context-function pool for thread-safety.
+    Per-thread list of idle contexts, weak-referenceable.
     '''
+    __slots__ = ('__weakref__',)
 
-    translate_class = CodeTranslator
-    template_context_class = TemplateContext
-    runtime_error_class = TemplateRuntimeError
-    lineno_annotation_re = re.compile("^.*#lineno:(?P<lineno>\d+)#$")
 
-    @property
-    def pycode(self):
-        return zlib.decompress(self._pycode).decode("utf-8")
+class TemplateContextPool(object):
+    '''
+    Thread-safe pool of idle template contexts, which are expensive to create.
 
-    def __init__(self, code, filename=None, manager=None):
-        self.filename = filename
-        self.manager = manager
-        self.code = code
+    Idle contexts are kept in a shared deque bounded by :py:attr:maxsize, and
+    optionally in per-thread lists of :py:attr:thread_cache size. Acquiring
+    and releasing contexts is lock-free, relying on atomic deque pop and
+    append, so under contention counters could be slightly inaccurate and
+    the shared deque could briefly exceed :py:attr:maxsize.
+    '''
+    free_list_class = TemplateContextFreeList
+
+    def __init__(self, factory, maxsize=None, thread_cache=0):
+        '''
+        :param callable factory: function returning new template contexts
+        :param int maxsize: maximum number of idle contexts on shared list,
+                            unbounded if None
+        :param int thread_cache: maximum number of idle contexts kept by
+                                 every thread, disabled if 0
+        '''
+        self.factory = factory
+        self.maxsize = maxsize
+        self.thread_cache = thread_cache
+        self.hits = 0
+        self.misses = 0
+        self.created = 0
+        self.discarded = 0
+        self._free = collections.deque()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._local_lists = weakref.WeakValueDictionary()
+        self._contexts = weakref.WeakSet()
+
+    def __len__(self):
+        '''
+        Number of idle contexts, on both shared and thread-local lists.
+        '''
+        with self._lock:
+            local_lists = list(self._local_lists.values())
+        return len(self._free) + sum(len(free) for free in local_lists)
 
-        pycode = "".join(self.translate_class().translate_code(code))
+    @property
+    def in_use(self):
+        '''
+        Whether any context created by this pool is alive outside the pool.
+        '''
+        return len(self._contexts) > len(self)
 
-        self._pycode = zlib.compress(pycode.encode("utf-8"))
-        self._pycompiled = compile(pycode, filename or "<template>", "exec")
-        self._pool = []
+    def _get_local_list(self):
+        free = getattr(self._local, "free", None)
+        if free is None:
+            free = self._local.free = self.free_list_class()
+            with self._lock:
+                self._local_lists[id(free)] = free
+        return free
 
-    def get_context(self, env=None):
+    def create(self):
         '''
-        Generate or retrieve from pool a template context object for
-        thread-safety usage.
+        Create a new context using :py:attr:factory.
 
-        :param dict env: environment dictionary
-        :returns TemplateContext: template context object
+        :returns TemplateContext: new template context
         '''
-        if self._pool:
-            context = self._pool.pop()
-        else:
-            context = self.template_context_class(self._pycompiled, self.manager)
-        if env:
-            context.update(env)
+        context = self.factory()
+        with self._lock:
+            self.created += 1
+            self._contexts.add(context)
         return context
 
-    def render(self, env=None):
+    def acquire(self):
         '''
-        Renders template updating global namespace with env dict-like object.
+        Get idle context from pool, or create a new one.
 
-        :param dict env: environment dictionary
-        :yields str: template lines as string
-        :raise TemplateRuntimeError: on any template exception.
+        :returns TemplateContext: template context
         '''
-        context = self.get_context(env)
+        if self.thread_cache:
+            free = self._get_local_list()
+            if free:
+                self.hits += 1
+                return free.pop()
         try:
-            # Yielding here for proper error handling
-            for line in context.template():
-                yield line
-        except BaseException as e:
-            type, value, traceback = sys.exc_info()
-
-            # Get exception template context
-            tb_next = traceback
-            while tb_next.tb_next:
-                tb_next = tb_next.tb_next
-            tb_ctx = tb_next.tb_frame.f_globals.get('__ctx__')
-            if tb_ctx is None:
-                raise
-
-            # Get related template object
-            template = None
-            if tb_ctx is context:
-                template = self
-            elif self.manager:
-                # Search for reference recursively
-                queue = [context]
-                candidates = {}
-                while queue:
-                    # Inspect reachable contexts
-                    ctx = queue.pop()
-                    candidates.clear()
-                    if ctx.rebase:
-                        candidates[ctx.rebase] = ctx.rebased
-                    if ctx.extends:
-                        candidates[ctx.extends] = ctx.parent
-                    candidates.update(ctx.includes_cache)
-                    # Check if one of candidates is reference
-                    for name, cctx in iteritems(candidates):
-                        if cctx is tb_ctx:
-                            template = self.manager.get_template(name)
-                            break
-                        queue.append(cctx)
-                    else:
-                        continue
-                    break
+            context = self._free.pop()
+        except IndexError:
+            self.misses += 1
+            return self.create()
+        self.hits += 1
+        return context
 
-            # Generate exception
-            if template:
-                pycode = template.pycode.splitlines()
-                pycode_lineno = tb_next.tb_lineno-1
-                code_lineno = None
-
-                # Search template line looking at annotations
-                for lineno in xrange(pycode_lineno, -1, -1):
-                    match = self.lineno_annotation_re.match(pycode[lineno])
-                    if match:
-                        code_lineno = int(match.groupdict()['lineno'], 10)
-                        break
-                else:
-                    # should not happen
-                    raise self.runtime_error_class(value,
-                        pycode=pycode, pylineno=pycode_lineno
-                        )
-                raise self.runtime_error_class(value,
-                    code=template.code.splitlines(), lineno=code_lineno,
-                    pycode=pycode, pylineno=pycode_lineno
-                    )
-            raise self.runtime_error_class(value)
-        finally:
-            context.reset()
-            self._pool.append(context)
+    def release(self, context):
+        '''
+        Return given context to pool, discarding it if pool is full.
 
+        :param TemplateContext context: template context, already reset
+        '''
+        if self.thread_cache:
+            free = self._get_local_list()
+            if len(free) < self.thread_cache:
+                free.append(context)
+                return
+        if self.maxsize is None or len(self._free) < self.maxsize:
+            self._free.append(context)
+            return
+        self.discarded += 1
+        context.close()
+
+    def prewarm(self, number):
+        '''
+        Create contexts up to given number of idle contexts on shared list,
+        bounded by :py:attr:maxsize.
 
-class BufferingTemplate(Template):
-    '''
-    Template which yields buffered chunks of :py:cvar:buffersize size.
+        :param int number: desired number of idle contexts
+        :returns int: number of created contexts
+        '''
+        if self.maxsize is not None:
+            number = min(number, self.maxsize)
+        created = 0
+        while len(self._free) < number:
+            self._free.append(self.create())
+            created += 1
+        return created
+
+    def peek(self):
+        '''
+        Get any idle context without removing it from pool.
 
-    You may want to inherit from this class in order to define a different
-    value or, alternatively, change it once object is initialized.
-    '''
-    buffersize = 4096
+        :returns TemplateContext: idle context or None
+        '''
+        with self._lock:
+            local_lists = list(self._local_lists.values())
+        for free in [self._free] + local_lists:
+            try:
+                return free[-1]
+            except IndexError:
+                pass
+        return None
 
-    def render(self, env=None):
+    def clear(self):
         '''
-        Renders template updating global namespace with env dict-like object.
-        Additionaly, this function ensures all-but-last yielded strings have
-        the same length defined in :py:cvar:buffersize.
+        Remove all idle contexts from shared list and current thread's list,
+        closing them (see :py:meth:TemplateContext.close).
+        '''
+        contexts = []
+        while True:
+            try:
+                contexts.append(self._free.pop())
+            except IndexError:
+                break
+        free = getattr(self._local, "free", None)
+        if free:
+            contexts.extend(free)
+            del free[:]
+        for context in contexts:
+            context.close()
+
+    def stats(self):
+        '''
+        Get pool counters.
 
-        :param dict env: environment dictionary
-        :yields str: template lines as string
+        :returns dict: idle, hits, misses, created and discarded counters.
         '''
-        buffsize = 0
-        cache = []
-        for line in Template.render(self, env):
-            cache.append(line)
-            buffsize += len(line)
-            # Buffering
-            while buffsize > self.buffersize:
-                data = "".join(cache)
-                yield data[:self.buffersize]
-                data = data[self.buffersize:]
-                cache[:] = (data,) if data else ()
-                buffsize = len(data)
-        if cache:
-            yield "".join(cache)
+        return {
+            "idle": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "created": self.created,
+            "discarded": self.discarded,
+            }
 
 
-class TemplateManager(object):
+class TemplateStats(object):
     '''
-    Template manager is responsible of Template loading and caching, and should
-    be instanced once for your application.
+    Runtime counters of a template: compilations, renders, failed renders,
+    render duration histogram and output size (characters, or bytes if
+    rendering bytes).
+
+    Render duration is measured from first to last line, so it includes time
+    spent by consumer between lines.
+
+    Hooks, shared with :py:class:TemplateManagerStats, are called with event
+    name ("compile" or "render"), template and event data dictionary.
+
+    Counters are not synchronized so, under contention, they could be
+    slightly inaccurate.
+    '''
+    duration_buckets = (.0001, .0005, .001, .005, .01, .05, .1, .5, 1.)
+
+    def __init__(self, hooks=None):
+        '''
+        :param list hooks: optional list of hook functions
+        '''
+        self.hooks = [] if hooks is None else hooks
+        self.compilations = 0
+        self.compile_time = 0.
+        self.renders = 0
+        self.failures = 0
+        self.render_time = 0.
+        self.output_size = 0
+        self.durations = [0] * (len(self.duration_buckets) + 1)
+
+    def add_compilation(self, template, seconds, variant="stream"):
+        '''
+        Record a template compilation.
+
+        :param Template template: template object
+        :param float seconds: translation and compilation time
+        :param str variant: code variant (see :py:meth:Template.get_variant)
+        '''
+        self.compilations += 1
+        self.compile_time += seconds
+        for hook in self.hooks:
+            hook("compile", template, {"time": seconds, "variant": variant})
+
+    def add_render(self, template, seconds, size, failed=False):
+        '''
+        Record a template render.
+
+        :param Template template: template object
+        :param float seconds: render duration
+        :param int size: output size
+        :param bool failed: whether render raised an exception
+        '''
+        self.renders += 1
+        self.failures += failed
+        self.render_time += seconds
+        self.output_size += size
+        self.durations[bisect.bisect_left(self.duration_buckets, seconds)] += 1
+        for hook in self.hooks:
+            hook("render", template, {
+                "time": seconds, "size": size, "failed": failed})
+
+    def snapshot(self):
+        '''
+        Get counters.
+
+        :returns dict: compilation and render counters, with durations as a
+                       list of (upper bound in seconds, count) tuples, last
+                       one without bound (None)
+        '''
+        return {
+            "compilations": self.compilations,
+            "compile_time": self.compile_time,
+            "renders": self.renders,
+            "failures": self.failures,
+            "render_time": self.render_time,
+            "output_size": self.output_size,
+            "durations": list(zip(self.duration_buckets + (None,),
+                                  self.durations)),
+            }
+
+
+class TemplateManagerStats(object):
+    '''
+    Runtime counters of a template manager: template cache hits, and misses
+    with their loading time (file lookup, reading and compilation).
+
+    Hooks, shared with every :py:class:TemplateStats of manager templates,
+    are called with event name ("load", "compile" or "render"), template and
+    event data dictionary.
+
+    Counters are not synchronized so, under contention, they could be
+    slightly inaccurate.
+    '''
+    def __init__(self):
+        self.hooks = []
+        self.hits = 0
+        self.misses = 0
+        self.load_time = 0.
+
+    def add_load(self, name, template, seconds):
+        '''
+        Record a template cache miss.
+
+        :param str name: template name
+        :param Template template: loaded template object
+        :param float seconds: loading time
+        '''
+        self.misses += 1
+        self.load_time += seconds
+        for hook in self.hooks:
+            hook("load", template, {"name": name, "time": seconds})
+
+    def snapshot(self):
+        '''
+        Get counters.
+
+        :returns dict: hits, misses and load_time
+        '''
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "load_time": self.load_time,
+            }
+
+
+class FragmentCache(object):
+    '''
+    Thread-safe in-process cache for template fragments (see cache token),
+    with least-recently-used eviction and optional per-fragment expiration.
+    Also used for render memoization (see :py:meth:Template.set_memoize).
+
+    Alternative backends (shared between processes, for instance) must
+    implement :py:meth:get, :py:meth:set, :py:meth:delete and
+    :py:meth:clear methods.
+    '''
+    def __init__(self, maxsize=1024):
+        '''
+        :param int maxsize: maximum number of fragments, unbounded if None
+        '''
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict() # key: (value, expiration)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        '''
+        Get cached fragment.
+
+        :param key: hashable cache key
+        :returns str: cached fragment output or None if not cached or expired
+        '''
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None:
+                return None
+            if item[1] is not None and item[1] <= time.time():
+                return None
+            self._data[key] = item # move to most recently used
+            return item[0]
+
+    def set(self, key, value, ttl=None):
+        '''
+        Store fragment, evicting least recently used ones if necessary.
+
+        :param key: hashable cache key
+        :param str value: fragment output
+        :param float ttl: optional time-to-live in seconds, fragment is not
+                          stored if zero or negative
+        '''
+        if ttl is not None and ttl <= 0:
+            self.delete(key)
+            return
+        expiration = None if ttl is None else time.time() + ttl
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expiration)
+            if self.maxsize is not None:
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(False)
+
+    def delete(self, key):
+        '''
+        Remove fragment from cache, if any.
+
+        :param key: hashable cache key
+        '''
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        '''
+        Remove all fragments.
+        '''
+        with self._lock:
+            self._data.clear()
+
+
+class Template(object):
+    '''
+    Template class using a template context-function pool for thread-safety.
+    '''
+
+    translate_class = CodeTranslator
+    template_context_class = TemplateContext
+    pool_class = TemplateContextPool
+    pool_maxsize = 32 # maximum number of idle contexts
+    pool_thread_cache = 0 # idle contexts kept per thread, see TemplateContextPool
+    runtime_error_class = TemplateRuntimeError
+    static_error_class = TemplateValueError
+    output_encoding = None # bytes are rendered if set, see TemplateManager
+    memoize_cache_class = FragmentCache # see set_memoize
+    stats_class = TemplateStats
+    instrument = True # templates with manager follow TemplateManager.stats
+    memoize_maxsize = 128 # default maximum number of memoized outputs
+    lineno_annotation_re = re.compile(r"^.*#lineno:(?P<lineno>\d+)#$")
+
+    @property
+    def pycode(self):
+        return self.get_pycode()
+
+    def get_pycode(self, variant="stream"):
+        '''
+        Get generated python code of given variant (see :py:meth:get_variant).
+
+        Generated code is not kept after compilation, but translated again
+        when requested.
+
+        :param str variant: code variant
+        :returns str: python code
+        '''
+        pycode = self._pycode if variant == "stream" else self.get_variant(variant)[0]
+        if pycode is not None:
+            # compressed code, from compiled states of previous versions
+            return zlib.decompress(pycode).decode("utf-8")
+        translator = (
+            self.translate_class() if variant == "stream" else
+            self.translate_class(variant, encoding=self.encoding)
+            )
+        return "".join(translator.translate_code(self.code, self.chunk_breaks))
+
+    def __init__(self, code, filename=None, manager=None, compiled_state=None,
+                 line_origins=None):
+        '''
+        :param str code: template code
+        :param str filename: optional template path
+        :param TemplateManager manager: optional template manager
+        :param tuple compiled_state: optional precompiled state, as given by
+                                     :py:meth:get_compiled_state
+        :param list line_origins: optional (template name, line number)
+                                  tuples of every code line, for linked
+                                  templates (see :py:class:TemplateLinker)
+        '''
+        self.filename = filename
+        self.manager = manager
+        self.code = code
+        self.line_origins = line_origins
+        # string chunks are finished where line origins are not contiguous,
+        # so errors on variables are located on their own template
+        self.chunk_breaks = frozenset(
+            lineno
+            for lineno, (previous, origin) in enumerate(
+                zip(line_origins, line_origins[1:]), 2)
+            if origin != (previous[0], previous[1] + 1)
+            ) if line_origins else frozenset()
+        if getattr(manager, "output_encoding", None):
+            self.output_encoding = manager.output_encoding
+        self._pool = self.pool_class(
+            self.create_context, self.pool_maxsize, self.pool_thread_cache)
+        self._pools = {"stream": self._pool}
+        self._variants = {}
+        self._line_maps = {} # see get_line_map
+        self._memory_usage = None
+        self._variants_memory_usage = (0, 0, 0) # variants, line maps, size
+        self._context_memory_usage = None
+        self._static_output = None
+        self._static_encoded = {}
+        self._fragment_namespace = None
+        self.flattened = None # see TemplateManager.get_flattened_template
+        self.linked_members = () # see TemplateLinker
+        self._memoize = None # see set_memoize
+        self.memoize_hits = 0
+        self.memoize_misses = 0
+        self.memoize_bypasses = 0
+        if manager is None:
+            self.stats = self.stats_class() if self.instrument else None
+        else:
+            manager_stats = getattr(manager, "stats", None)
+            self.stats = (
+                None if manager_stats is None else
+                self.stats_class(manager_stats.hooks)
+                )
+
+        cache = getattr(manager, "bytecode_cache", None)
+        if compiled_state is not None:
+            self.set_compiled_state(compiled_state)
+        elif cache is None:
+            self.compile()
+        elif not cache.load(self):
+            self.compile()
+            cache.dump(self)
+
+    def compile(self):
+        '''
+        Translate template code to python and compile it, setting both
+        generated code and template metadata (blocks, includes, extends and
+        rebase).
+        '''
+        start = timer()
+        translator = self.translate_class()
+        pycode = "".join(translator.translate_code(self.code, self.chunk_breaks))
+
+        self._pycode = None # see get_pycode
+        self._pycompiled = compile(pycode, self.filename or "<template>", "exec")
+        self._line_maps = {"stream": self.build_line_map(pycode)}
+        self.blocks = tuple(translator.block_content)
+        self.includes = tuple(translator.includes)
+        self.extends = translator.extends
+        self.rebase = translator.rebase
+        self.static = translator.static
+        if self.stats is not None:
+            self.stats.add_compilation(self, timer() - start)
+
+    @property
+    def dependencies(self):
+        '''
+        Names of templates this one statically depends on (includes, extends
+        and rebase).
+        '''
+        return self.includes + tuple(
+            name for name in (self.extends, self.rebase) if name)
+
+    def get_compiled_state(self):
+        '''
+        Get marshallable compilation state, see :py:meth:set_compiled_state.
+
+        :returns tuple: python code placeholder (see :py:meth:get_pycode),
+                        code object and metadata.
+        '''
+        return (self._pycode, self._pycompiled, self.blocks, self.includes,
+                self.extends, self.rebase, self.static)
+
+    def set_compiled_state(self, state):
+        '''
+        Restore compilation state, as given by :py:meth:get_compiled_state,
+        skipping both translation and compilation.
+
+        :param tuple state: python code placeholder, code object and metadata.
+        '''
+        (self._pycode, self._pycompiled, self.blocks, self.includes,
+         self.extends, self.rebase, self.static) = state
+        self._line_maps = {} # built on first use, see get_line_map
+
+    @classmethod
+    def from_module(cls, name, manager=None):
+        '''
+        Create template from a module generated by
+        :py:meth:TemplateManager.compile_package, without translating nor
+        compiling template code (python import system handles bytecode).
+
+        Modules generated by another stpl2 version or translator (see
+        :py:meth:get_build_signature) are compiled again from their source.
+
+        :param str name: absolute module name
+        :param TemplateManager manager: optional template manager
+        :returns Template: template object
+        '''
+        pycompiled = get_module_code(name)
+        namespace = {}
+        eval(pycompiled, namespace)
+        if namespace.get("__build__") != cls.get_build_signature():
+            return cls(namespace["__source__"], namespace["__filename__"], manager)
+        state = (namespace["__pycode__"], pycompiled,
+                 tuple(namespace["__blocks__"]),
+                 tuple(namespace["__includes__"]),
+                 namespace["__extends__"], namespace["__rebase__"],
+                 namespace["__static__"])
+        return cls(namespace["__source__"], namespace["__filename__"],
+                   manager, state)
+
+    def get_module_source(self):
+        '''
+        Get python module code for this template, as loaded by
+        :py:meth:from_module. Template metadata is appended after generated
+        code, so line numbers are kept.
+
+        :returns str: python code
+        '''
+        return (
+            "%s__source__ = %r\n__filename__ = %r\n__pycode__ = %r\n"
+            "__static__ = %r\n__build__ = %r\n"
+            ) % (self.pycode, self.code, self.filename, self._pycode,
+                 self.static, self.get_build_signature())
+
+    @classmethod
+    def get_build_signature(cls):
+        '''
+        Get stpl2 version and translator generating code of this template
+        class, recorded by :py:meth:TemplateManager.compile_package.
+
+        :returns str: build signature
+        '''
+        from . import __version__
+        translate_class = cls.translate_class
+        return "stpl2 %s %s.%s" % (
+            __version__, translate_class.__module__, translate_class.__name__)
+
+    def get_variant(self, variant):
+        '''
+        Get alternative code variant, translated (using given variant as
+        :py:cvar:translate_class mode) and compiled on first use.
+
+        "string" variants whose functions would be generators (because of
+        user code yielding values) are not supported.
+
+        :param str variant: code variant, "string" for code returning lists,
+                            "async" for asynchronous generators, or "bytes"
+                            for code yielding bytes (see :py:attr:encoding)
+        :returns tuple: python code placeholder (see :py:meth:get_pycode) and
+                        code object, or None if variant is not supported
+        '''
+        if not variant in self._variants:
+            start = timer()
+            translator = self.translate_class(variant, encoding=self.encoding)
+            pycode = "".join(translator.translate_code(self.code, self.chunk_breaks))
+            try:
+                pycompiled = compile(pycode, self.filename or "<template>", "exec")
+            except SyntaxError:
+                # python 2 rejects returning values from generators
+                if variant != "string":
+                    raise
+                pycompiled = None
+            generators = variant == "string" and (pycompiled is None or [
+                const for const in pycompiled.co_consts
+                if isinstance(const, types.CodeType) and
+                const.co_flags & CO_GENERATOR
+                ])
+            self._variants[variant] = None if generators else (None, pycompiled)
+            if not generators:
+                self._line_maps[variant] = self.build_line_map(pycode)
+            if self.stats is not None:
+                self.stats.add_compilation(self, timer() - start, variant)
+        return self._variants[variant]
+
+    @classmethod
+    def build_line_map(cls, pycode):
+        '''
+        Build map of generated python lines to template lines, from line
+        annotations (see :py:cvar:lineno_annotation_re). Python lines without
+        annotation come from the closest annotated line above them.
+
+        :param str pycode: generated python code
+        :returns array: template line number by python line index, 0 if
+                        unknown
+        '''
+        line_map = array.array("I")
+        lineno = 0
+        for line in pycode.splitlines():
+            if line.endswith("#"):
+                match = cls.lineno_annotation_re.match(line)
+                if match:
+                    lineno = int(match.group("lineno"), 10)
+            line_map.append(lineno)
+        return line_map
+
+    def get_line_map(self, variant="stream"):
+        '''
+        Get map of generated python lines to template lines of given code
+        variant (see :py:meth:build_line_map), built on compilation or on
+        first use.
+
+        :param str variant: code variant
+        :returns array: template line number by python line index, 0 if
+                        unknown
+        '''
+        line_map = self._line_maps.get(variant)
+        if line_map is None:
+            line_map = self._line_maps[variant] = self.build_line_map(
+                self.get_pycode(variant))
+        return line_map
+
+    def get_pool(self, variant="stream"):
+        '''
+        Get context pool for given code variant, falling back to default
+        "stream" variant if not supported (see :py:meth:get_variant).
+
+        :param str variant: code variant
+        :returns TemplateContextPool: context pool
+        '''
+        pool = self._pools.get(variant)
+        if pool is None:
+            if self.get_variant(variant) is None:
+                pool = self._pool
+            else:
+                pool = self.pool_class(
+                    functools.partial(self.create_context, variant),
+                    self.pool_maxsize, self.pool_thread_cache)
+            self._pools[variant] = pool
+        return pool
+
+    def get_context(self, env=None, variant="stream", pool=None):
+        '''
+        Generate or retrieve from pool a template context object for
+        thread-safety usage.
+
+        :param dict env: environment dictionary
+        :param str variant: code variant (see :py:meth:get_variant)
+        :param TemplateContextPool pool: optional pool of given variant, as
+                                         given by :py:meth:get_pool
+        :returns TemplateContext: template context object
+        '''
+        if pool is None:
+            pool = self.get_pool(variant)
+        context = pool.acquire()
+        if context.manager is not None:
+            context.check_globals()
+        if env:
+            context.update(env)
+        return context
+
+    def release_context(self, context, pool=None):
+        '''
+        Reset given context and return it to its pool.
+
+        :param TemplateContext context: template context object
+        :param TemplateContextPool pool: optional pool context was taken
+                                         from (see :py:meth:get_context)
+        '''
+        context.reset()
+        if pool is None:
+            pool = self.get_pool(context.variant)
+        pool.release(context)
+
+    def create_context(self, variant="stream"):
+        '''
+        Create a new template context, bypassing the pool.
+
+        :param str variant: code variant (see :py:meth:get_variant)
+        :returns TemplateContext: template context object
+        '''
+        pycompiled = (
+            self._pycompiled if variant == "stream" else
+            self.get_variant(variant)[1]
+            )
+        return self.template_context_class(
+            pycompiled, self.manager, variant, self.encoding, self)
+
+    def prewarm(self, number):
+        '''
+        Create idle contexts of :py:attr:output_variant up front, so first
+        renders do not pay context creation (see
+        :py:meth:TemplateContextPool.prewarm).
+
+        :param int number: desired number of idle contexts
+        :returns int: number of created contexts
+        '''
+        return self.get_pool(self.output_variant).prewarm(number)
+
+    def pool_stats(self):
+        '''
+        Get counters of :py:attr:output_variant context pool, used by
+        :py:meth:render (see :py:meth:TemplateContextPool.stats).
+
+        :returns dict: counters
+        '''
+        return self.get_pool(self.output_variant).stats()
+
+    def get_stats(self):
+        '''
+        Get snapshot of template counters: :py:attr:stats if enabled (see
+        :py:meth:TemplateStats.snapshot), context pools by code variant (see
+        :py:meth:TemplateContextPool.stats) and memoization if enabled (see
+        :py:meth:memoize_stats).
+
+        :returns dict: counters
+        '''
+        stats = {} if self.stats is None else self.stats.snapshot()
+        stats["pools"] = dict(
+            (variant, pool.stats()) for variant, pool in self._pools.items())
+        if self._memoize is not None:
+            stats["memoize"] = self.memoize_stats()
+        return stats
+
+    def set_memoize(self, enabled=True, ttl=None, keys=None, maxsize=None):
+        '''
+        Enable or disable :py:meth:render output memoization, so rendering
+        again with an equivalent environment yields stored output without
+        running template code. Enabling it again discards stored output.
+
+        Environments are fingerprinted by their items, or only by given keys
+        if any, which must be hashable: renders with unhashable environments
+        are not memoized (see :py:meth:get_memoize_key). Template output must
+        depend only on fingerprinted variables.
+
+        :param bool enabled: False to disable memoization
+        :param float ttl: optional time-to-live of stored output in seconds
+        :param keys: optional iterable of environment keys output depends on
+        :param int maxsize: maximum number of stored outputs, defaults to
+                            :py:cvar:memoize_maxsize
+        '''
+        self._memoize = (
+            self.memoize_cache_class(
+                self.memoize_maxsize if maxsize is None else maxsize),
+            ttl,
+            None if keys is None else tuple(keys),
+            ) if enabled else None
+
+    def get_memoize_key(self, env=None):
+        '''
+        Get memoization fingerprint of given environment (see
+        :py:meth:set_memoize).
+
+        :param dict env: environment dictionary
+        :returns: hashable key, or None if environment is not hashable
+        '''
+        keys = self._memoize[2] if self._memoize else None
+        # values are keyed along their type, as 1, 1.0 and True are equal
+        # but rendered differently
+        if not env:
+            items = ()
+        elif keys is None:
+            items = [(key, type(value), value) for key, value in env.items()]
+        else:
+            items = [(key, type(env[key]), env[key]) for key in keys if key in env]
+        try:
+            key = frozenset(items)
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def memoize_stats(self):
+        '''
+        Get :py:meth:render memoization counters (see :py:meth:set_memoize).
+
+        Counters are not synchronized, so they could be slightly off under
+        heavy concurrency.
+
+        :returns dict: enabled flag, number of stored outputs, hits, misses
+                       and bypasses (unhashable environments)
+        '''
+        return {
+            "enabled": self._memoize is not None,
+            "size": len(self._memoize[0]) if self._memoize else 0,
+            "hits": self.memoize_hits,
+            "misses": self.memoize_misses,
+            "bypasses": self.memoize_bypasses,
+            }
+
+    def get_code_location(self, lineno):
+        '''
+        Get template code and line number where given line of this template
+        code comes from, which differ for linked templates (see
+        :py:class:TemplateLinker).
+
+        :param int lineno: line number
+        :returns tuple: template code and line number
+        '''
+        if self.line_origins:
+            name, lineno = self.line_origins[lineno - 1]
+            return self.manager.get_template(name).code, lineno
+        return self.code, lineno
+
+    @property
+    def fragment_namespace(self):
+        '''
+        Namespace of fragment cache keys of this template (see cache token):
+        its filename or, if it has none, a digest of its code.
+        '''
+        if self._fragment_namespace is None:
+            code = self.code
+            self._fragment_namespace = self.filename or hashlib.sha1(
+                code if isinstance(code, bytes) else code.encode("utf-8")
+                ).hexdigest()
+        return self._fragment_namespace
+
+    @property
+    def static_output(self):
+        '''
+        Output of static templates (see :py:attr:static), rendered only once.
+        '''
+        if self._static_output is None:
+            self._static_output = "".join(self.create_context().template())
+        return self._static_output
+
+    def iter_static(self, encoding=None):
+        '''
+        Get iterator over static template output (see :py:attr:static).
+
+        :param str encoding: optional encoding for getting output as bytes
+        :returns iterator: iterator over output, as a single chunk
+        '''
+        output = self.static_output
+        if output and encoding:
+            if not encoding in self._static_encoded:
+                self._static_encoded[encoding] = output.encode(encoding)
+            output = self._static_encoded[encoding]
+        return iter((output,) if output else ())
+
+    @property
+    def encoding(self):
+        '''
+        Encoding used by "bytes" code variant, :py:cvar:output_encoding
+        defaulting to UTF-8.
+        '''
+        return self.output_encoding or "utf-8"
+
+    @property
+    def output_variant(self):
+        '''
+        Code variant used by :py:meth:render, "bytes" if
+        :py:cvar:output_encoding is set, "stream" otherwise.
+        '''
+        return "bytes" if self.output_encoding else "stream"
+
+    def get_static_file(self, directory=None):
+        '''
+        Get path of a file containing static template output (see
+        :py:attr:static), UTF-8 encoded, suitable for wsgi.file_wrapper.
+
+        File is written once, atomically, at given directory, defaulting to
+        manager bytecode cache directory or system temporary directory.
+
+        :param str directory: optional directory
+        :returns str: file path
+        '''
+        if not self.static:
+            raise self.static_error_class("Template output is not static.")
+        data = self.static_output.encode("utf-8")
+        if directory is None:
+            cache = getattr(self.manager, "bytecode_cache", None)
+            directory = cache.directory if cache else tempfile.gettempdir()
+        path = os.path.join(
+            directory, "stpl2-%s.static" % hashlib.sha1(data).hexdigest())
+        if not os.path.isfile(path):
+            write_file_atomic(path, data)
+        return path
+
+    @property
+    def in_use(self):
+        '''
+        Whether any context of this template is alive outside its pool, being
+        rendered or referenced by other template contexts (includes, extends
+        and rebase).
+        '''
+        return any(pool.in_use for pool in set(self._pools.values()))
+
+    def memory_usage(self):
+        '''
+        Estimate memory used by this template, including source, generated
+        code, code object and pooled contexts.
+
+        :returns int: size in bytes
+        '''
+        if self._memory_usage is None:
+            self._memory_usage = estimate_size(
+                (self.code, self.filename, self._pycode, self._pycompiled))
+        if self._context_memory_usage is None:
+            context = self.get_pool(self.output_variant).peek()
+            if context is not None:
+                self._context_memory_usage = context.memory_usage()
+        variants, line_maps, variants_size = self._variants_memory_usage
+        if variants != len(self._variants) or line_maps != len(self._line_maps):
+            variants_size = estimate_size((self._variants, self._line_maps))
+            self._variants_memory_usage = (
+                len(self._variants), len(self._line_maps), variants_size)
+        pools = set(self._pools.values())
+        return (
+            self._memory_usage + variants_size +
+            sum(len(pool) for pool in pools) * (self._context_memory_usage or 0)
+            )
+
+    def render(self, env=None):
+        '''
+        Renders template updating global namespace with env dict-like object,
+        recording render on :py:attr:stats if enabled.
+
+        :param dict env: environment dictionary
+        :returns: iterator of template lines as string, or as bytes if
+                  :py:cvar:output_encoding is set
+        :raise TemplateRuntimeError: on any template exception.
+        '''
+        return self.iter_render(env, self.stats)
+
+    def iter_render(self, env=None, stats=None):
+        '''
+        Renders template updating global namespace with env dict-like object,
+        recording it on given stats, if any, once exhausted or closed (see
+        :py:meth:render).
+
+        Render is measured by this generator itself, as wrapping it would add
+        a generator resume to every line.
+
+        :param dict env: environment dictionary
+        :param TemplateStats stats: optional stats recording this render
+        :yields str: template lines as string, or as bytes if
+                     :py:cvar:output_encoding is set
+        :raise TemplateRuntimeError: on any template exception.
+        '''
+        start = None if stats is None else timer()
+        size = 0
+        failed = False
+        try:
+            if self.static:
+                for line in self.iter_static(self.output_encoding):
+                    size += len(line)
+                    yield line
+                return
+            key = None
+            memoize = self._memoize
+            if memoize is not None:
+                key = self.get_memoize_key(env)
+                if key is None:
+                    self.memoize_bypasses += 1
+                else:
+                    lines = memoize[0].get(key)
+                    if lines is not None:
+                        self.memoize_hits += 1
+                        for line in lines:
+                            size += len(line)
+                            yield line
+                        return
+                    self.memoize_misses += 1
+            variant = self.output_variant
+            pool = self.get_pool(variant)
+            context = self.get_context(env, variant, pool)
+            try:
+                # Yielding here for proper error handling
+                if key is not None:
+                    # Output is stored only when fully rendered
+                    lines = []
+                    for line in context.template():
+                        size += len(line)
+                        lines.append(line)
+                        yield line
+                    memoize[0].set(key, tuple(lines), memoize[1])
+                elif start is None:
+                    for line in context.template():
+                        yield line
+                else:
+                    for line in context.template():
+                        size += len(line)
+                        yield line
+            except BaseException:
+                error = self.get_runtime_error(context)
+                if error is None:
+                    raise
+                raise error
+            finally:
+                self.release_context(context, pool)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            if start is not None:
+                stats.add_render(self, timer() - start, size, failed)
+
+    def render_string(self, env=None):
+        '''
+        Renders template updating global namespace with env dict-like object,
+        returning whole output as string. Uses "string" code variant (see
+        :py:meth:get_variant) which appends to lists instead of yielding.
+
+        :param dict env: environment dictionary
+        :returns str: rendered template
+        :raise TemplateRuntimeError: on any template exception.
+        '''
+        start = None if self.stats is None else timer()
+        if self.static:
+            output = self.static_output
+        else:
+            pool = self.get_pool("string")
+            context = self.get_context(env, "string", pool)
+            try:
+                output = "".join(context.template())
+            except BaseException:
+                if start is not None:
+                    self.stats.add_render(self, timer() - start, 0, True)
+                error = self.get_runtime_error(context)
+                if error is None:
+                    raise
+                raise error
+            finally:
+                self.release_context(context, pool)
+        if start is not None:
+            self.stats.add_render(self, timer() - start, len(output))
+        return output
+
+    def render_async(self, env=None):
+        '''
+        Renders template asynchronously updating global namespace with env
+        dict-like object. Uses "async" code variant (see :py:meth:get_variant)
+        where variables can be awaitables, which will be awaited.
+
+        New contexts, which load related templates, are created using event
+        loop's default executor.
+
+        Requires python 3.6 or newer.
+
+        :param dict env: environment dictionary
+        :returns: asynchronous iterator of strings
+        :raise TemplateRuntimeError: on any template exception.
+        '''
+        return render_template(self, env, self.stats)
+
+    def get_runtime_error(self, context):
+        '''
+        Get runtime error for exception being handled, pointing to template
+        line which raised it.
+
+        :param TemplateContext context: context being rendered
+        :returns TemplateRuntimeError: error or None if exception does not
+                                       come from template code.
+        '''
+        type, value, traceback = sys.exc_info()
+
+        # Get exception template context
+        tb_next = traceback
+        while tb_next.tb_next:
+            tb_next = tb_next.tb_next
+        tb_ctx = tb_next.tb_frame.f_globals.get('__ctx__')
+        if tb_ctx is None:
+            return None
+
+        # Get related template object and line
+        template = tb_ctx.template_ref and tb_ctx.template_ref()
+        if template is None:
+            return self.runtime_error_class(value)
+        pycode_lineno = tb_next.tb_lineno - 1
+        line_map = template.get_line_map(tb_ctx.variant)
+        code_lineno = (
+            line_map[pycode_lineno] if pycode_lineno < len(line_map) else 0)
+        if not code_lineno:
+            # should not happen
+            return self.runtime_error_class(value,
+                pylineno=pycode_lineno, template=template,
+                variant=tb_ctx.variant,
+                pycode=template.get_pycode(tb_ctx.variant).splitlines()
+                )
+        code, code_lineno = template.get_code_location(code_lineno)
+        return self.runtime_error_class(value,
+            code=code.splitlines(), lineno=code_lineno,
+            pylineno=pycode_lineno, template=template, variant=tb_ctx.variant
+            )
+
+
+class BufferingTemplate(Template):
+    '''
+    Template which yields buffered chunks of :py:cvar:buffersize size, or
+    between :py:cvar:min_buffersize and :py:cvar:max_buffersize sizes if set.
+
+    You may want to inherit from this class in order to define different
+    values or, alternatively, change them once object is initialized. Sizes
+    are validated on initialization and on every :py:meth:render call.
+    '''
+    buffersize = 4096
+    min_buffersize = None # minimum chunk size, defaults to buffersize
+    max_buffersize = None # maximum chunk size, defaults to buffersize
+    buffersize_error_class = TemplateValueError
+
+    def __init__(self, *args, **kwargs):
+        self.get_buffersizes()
+        Template.__init__(self, *args, **kwargs)
+
+    def get_buffersizes(self):
+        '''
+        Get validated chunk sizes.
+
+        :returns tuple: minimum and maximum chunk sizes
+        :raise TemplateValueError: if sizes are not positive or minimum is
+                                   greater than maximum
+        '''
+        minsize = self.min_buffersize or self.buffersize
+        maxsize = self.max_buffersize or max(minsize, self.buffersize)
+        if minsize <= 0 or maxsize <= 0:
+            raise self.buffersize_error_class("Buffer sizes must be positive.")
+        if minsize > maxsize:
+            raise self.buffersize_error_class(
+                "min_buffersize cannot be greater than max_buffersize.")
+        return minsize, maxsize
+
+    def render(self, env=None):
+        '''
+        Renders template updating global namespace with env dict-like object.
+        Additionaly, this function ensures all-but-last yielded strings have
+        a length between :py:cvar:min_buffersize and :py:cvar:max_buffersize,
+        which are :py:cvar:buffersize by default.
+
+        :param dict env: environment dictionary
+        :returns: iterator of template lines as string, or as bytes if
+                  :py:cvar:output_encoding is set
+        :raise TemplateValueError: on invalid buffer sizes, before rendering
+        '''
+        minsize, maxsize = self.get_buffersizes()
+        return self.iter_buffered(env, minsize, maxsize)
+
+    def iter_buffered(self, env, minsize, maxsize):
+        '''
+        Render template yielding chunks of given sizes (see :py:meth:render).
+
+        Rendered data is copied a fixed number of times regardless of its
+        size, as pending data is joined only once a chunk can be yielded,
+        and only the remainder smaller than a chunk is kept.
+
+        :param dict env: environment dictionary
+        :param int minsize: minimum chunk size
+        :param int maxsize: maximum chunk size
+        :yields str: chunks as string, or as bytes if
+                     :py:cvar:output_encoding is set
+        '''
+        empty = b"" if self.output_encoding else ""
+        pending = []
+        size = 0
+        for line in Template.render(self, env):
+            pending.append(line)
+            size += len(line)
+            if size < minsize:
+                continue
+            data = pending[0] if len(pending) == 1 else empty.join(pending)
+            del pending[:]
+            start = 0
+            while size - start >= maxsize:
+                yield data[start:start + maxsize]
+                start += maxsize
+            if start == 0:
+                yield data
+                start = size
+            elif size - start >= minsize:
+                yield data[start:]
+                start = size
+            if start < size:
+                pending.append(data[start:])
+            size -= start
+        if pending:
+            yield empty.join(pending)
+
+
+def write_file_atomic(path, data):
+    '''
+    Write data to given path atomically, so concurrent readers get either
+    previous or new data, creating parent directory if necessary.
+
+    :param str path: file path
+    :param bytes data: file content
+    '''
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory)
+    except EnvironmentError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        replace_file(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+class BytecodeCache(object):
+    '''
+    Persistent on-disk cache of compiled templates, safe to be shared by
+    concurrent processes.
+
+    Entries are keyed by template source, filename, translator, stpl2 version
+    and python bytecode magic number, and are written atomically along a
+    digest of their payload, checked before unmarshalling it. Stale or
+    corrupt entries are ignored, so templates get compiled and dumped again.
+    '''
+    header = b"STPL2"
+    extension = ".stplc"
+    digest_size = hashlib.sha1().digest_size
+    logger = logging.getLogger("stpl2")
+
+    def __init__(self, directory):
+        from . import __version__
+        self.directory = directory
+        self.version = __version__
+
+    def get_key(self, template):
+        '''
+        Get cache key for given template.
+
+        :param Template template: template object
+        :returns str: hexadecimal key
+        '''
+        translate_class = template.translate_class
+        key = hashlib.sha1()
+        parts = [self.version, python_magic, translate_class.__module__,
+                 translate_class.__name__, template.filename or "",
+                 template.code]
+        if template.chunk_breaks:
+            parts.append(repr(sorted(template.chunk_breaks)))
+        for part in parts:
+            if not isinstance(part, bytes):
+                part = part.encode("utf-8")
+            key.update(part)
+            key.update(b"\0")
+        return key.hexdigest()
+
+    def get_path(self, key):
+        '''
+        Get cache entry path for given key.
+
+        :param str key: cache key
+        :returns str: path
+        '''
+        return os.path.join(self.directory, key + self.extension)
+
+    def load(self, template):
+        '''
+        Set template compiled state from cache, if available.
+
+        :param Template template: template object
+        :returns bool: True if template was loaded from cache, False otherwise
+        '''
+        key = self.get_key(template)
+        try:
+            with open(self.get_path(key), "rb") as f:
+                data = f.read()
+        except EnvironmentError:
+            return False
+        prefix = self.header + python_magic
+        if not data.startswith(prefix):
+            return False
+        start = len(prefix) + self.digest_size
+        payload = data[start:]
+        # unmarshalling corrupt code objects could crash the interpreter
+        if hashlib.sha1(payload).digest() != data[len(prefix):start]:
+            return False
+        try:
+            entry_key, state = marshal.loads(payload)
+            if entry_key != key:
+                return False
+            template.set_compiled_state(state)
+        except (EOFError, ValueError, TypeError):
+            return False
+        return True
+
+    def dump(self, template):
+        '''
+        Write template compiled state to cache, atomically replacing any
+        existing entry. Write errors (as unwritable cache directory or full
+        disk) are logged, as cache must never break template loading.
+
+        :param Template template: template object
+        :returns bool: True if entry was written, False otherwise
+        '''
+        key = self.get_key(template)
+        data = marshal.dumps((key, template.get_compiled_state()))
+        path = self.get_path(key)
+        try:
+            write_file_atomic(path, b"".join((
+                self.header, python_magic, hashlib.sha1(data).digest(), data)))
+        except EnvironmentError as e:
+            self.logger.warning("Cannot write bytecode cache entry %r: %s", path, e)
+            return False
+        return True
+
+    def clear(self):
+        '''
+        Remove all cache entries.
+        '''
+        try:
+            names = os.listdir(self.directory)
+        except EnvironmentError:
+            return
+        for name in names:
+            if name.endswith(self.extension):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except EnvironmentError:
+                    pass
+
+
+def compile_template_state(task):
+    '''
+    Compile template code, as done by :py:meth:TemplateManager.warmup worker
+    processes. Compiled state is marshalled, as code objects cannot be
+    pickled.
+
+    :param tuple task: template class, template code and filename
+    :returns tuple: marshalled compiled state (see
+                    :py:meth:Template.get_compiled_state) or None,
+                    compilation time in seconds and error or None
+    '''
+    template_class, code, filename = task
+    start = timer()
+    try:
+        template = template_class(code, filename)
+        data = marshal.dumps(template.get_compiled_state())
+    except Exception as e:
+        return None, timer() - start, e
+    return data, timer() - start, None
+
+
+def estimate_size(obj, seen=None):
+    '''
+    Estimate memory size of given object, recursing into containers and code
+    objects, counting every object once.
+
+    :param obj: any python object
+    :param set seen: ids of objects to be ignored, updated with visited ones
+    :return int: size in bytes
+    '''
+    if seen is None:
+        seen = set()
+    size = 0
+    pending = [obj]
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            pending.extend(obj)
+            pending.extend(itervalues(obj))
+        elif isinstance(obj, (tuple, list, set, frozenset)):
+            pending.extend(obj)
+        elif isinstance(obj, types.CodeType):
+            pending.extend((obj.co_code, obj.co_consts, obj.co_names,
+                            obj.co_varnames))
+    return size
+
+
+class TemplateCache(MutableMapping):
+    '''
+    Thread-safe template mapping with optional least-recently-used eviction,
+    bounded by number of templates and/or estimated memory usage (see
+    :py:meth:Template.memory_usage).
+
+    Templates being used (see :py:attr:Template.in_use) are never evicted.
+    Bounds are enforced when templates are added, or by calling
+    :py:meth:shrink. Template memory is estimated once, when added (or when
+    first shrinking after setting :py:attr:maxmemory), and summed as
+    templates are added and removed.
+
+    Lookups on unbounded caches are not locked, nor reorder templates.
+    '''
+    def __init__(self, maxsize=None, maxmemory=None):
+        '''
+        :param int maxsize: maximum number of templates, unbounded if None
+        :param int maxmemory: maximum memory in bytes, unbounded if None
+        '''
+        self.maxsize = maxsize
+        self.maxmemory = maxmemory
+        self._data = collections.OrderedDict()
+        self._sizes = {} # estimated template memory, see maxmemory
+        self._memory = 0
+        self._lock = threading.RLock()
+
+    @property
+    def bounded(self):
+        return self.maxsize is not None or self.maxmemory is not None
+
+    def __getitem__(self, name):
+        if not self.bounded:
+            return self._data[name]
+        with self._lock:
+            template = self._data[name]
+            # Move to most recently used
+            del self._data[name]
+            self._data[name] = template
+            return template
+
+    def __setitem__(self, name, template):
+        with self._lock:
+            self._discard(name)
+            self._data[name] = template
+            if self.maxmemory is not None:
+                self._add_size(name, template)
+            if self.bounded:
+                self.shrink(name)
+
+    def __delitem__(self, name):
+        with self._lock:
+            if self._discard(name) is None:
+                raise KeyError(name)
+
+    def __contains__(self, name):
+        return name in self._data
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._data))
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, name, default=None):
+        '''
+        Get template, atomically (unlike checking and getting it).
+
+        :param str name: template name
+        :param default: value returned if template is not cached
+        :returns Template: template object or default
+        '''
+        if not self.bounded:
+            return self._data.get(name, default)
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def pop(self, name, *default):
+        with self._lock:
+            template = self._discard(name)
+            if template is None:
+                if default:
+                    return default[0]
+                raise KeyError(name)
+            return template
+
+    def items(self):
+        with self._lock:
+            return list(self._data.items())
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self._memory = 0
+
+    def _discard(self, name):
+        '''
+        Remove template and its estimated memory, if any.
+
+        :param str name: template name
+        :returns Template: removed template or None
+        '''
+        template = self._data.pop(name, None)
+        self._memory -= self._sizes.pop(name, 0)
+        return template
+
+    def _add_size(self, name, template):
+        '''
+        Estimate memory of given template and add it to total.
+        '''
+        size = self._sizes[name] = template.memory_usage()
+        self._memory += size
+
+    def memory_usage(self):
+        '''
+        Estimate memory used by every template (see :py:meth:Template.memory_usage).
+
+        :returns dict: template names and sizes in bytes
+        '''
+        return dict(
+            (name, template.memory_usage())
+            for name, template in self.items()
+            )
+
+    def shrink(self, keep=None):
+        '''
+        Evict least recently used templates until bounds are satisfied.
+
+        :param str keep: template name which must not be evicted
+        :returns list: evicted template names
+        '''
+        with self._lock:
+            if self.maxmemory is not None and len(self._sizes) != len(self._data):
+                # memory bound set after templates were added
+                for name, template in self._data.items():
+                    if name not in self._sizes:
+                        self._add_size(name, template)
+            evicted = []
+            for name, template in list(self._data.items()):
+                if (
+                  (self.maxsize is None or len(self._data) <= self.maxsize) and
+                  (self.maxmemory is None or self._memory <= self.maxmemory)):
+                    break
+                if name == keep or template.in_use:
+                    continue
+                self._discard(name)
+                evicted.append(name)
+            return evicted
+
+
+class TemplateLinkError(TemplateValueError):
+    pass
+
+
+class TemplateLinker(object):
+    '''
+    Link a template with its literal includes, extends and rebase into a
+    single flattened template, so it is rendered by a single generator
+    function instead of a chain of template contexts.
+
+    Lines are spliced at template level: block definitions are replaced by
+    their childmost overrides (with block.super replaced by parent blocks),
+    literal includes by included template lines, and base by rebased
+    template lines. Templates are not linked (or includes are kept as
+    includes) if they use code blocks, block or base variables, include
+    parameters, or if their spliced parts would share variable names.
+    Includes are also kept if either side accesses its namespace by name
+    (see :py:cvar:namespace_names), as it would see the other's variables.
+    '''
+    link_error_class = TemplateLinkError
+    word_re_template = r"\b%s\b"
+    namespace_names = frozenset((
+        "defined", "get", "setdefault", "globals", "locals", "vars",
+        "eval", "exec", "__ctx__",
+        ))
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.translator = manager.template_class.translate_class()
+        self.block_re = re.compile(self.word_re_template % "block")
+        self.base_re = re.compile(self.word_re_template % "base")
+        self.members = set()
+        self._lines = {}
+        self._scopes = {}
+
+    def get_lines(self, name):
+        '''
+        Parse template code into lines with their custom tokens.
+
+        :param str name: template name
+        :returns list: (line, token, params, (name, lineno)) tuples, token
+                       being None for text lines.
+        '''
+        if name in self._lines:
+            return self._lines[name]
+        translator = self.translator
+        template = self.manager.get_template(name)
+        lines = []
+        for lineno, line in enumerate(template.code.splitlines(True), 1):
+            if translator.literal_open in line:
+                raise self.link_error_class("Code blocks cannot be linked.")
+            token = params = None
+            lstripped = line.lstrip()
+            if lstripped.startswith(translator.code_line_prefix):
+                code = lstripped[translator.code_line_prefix_length:].lstrip()
+                match = translator.re_tokens.match(code)
+                group = match.groupdict() if match else {}
+                if group.get("custom"):
+                    token = group["custom"]
+                    params = group["params"]
+                elif group.get("indent") and translator.check_indent(code):
+                    token = "indent"
+                elif group.get("redent") and not translator.check_indent(code):
+                    token = "dedent"
+                else:
+                    token = "code"
+                if not line.endswith(translator.linesep):
+                    line += translator.linesep # code lines are not rendered
+            lines.append((line, token, params, (name, lineno)))
+        self.members.add(name)
+        self._lines[name] = lines
+        return lines
+
+    def get_name(self, params):
+        '''
+        Get template or block name from token params, as translator does.
+
+        :param str params: token params
+        :returns tuple: name and unparsed params
+        '''
+        args, kwargs, unparsed = self.translator.token_params(params, 1)
+        return kwargs.get("name", args[0] if args else None), unparsed
+
+    def find_end(self, lines, start):
+        '''
+        Get index of end token closing block token at given index.
+        '''
+        depth = 0
+        for index in xrange(start + 1, len(lines)):
+            token = lines[index][1]
+            if token in ("indent", "block", "cache"):
+                depth += 1
+            elif token in ("end", "dedent"):
+                if not depth:
+                    if token == "dedent":
+                        break
+                    return index
+                depth -= 1
+        raise self.link_error_class("Unmatched block.")
+
+    def get_blocks(self, lines):
+        '''
+        Get block definitions (nested ones included) from template lines.
+
+        :param list lines: template lines
+        :returns dict: block names and their content lines
+        '''
+        blocks = {}
+        for index, (line, token, params, origin) in enumerate(lines):
+            if token == "block":
+                name, unparsed = self.get_name(params)
+                if name is None or unparsed:
+                    raise self.link_error_class("Unsupported block params.")
+                blocks[name] = lines[index + 1:self.find_end(lines, index)]
+        return blocks
+
+    def expand(self, lines, chain, level, current, pieces, stack):
+        '''
+        Replace block definitions and block.super tokens from given lines.
+
+        :param list lines: template lines
+        :param list chain: (name, blocks) tuples from childmost to parentmost
+        :param int level: chain index of lines' template
+        :param str current: name of block being expanded or None
+        :param list pieces: list where scope pieces will be appended
+        :param tuple stack: blocks being expanded, for recursion detection
+        :returns list: expanded lines
+        '''
+        result = []
+        index = 0
+        while index < len(lines):
+            line, token, params, origin = lines[index]
+            if token == "block":
+                name, unparsed = self.get_name(params)
+                result.extend(self.resolve(name, 0, chain, pieces, stack))
+                index = self.find_end(lines, index)
+            elif token == "block.super":
+                result.extend(
+                    self.resolve(current, level + 1, chain, pieces, stack))
+            else:
+                result.append(lines[index])
+            index += 1
+        return result
+
+    def resolve(self, name, start, chain, pieces, stack):
+        '''
+        Get expanded lines of first block with given name found on chain.
+        '''
+        for level in xrange(start, len(chain)):
+            template_name, blocks = chain[level]
+            if name in blocks:
+                key = (level, name)
+                if key in stack:
+                    raise self.link_error_class("Recursive block %r." % name)
+                pieces.append((template_name, name))
+                return self.expand(blocks[name], chain, level, name, pieces,
+                                   stack + (key,))
+        return []
+
+    def link(self, name, pieces, stack=(), include=True):
+        '''
+        Get flattened lines of given template.
+
+        :param str name: template name
+        :param list pieces: list where scope pieces will be appended, as
+                            (template name, block name or None) tuples
+        :param tuple stack: templates being linked, for recursion detection
+        :param bool include: whether includes should be linked
+        :returns list: template lines
+        '''
+        if name in stack:
+            raise self.link_error_class("Recursive template %r." % name)
+        stack += (name,)
+        template = self.manager.get_template(name)
+        if template.rebase and template.extends:
+            raise self.link_error_class("Cannot link extends with rebase.")
+
+        # Extends
+        chain = [(name, self.get_blocks(self.get_lines(name)))]
+        parent = template
+        while parent.extends:
+            if parent.extends in stack or parent.extends in dict(chain):
+                raise self.link_error_class("Recursive extends.")
+            parent_name = parent.extends
+            parent = self.manager.get_template(parent_name)
+            if parent.rebase:
+                raise self.link_error_class("Cannot link extends with rebase.")
+            chain.append(
+                (parent_name, self.get_blocks(self.get_lines(parent_name))))
+        pieces.append((chain[-1][0], None))
+        lines = self.expand(self.get_lines(chain[-1][0]), chain,
+                            len(chain) - 1, None, pieces, ())
+
+        # Includes
+        if include:
+            lines = self.link_includes(lines, pieces, stack)
+
+        # Rebase
+        if template.rebase:
+            body = [line for line in lines if line[1] != "rebase"]
+            if body and not body[-1][0].endswith(self.translator.linesep):
+                raise self.link_error_class("Unterminated rebased template.")
+            rebased = []
+            for line in self.link(template.rebase, pieces, stack, include):
+                if line[1] == "base":
+                    rebased.extend(body)
+                else:
+                    rebased.append(line)
+            lines = rebased
+        return lines
+
+    def link_includes(self, lines, pieces, stack):
+        '''
+        Replace literal includes from given lines with included template
+        lines, when possible.
+        '''
+        result = []
+        for line in lines:
+            if line[1] == "include":
+                name, unparsed = self.get_name(line[2])
+                if name is not None and not unparsed:
+                    included_pieces = []
+                    try:
+                        included = self.link(name, included_pieces, stack)
+                        if self.access_namespace(pieces + included_pieces):
+                            included = None
+                    except (self.link_error_class, TemplateNotFoundError):
+                        included = None
+                    if included is not None and (
+                      not included or
+                      included[-1][0].endswith(self.translator.linesep)):
+                        result.extend(included)
+                        pieces.extend(included_pieces)
+                        continue
+            result.append(line)
+        return result
+
+    def get_scope(self, name, block):
+        '''
+        Get local and referenced names of template or block function.
+
+        :param str name: template name
+        :param str block: block name or None
+        :returns tuple: set of local names and set of referenced names
+        '''
+        key = (name, block)
+        if not key in self._scopes:
+            namespace = {}
+            eval(self.manager.get_template(name)._pycompiled, namespace)
+            function = (
+                namespace["__blocks__"][block] if block else
+                namespace["__template__"]
+                )
+            code = function.__code__
+            local = set(
+                local_name for local_name in code.co_varnames + code.co_cellvars
+                # generated names, as fragment functions, are not shared
+                if not (local_name.startswith("__") and local_name.endswith("__"))
+                )
+            if block:
+                local.discard("block")
+            names = set()
+            pending = [code]
+            while pending:
+                code = pending.pop()
+                names.update(code.co_names + code.co_freevars)
+                pending.extend(
+                    const for const in code.co_consts
+                    if isinstance(const, types.CodeType))
+            self._scopes[key] = (local, names)
+        return self._scopes[key]
+
+    def access_namespace(self, pieces):
+        '''
+        Get whether any given piece references namespace functions (see
+        :py:cvar:namespace_names), attribute names included.
+
+        :param list pieces: (template name, block name or None) tuples
+        :returns bool: True if namespace is accessed by name
+        '''
+        return any(
+            not self.namespace_names.isdisjoint(self.get_scope(name, block)[1])
+            for name, block in pieces
+            )
+
+    def check(self, lines, pieces):
+        '''
+        Raise link error if linked lines reference block or base variables,
+        or if any linked piece (template or block function) defines a local
+        variable also used by any other piece.
+        '''
+        for line, token, params, origin in lines:
+            if token is None:
+                expressions = [
+                    line[start:end]
+                    for start, end in self.translator.iter_var_spans(line)]
+            elif token in ("code", "indent", "dedent", "cache"):
+                expressions = [line]
+            else:
+                continue
+            for expression in expressions:
+                if self.block_re.search(expression) or self.base_re.search(expression):
+                    raise self.link_error_class("Cannot link block or base variables.")
+        scopes = [self.get_scope(name, block) for name, block in pieces]
+        for i, (local, names) in enumerate(scopes):
+            if local:
+                for j, (other_local, other_names) in enumerate(scopes):
+                    if i != j and (local & other_local or local & other_names):
+                        raise self.link_error_class("Shared variable names.")
+
+    def link_template(self, name):
+        '''
+        Create flattened template for given template name.
+
+        :param str name: template name
+        :returns Template: linked template, or None if cannot be linked
+        '''
+        template = self.manager.get_template(name)
+        if not (template.dependencies or template.blocks):
+            return None
+        lines = None
+        for include in (True, False):
+            pieces = []
+            try:
+                lines = self.link(name, pieces, include=include)
+                self.check(lines, pieces)
+                break
+            except self.link_error_class:
+                lines = None
+        if lines is None or lines == self.get_lines(name):
+            return None
+        linked = self.manager.template_class(
+            "".join(line[0] for line in lines), None, self.manager,
+            line_origins=[line[3] for line in lines])
+        linked.linked_members = tuple(
+            (member, self.manager.get_template(member))
+            for member in sorted(self.members)
+            )
+        return linked
+
+
+class TemplateProfiler(object):
+    '''
+    Template line profiler, attributing hits and time to template lines
+    (following :py:attr:Template.line_origins of linked templates) using the
+    line annotations of generated python code.
+
+    Uses :py:mod:sys.monitoring if available (python 3.12 or newer), which
+    records all threads, falling back to :py:func:sys.settrace, which
+    records current thread. Time is measured between line events, so lines
+    get their own time plus time spent on non-template functions they call,
+    but not time spent on other template lines (as included templates) nor
+    by the consumer of rendered lines.
+
+    Usage:
+
+        with TemplateProfiler(manager) as profiler:
+            manager.render_string("index", env)
+        profiler.print_report()
+
+    '''
+    tool_name = "stpl2"
+
+    def __init__(self, manager=None, templates=(), use_monitoring=None):
+        '''
+        :param TemplateManager manager: manager whose templates are profiled
+        :param templates: iterable of additional templates to profile
+        :param bool use_monitoring: whether use :py:mod:sys.monitoring,
+                                    defaults to True if available
+        '''
+        if use_monitoring is None:
+            use_monitoring = hasattr(sys, "monitoring")
+        self.manager = manager
+        self.templates = list(templates)
+        self.use_monitoring = use_monitoring
+        self.running = False
+        self._tool = None
+        self._previous_trace = None
+        self.clear()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def clear(self):
+        '''
+        Discard recorded data.
+        '''
+        self._codes = {} # code: (template, variant) or None
+        self._indexed = set() # (id(template), variant)
+        self._offsets = {} # code: {instruction offset: python line}
+        self._lines = {} # (code, python line): [hits, seconds]
+        self._last = None
+        self._last_time = 0.
+
+    def start(self):
+        '''
+        Start recording template line events.
+        '''
+        if self.running:
+            return
+        if self.use_monitoring:
+            monitoring = sys.monitoring
+            events = monitoring.events
+            self._tool = monitoring.PROFILER_ID
+            monitoring.use_tool_id(self._tool, self.tool_name)
+            for event, callback in (
+              (events.LINE, self._monitor_line),
+              (events.PY_RESUME, self._monitor_resume),
+              (events.PY_YIELD, self._monitor_leave),
+              (events.PY_RETURN, self._monitor_leave)):
+                monitoring.register_callback(self._tool, event, callback)
+            monitoring.set_events(
+                self._tool,
+                events.LINE | events.PY_RESUME | events.PY_YIELD |
+                events.PY_RETURN)
+            monitoring.restart_events()
+        else:
+            self._previous_trace = sys.gettrace()
+            sys.settrace(self._trace_call)
+        self.running = True
+
+    def stop(self):
+        '''
+        Stop recording template line events.
+        '''
+        if not self.running:
+            return
+        if self._tool is not None:
+            monitoring = sys.monitoring
+            monitoring.set_events(self._tool, 0)
+            for event in (monitoring.events.LINE, monitoring.events.PY_RESUME,
+                          monitoring.events.PY_YIELD,
+                          monitoring.events.PY_RETURN):
+                monitoring.register_callback(self._tool, event, None)
+            monitoring.free_tool_id(self._tool)
+            self._tool = None
+        else:
+            sys.settrace(self._previous_trace)
+            self._previous_trace = None
+        self._leave()
+        self.running = False
+
+    def iter_templates(self):
+        '''
+        Iterate over profiled templates: given ones, and manager templates
+        along with their flattened templates.
+
+        :yields Template: template objects
+        '''
+        for template in self.templates:
+            yield template
+        if self.manager is not None:
+            for template in list(self.manager.templates.values()):
+                yield template
+                if template.flattened not in (None, template):
+                    yield template.flattened
+
+    def is_template_code(self, code):
+        '''
+        Get if given code object belongs to a profiled template, indexing
+        code objects of templates not indexed yet.
+
+        :param code: code object
+        :returns bool: True if code comes from a template
+        '''
+        if not code in self._codes:
+            for template in self.iter_templates():
+                modules = [("stream", template._pycompiled)]
+                modules.extend(
+                    (variant, compiled[1])
+                    for variant, compiled in template._variants.items()
+                    if compiled)
+                for variant, module in modules:
+                    key = (id(template), variant)
+                    if key in self._indexed:
+                        continue
+                    self._indexed.add(key)
+                    pending = [module]
+                    while pending:
+                        current = pending.pop()
+                        self._codes[current] = (template, variant)
+                        pending.extend(
+                            const for const in current.co_consts
+                            if isinstance(const, types.CodeType))
+            self._codes.setdefault(code, None)
+        return self._codes[code] is not None
+
+    def _hit(self, code, lineno):
+        now = timer()
+        if self._last is not None:
+            self._last[1] += now - self._last_time
+        key = (code, lineno)
+        entry = self._lines.get(key)
+        if entry is None:
+            entry = self._lines[key] = [0, 0.]
+        entry[0] += 1
+        self._last = entry
+        self._last_time = timer()
+
+    def _enter(self, code, lineno):
+        self._leave()
+        key = (code, lineno)
+        entry = self._lines.get(key)
+        if entry is None:
+            entry = self._lines[key] = [0, 0.]
+        self._last = entry
+        self._last_time = timer()
+
+    def _leave(self):
+        if self._last is not None:
+            self._last[1] += timer() - self._last_time
+            self._last = None
+
+    def _monitor_line(self, code, lineno):
+        if not self.is_template_code(code):
+            return sys.monitoring.DISABLE
+        self._hit(code, lineno)
+
+    def _monitor_resume(self, code, offset):
+        if not self.is_template_code(code):
+            return sys.monitoring.DISABLE
+        offsets = self._offsets.get(code)
+        if offsets is None:
+            offsets = self._offsets[code] = dict(
+                (current, lineno)
+                for start, end, lineno in code.co_lines()
+                for current in xrange(start, end, 2))
+        self._enter(code, offsets.get(offset))
+
+    def _monitor_leave(self, code, offset, value):
+        if not self.is_template_code(code):
+            return sys.monitoring.DISABLE
+        self._leave()
+
+    def _trace_call(self, frame, event, arg):
+        if self.is_template_code(frame.f_code):
+            # Called on both function start and generator resume
+            self._enter(frame.f_code, frame.f_lineno)
+            return self._trace_line
+        return None
+
+    def _trace_line(self, frame, event, arg):
+        if event == "line":
+            self._hit(frame.f_code, frame.f_lineno)
+        elif event == "return": # also on generator yield
+            self._leave()
+        return self._trace_line
+
+    def get_template_label(self, template):
+        '''
+        Get label identifying given template on results.
+
+        :param Template template: template object
+        :returns str: template filename, name or "<template>"
+        '''
+        if template.filename:
+            return template.filename
+        if self.manager is not None:
+            for name, current in list(self.manager.templates.items()):
+                if current is template:
+                    return name
+        return "<template>"
+
+    def get_results(self):
+        '''
+        Get recorded data by template line, sorted by time.
+
+        :returns list: tuples of template label (see
+                       :py:meth:get_template_label), template line number,
+                       hits, time in seconds and template line
+        '''
+        results = {}
+        for (code, pylineno), (hits, seconds) in list(self._lines.items()):
+            template, variant = self._codes[code]
+            line_map = template.get_line_map(variant)
+            if not pylineno or pylineno > len(line_map) or not line_map[pylineno - 1]:
+                continue # generated code outside template lines
+            lineno = line_map[pylineno - 1]
+            origin = template
+            if template.line_origins:
+                name, lineno = template.line_origins[lineno - 1]
+                origin = self.manager.get_template(name)
+            key = (self.get_template_label(origin), lineno)
+            result = results.get(key)
+            if result is None:
+                lines = origin.code.splitlines()
+                result = results[key] = [
+                    key[0], lineno, 0, 0.,
+                    lines[lineno - 1] if lineno <= len(lines) else ""]
+            # Template lines can span many python lines
+            result[2] = max(result[2], hits)
+            result[3] += seconds
+        return sorted(
+            (tuple(result) for result in results.values()),
+            key=lambda result: (-result[3], result[0], result[1]))
+
+    def print_report(self, limit=None, stream=None):
+        '''
+        Print recorded data by template line, sorted by time.
+
+        :param int limit: maximum number of lines, unlimited if None
+        :param stream: file-like object, defaults to sys.stdout
+        '''
+        stream = sys.stdout if stream is None else stream
+        results = self.get_results()
+        total = sum(result[3] for result in results) or 1.
+        stream.write("%10s %7s %10s %6s  %s\n" % (
+            "Time (ms)", "Hits", "Per hit", "%", "Location and source"))
+        for label, lineno, hits, seconds, line in results[:limit]:
+            stream.write("%10.3f %7d %8.2fus %5.1f%%  %s:%d  %s\n" % (
+                seconds * 1e3, hits, seconds * 1e6 / (hits or 1),
+                seconds * 100 / total, label, lineno, line.strip()))
+
+
+def get_file_version(path):
+    '''
+    Get a cheap version token of given file.
+
+    :param str path: file path
+    :return tuple: modification time and size, or None if not available
+    '''
+    try:
+        stat = os.stat(path)
+    except EnvironmentError:
+        return None
+    return (stat.st_mtime, stat.st_size)
+
+
+def iter_directory(path):
+    '''
+    Iterate over directory entries, following symbolic links, using a
+    single :py:func:os.scandir call when available.
+
+    :param str path: directory path
+    :yields tuple: entry name, whether entry is a file, whether entry is a
+                   directory and whether entry is a symbolic link
+    '''
+    if scandir is not None:
+        for entry in scandir(path):
+            try:
+                yield entry.name, entry.is_file(), entry.is_dir(), entry.is_symlink()
+            except EnvironmentError:
+                pass
+    else:
+        for name in os.listdir(path):
+            entry = os.path.join(path, name)
+            yield name, os.path.isfile(entry), os.path.isdir(entry), os.path.islink(entry)
+
+
+class TemplateLoader(object):
+    '''
+    Base template loader, getting template sources by name for
+    :py:class:TemplateManager (see :py:attr:TemplateManager.loaders).
+
+    Names are looked up as they are, and then with every extension from
+    :py:attr:extensions appended.
+    '''
+    extensions = (".tpl", ".stpl")
+    encoding = "utf-8" # for sources read as bytes
+
+    def __init__(self, extensions=None, encoding=None):
+        '''
+        :param iterable extensions: optional template extensions, in lookup
+                                    order
+        :param str encoding: optional encoding of sources read as bytes
+        '''
+        if extensions is not None:
+            self.extensions = tuple(extensions)
+        if encoding is not None:
+            self.encoding = encoding
+
+    def iter_candidates(self, name):
+        '''
+        :param str name: template name
+        :yields str: names to look up, in order
+        '''
+        yield name
+        for ext in self.extensions:
+            yield name + ext
+
+    def iter_names(self, names):
+        '''
+        Iterate over template names, both with and without extension, for
+        given sorted source names.
+
+        :param iterable names: source names, with extension
+        :yields str: template names
+        '''
+        for name in names:
+            base, ext = os.path.splitext(name)
+            if ext in self.extensions:
+                yield base
+                yield name
+
+    def decode(self, data):
+        '''
+        :param bytes data: template source as read
+        :returns str: template source as native string
+        '''
+        return data.decode(self.encoding) if py3k else data
+
+    def load(self, name):
+        '''
+        Get template source for given name.
+
+        :param str name: template name
+        :returns tuple: template filename, source and version token (see
+                        :py:meth:get_version), or None if not found
+        '''
+        raise NotImplementedError
+
+    def find(self, name):
+        '''
+        :param str name: template name
+        :returns str: template filename or None if not found
+        '''
+        found = self.load(name)
+        return None if found is None else found[0]
+
+    def get_version(self, filename):
+        '''
+        Get a cheap version token for template source, changing along with
+        it, used to detect changes on templates loaded by this loader.
+
+        :param str filename: template filename, as given by :py:meth:load
+        :returns: hashable version token, or None if not available
+        '''
+        return None
+
+    def iter_template_names(self):
+        '''
+        Iterate over names of all templates available on this loader.
+
+        :yields str: template names
+        '''
+        return iter(())
+
+
+class FileSystemLoader(TemplateLoader):
+    '''
+    Template loader for template directories, also accepting absolute
+    template paths. This is the default :py:class:TemplateManager loader.
+
+    Template directories can be optionally indexed in memory, along with
+    names not found on them (up to :py:cvar:max_misses), so names are
+    resolved without system calls until next index rebuild. Resolution order
+    is kept, but files created or removed since last rebuild are not
+    noticed, and symbolic link loops are not followed.
+    '''
+    miss_cache_class = FragmentCache
+    max_misses = 1024 # maximum number of names remembered as not found
+
+    def __init__(self, directories=(), extensions=None, index_interval=None):
+        '''
+        :param directories: template directory or collection of directories,
+                            kept as given so later changes are honored
+        :param iterable extensions: optional template extensions
+        :param float index_interval: optional seconds between rebuilds of
+                                     the in-memory index of template
+                                     directories, disabled if None
+        '''
+        super(FileSystemLoader, self).__init__(extensions)
+        if isinstance(directories, native_string_bases):
+            directories = (directories,)
+        self.directories = directories
+        self.index_interval = index_interval
+        self.misses = self.miss_cache_class(self.max_misses)
+        self._index = (0, {}) # next rebuild time, directory: relative paths
+
+    def find(self, name):
+        '''
+        Find template file for given name on template directories, or path.
+
+        :param str name: template name, relative or absolute path
+        :returns str: template path or None if not found
+        '''
+        if self.index_interval is None:
+            return self.find_path(name)
+        index = self.get_index()
+        if self.misses.get(name):
+            return None
+        key = os.path.normcase(name)
+        parts = key.split(os.sep)
+        if os.path.isabs(name) or "" in parts or os.curdir in parts or os.pardir in parts:
+            # not indexed, as resolution depends on other paths
+            path = self.find_path(name)
+        else:
+            path = self.find_indexed(name, key, index)
+        if path is None:
+            self.misses.set(name, True)
+        return path
+
+    def find_path(self, name):
+        '''
+        Find template file for given name on template directories, or path,
+        checking file system.
+
+        :param str name: template name, relative or absolute path
+        :returns str: template path or None if not found
+        '''
+        if not os.path.isabs(name):
+            for directory in self.directories:
+                path = os.path.join(directory, name)
+                if os.path.isfile(path):
+                    return path
+                for ext in self.extensions:
+                    extpath = path + ext
+                    if os.path.isfile(extpath):
+                        return extpath
+        elif os.path.exists(name):
+            return name
+        return None
+
+    def find_indexed(self, name, key, index):
+        '''
+        Find template file for given relative name on directory index, in
+        the same order than :py:meth:find_path.
+
+        :param str name: relative template name
+        :param str key: normalized template name (see :py:func:os.path.normcase)
+        :param dict index: directory index (see :py:meth:get_index)
+        :returns str: template path or None if not found
+        '''
+        for directory in self.directories:
+            paths = index.get(directory)
+            if paths is None:
+                paths = index[directory] = self.build_index(directory)
+            if key in paths:
+                return os.path.join(directory, name)
+            for ext in self.extensions:
+                if key + os.path.normcase(ext) in paths:
+                    return os.path.join(directory, name) + ext
+        return None
+
+    def get_index(self):
+        '''
+        Get directory index, discarding it along with remembered misses
+        every :py:attr:index_interval seconds.
+
+        :returns dict: directories and their indexed relative paths,
+                       filled on demand (see :py:meth:build_index)
+        '''
+        rebuild, index = self._index
+        now = time.time()
+        if rebuild <= now:
+            index = {}
+            self._index = (now + self.index_interval, index)
+            self.misses.clear()
+        return index
+
+    def refresh_index(self):
+        '''
+        Discard directory index and remembered misses, so they are rebuilt
+        on next lookup.
+        '''
+        self._index = (0, {})
+
+    def build_index(self, directory):
+        '''
+        Walk given directory, following symbolic links.
+
+        :param str directory: template directory
+        :returns frozenset: normalized relative paths of all files (see
+                            :py:func:os.path.normcase)
+        '''
+        paths = []
+        pending = [(directory, "")]
+        while pending:
+            path, prefix = pending.pop()
+            try:
+                entries = list(iter_directory(path))
+            except EnvironmentError:
+                continue
+            for name, isfile, isdir, islink in entries:
+                if isfile:
+                    paths.append(os.path.normcase(prefix + name))
+                elif isdir:
+                    entry = os.path.join(path, name)
+                    if islink:
+                        target = os.path.realpath(entry)
+                        parent = os.path.realpath(path)
+                        if parent == target or parent.startswith(target + os.sep):
+                            continue # symbolic link loop
+                    pending.append((entry, prefix + name + os.sep))
+        return frozenset(paths)
+
+    def load(self, name):
+        path = self.find(name)
+        if path is None:
+            return None
+        version = self.get_version(path)
+        try:
+            f = open(path)
+        except EnvironmentError as e:
+            if self.index_interval is None or e.errno != errno.ENOENT:
+                raise
+            return None # removed since indexed
+        with f:
+            return path, f.read(), version
+
+    def get_version(self, filename):
+        return get_file_version(filename)
+
+    def iter_template_names(self):
+        for directory in self.directories:
+            for dirpath, dirnames, filenames in os.walk(directory):
+                dirnames.sort()
+                relpath = os.path.relpath(dirpath, directory)
+                if relpath != os.curdir:
+                    filenames = [
+                        os.path.join(relpath, filename)
+                        for filename in filenames]
+                for name in self.iter_names(sorted(filenames)):
+                    yield name.replace(os.sep, "/")
+
+
+class ZipLoader(TemplateLoader):
+    '''
+    Template loader reading templates in place from zip archives, as
+    zipapps or zipped eggs.
+
+    Archive member list is read again only when archive file changes.
+    '''
+
+    def __init__(self, path, extensions=None, encoding=None):
+        '''
+        :param str path: zip archive path, optionally followed by a directory
+                         inside the archive (as "app.pyz/templates", as
+                         zipimport paths)
+        :param iterable extensions: optional template extensions
+        :param str encoding: optional template encoding, defaults to utf-8
+        '''
+        super(ZipLoader, self).__init__(extensions, encoding)
+        archive = os.path.normpath(path)
+        prefix = ""
+        while not os.path.isfile(archive):
+            parent, tail = os.path.split(archive)
+            if not tail or parent == archive:
+                archive, prefix = path, ""
+                break
+            archive = parent
+            prefix = "%s/%s" % (tail, prefix) if prefix else "%s/" % tail
+        self.archive = archive
+        self.prefix = prefix
+        self._index = (None, {}) # archive version and members
+
+    def get_members(self):
+        '''
+        Get archive members, read again if archive changed.
+
+        :returns dict: member names and zipfile.ZipInfo objects
+        '''
+        version = get_file_version(self.archive)
+        current, members = self._index
+        if version != current:
+            members = {}
+            if version is not None:
+                archive = zipfile.ZipFile(self.archive)
+                try:
+                    for info in archive.infolist():
+                        if not info.filename.endswith("/"):
+                            members[info.filename] = info
+                finally:
+                    archive.close()
+            self._index = (version, members)
+        return members
+
+    def load(self, name):
+        members = self.get_members()
+        for candidate in self.iter_candidates(name):
+            info = members.get(self.prefix + candidate)
+            if info is not None:
+                archive = zipfile.ZipFile(self.archive)
+                try:
+                    data = archive.read(info)
+                finally:
+                    archive.close()
+                filename = os.path.join(self.archive, info.filename)
+                return filename, self.decode(data), (info.CRC, info.file_size)
+        return None
+
+    def get_version(self, filename):
+        member = filename[len(self.archive) + 1:].replace(os.sep, "/")
+        info = self.get_members().get(member)
+        return None if info is None else (info.CRC, info.file_size)
+
+    def iter_template_names(self):
+        size = len(self.prefix)
+        return self.iter_names(sorted(
+            member[size:] for member in self.get_members()
+            if member.startswith(self.prefix)))
+
+
+class ResourceLoader(TemplateLoader):
+    '''
+    Template loader for package resources, read through
+    importlib.resources (or pkgutil.get_data on older pythons) so templates
+    shipped inside wheels, eggs or zipapps are read in place.
+    '''
+
+    def __init__(self, package, directory="", extensions=None, encoding=None):
+        '''
+        :param str package: absolute package name
+        :param str directory: optional resource directory inside package,
+                              using slashes as separator
+        :param iterable extensions: optional template extensions
+        :param str encoding: optional template encoding, defaults to utf-8
+        '''
+        super(ResourceLoader, self).__init__(extensions, encoding)
+        self.package = package
+        self.directory = directory.strip("/")
+
+    def get_resource(self, name):
+        '''
+        :param str name: resource name relative to directory
+        :returns: importlib.resources traversable
+        '''
+        resource = resource_files(self.package)
+        for part in ("%s/%s" % (self.directory, name)).split("/"):
+            if part:
+                resource = resource.joinpath(part)
+        return resource
+
+    def load(self, name):
+        for candidate in self.iter_candidates(name):
+            if resource_files is not None:
+                resource = self.get_resource(candidate)
+                if not resource.is_file():
+                    continue
+                try:
+                    data = resource.read_bytes()
+                except (EnvironmentError, KeyError):
+                    # python 3.9 zip resources report missing files as files
+                    continue
+                filename = str(resource)
+            else:
+                path = "%s/%s" % (self.directory, candidate) if self.directory else candidate
+                try:
+                    data = pkgutil.get_data(self.package, path)
+                except EnvironmentError:
+                    continue
+                if data is None:
+                    return None # package loader cannot get resources
+                filename = os.path.join(
+                    os.path.dirname(sys.modules[self.package].__file__),
+                    *path.split("/"))
+            return filename, self.decode(data), get_file_version(filename)
+        return None
+
+    def get_version(self, filename):
+        # resources inside archives have no version, as they are not
+        # expected to change
+        return get_file_version(filename)
+
+    def iter_template_names(self):
+        if resource_files is None:
+            return
+        pending = [("", self.get_resource(""))]
+        names = []
+        while pending:
+            prefix, resource = pending.pop()
+            for child in resource.iterdir():
+                if child.is_dir():
+                    pending.append(("%s%s/" % (prefix, child.name), child))
+                else:
+                    names.append(prefix + child.name)
+        for name in self.iter_names(sorted(names)):
+            yield name
+
+
+class DictLoader(TemplateLoader):
+    '''
+    Template loader for in-memory mappings of template names to sources.
+    '''
+
+    def __init__(self, mapping, extensions=None):
+        '''
+        :param mapping: mapping of template names to sources, kept as given
+                        so later changes are honored
+        :param iterable extensions: optional template extensions
+        '''
+        super(DictLoader, self).__init__(extensions)
+        self.mapping = mapping
+
+    def load(self, name):
+        for candidate in self.iter_candidates(name):
+            source = self.mapping.get(candidate)
+            if source is not None:
+                return "<%s>" % candidate, source, hash(source)
+        return None
+
+    def get_version(self, filename):
+        source = self.mapping.get(filename[1:-1])
+        return None if source is None else hash(source)
+
+    def iter_template_names(self):
+        for name in sorted(self.mapping):
+            base, ext = os.path.splitext(name)
+            if ext in self.extensions:
+                yield base
+            yield name
+
+
+class TemplateFrozenError(TemplateNotFoundError):
+    pass
+
+
+class TemplateManager(object):
+    '''
+    Template manager is responsible of Template loading and caching, and should
+    be instanced once for your application.
 
     Please consider that template parsing, compiling and running is much slower
     than taken a precompiled template from cache, so using this class is
     absolutely recommended.
     '''
     template_class = Template
+    template_cache_class = TemplateCache
+    fragment_cache_class = FragmentCache
+    stats_class = TemplateManagerStats
+    profiler_class = TemplateProfiler
+    linker_class = TemplateLinker
+    bytecode_cache_class = BytecodeCache
+    globals_class = TemplateGlobals
+    filesystem_loader_class = FileSystemLoader
     notfound_error_class = TemplateNotFoundError
+    frozen_error_class = TemplateFrozenError
+    logger = logging.getLogger("stpl2")
     template_extensions = (".tpl", ".stpl")
+    reload_interval = 2.0 # minimum seconds between template source checks
+
+    @property
+    def globals(self):
+        '''
+        Variables available on every template, as a
+        :py:cvar:globals_class instance. Changes are seen by templates on
+        their next render, assigned dictionaries are converted.
+        '''
+        return self._globals
+
+    @globals.setter
+    def globals(self, value):
+        if not isinstance(value, self.globals_class):
+            value = self.globals_class(value)
+        self._globals = value
 
     @staticmethod
     def _ensure_set(obj):
@@ -1092,42 +4335,521 @@ class TemplateManager(object):
             return set(obj)
         return obj
 
-    def __init__(self, directories=None):
+    def __init__(self, directories=None, cache_directory=None, packages=None,
+                 auto_reload=False, max_templates=None, max_memory=None,
+                 flatten=False, output_encoding=None, fragment_cache=None,
+                 instrument=True, loaders=None, index_interval=None):
+        '''
+        :param directories: template directory or iterable of directories
+        :param str cache_directory: optional directory for persisting
+                                    compiled templates (see :py:class:BytecodeCache)
+        :param packages: package name or iterable of package names generated
+                         by :py:meth:compile_package, looked up in order
+                         before directories
+        :param bool auto_reload: whether check template files for changes,
+                                 at most once every :py:cvar:reload_interval
+                                 seconds, invalidating changed templates and
+                                 their dependents (see :py:meth:check_template)
+        :param int max_templates: optional maximum number of cached templates
+        :param int max_memory: optional maximum estimated memory of cached
+                               templates, in bytes (see :py:class:TemplateCache)
+        :param bool flatten: whether render linked templates, flattening
+                             their includes, extends and rebase (see
+                             :py:meth:get_flattened_template)
+        :param str output_encoding: optional ASCII-compatible encoding, making
+                                    :py:meth:render yield bytes with literals
+                                    encoded once (see :py:class:Template)
+        :param fragment_cache: optional cache backend for fragments rendered
+                               inside cache tokens, defaults to a new
+                               :py:cvar:fragment_cache_class instance
+        :param bool instrument: whether record runtime counters of manager
+                                and templates (see :py:attr:stats)
+        :param iterable loaders: optional template loaders (see
+                                 :py:class:TemplateLoader) looked up in order
+                                 after packages, replacing default
+                                 :py:cvar:filesystem_loader_class loader for
+                                 directories
+        :param float index_interval: optional seconds between rebuilds of an
+                                     in-memory index of directories, which
+                                     also remembers missing template names
+                                     (see :py:class:FileSystemLoader), also
+                                     applied to given loaders which are
+                                     :py:class:FileSystemLoader instances
+                                     without their own interval
+        '''
+        self.flatten = flatten
+        self.output_encoding = output_encoding
+        self.auto_reload = auto_reload
+        self._reload_state = {} # name: [filename, version, next check time, loader]
         self.directories = self._ensure_set(directories)
-        self.templates = {}
+        self.loaders = (
+            [self.filesystem_loader_class(
+                self.directories, self.template_extensions, index_interval)]
+            if loaders is None else list(loaders)
+            )
+        if loaders is not None and index_interval is not None:
+            indexed = [
+                loader for loader in self.loaders
+                if isinstance(loader, FileSystemLoader)]
+            for loader in indexed:
+                if loader.index_interval is None:
+                    loader.index_interval = index_interval
+            if not indexed:
+                self.logger.warning(
+                    "index_interval ignored, as no FileSystemLoader is given")
+        self.packages = (
+            [packages] if isinstance(packages, native_string_bases) else
+            list(packages or ())
+            )
+        self._package_indexes = None
+        self.frozen = False # see freeze
+        self.frozen_strict = True
+        self.templates = self.template_cache_class(max_templates, max_memory)
+        self.globals = {} # available on every template, see TemplateContext
+        self.memoized = {} # name: memoization options, see set_memoize
+        self.stats = self.stats_class() if instrument else None
+        self.fragment_cache = (
+            self.fragment_cache_class()
+            if fragment_cache is None else fragment_cache
+            )
+        self.bytecode_cache = (
+            self.bytecode_cache_class(cache_directory)
+            if cache_directory else None
+            )
 
     def get_template(self, name):
         '''
-        Get template object from given name from cache, template directories, or path.
+        Get template object from given name from cache, compiled packages or
+        template loaders (template directories or path by default).
 
         Note that template is cached based on given name, so if you pass to this method an absolute path, it will be the key from cache.
 
         :param str name: name of template (path or name if extension is in :py:cvar:template_extensions)
         :return Template: template object
         '''
-        if not name in self.templates:
-            template_path = None
-            if not os.path.isabs(name):
-                for directory in self.directories:
-                    path = os.path.join(directory, name)
-                    if os.path.isfile(path):
-                        template_path = path
-                        break
-                    for ext in self.template_extensions:
-                        extpath = path + ext
-                        if os.path.isfile(extpath):
-                            template_path = extpath
-                            break
-                    else:
-                        continue
-                    break
-            elif os.path.exists(name):
-                template_path = name
-            if template_path is None:
+        if self.auto_reload:
+            state = self._reload_state.get(name)
+            if state is not None and state[2] <= time.time():
+                self.check_template(name)
+        template = self.templates.get(name)
+        if template is not None:
+            if self.stats is not None:
+                self.stats.hits += 1
+            return template
+        if self.frozen and self.frozen_strict:
+            raise self.frozen_error_class(
+                "Template %r not loaded before freezing manager" % name)
+        start = timer()
+        template = self.get_package_template(name) if self.packages else None
+        if template:
+            self.add_template(name, template)
+        else:
+            found = self.find_template_source(name)
+            if found is None:
                 raise self.notfound_error_class("Template %r not found" % name)
-            with open(template_path) as f:
-                self.templates[name] = Template(f.read(), template_path, self)
-        return self.templates[name]
+            loader, filename, code, version = found
+            template = self.template_class(code, filename, self)
+            self.add_template(name, template, loader, version)
+        if self.frozen:
+            self.logger.warning(
+                "Template %r loaded after freezing manager", name)
+        if self.stats is not None:
+            self.stats.add_load(name, template, timer() - start)
+        return template
+
+    def add_template(self, name, template, loader=None, version=None):
+        '''
+        Add template object to cache, applying memoization options (see
+        :py:meth:set_memoize) and watching its source if :py:attr:auto_reload
+        is enabled.
+
+        :param str name: name of template
+        :param Template template: template object
+        :param TemplateLoader loader: optional loader template was loaded from
+        :param version: source version token given by loader (see
+                        :py:meth:TemplateLoader.get_version)
+        '''
+        if name in self.memoized:
+            template.set_memoize(**self.memoized[name])
+        self.templates[name] = template
+        if self.auto_reload and loader is not None:
+            self._reload_state[name] = [
+                template.filename, version, time.time() + self.reload_interval,
+                loader]
+
+    def find_template_source(self, name):
+        '''
+        Find template source for given name on template loaders.
+
+        :param str name: name of template
+        :return tuple: loader, template filename, source and version token,
+                       or None if not found
+        '''
+        for loader in self.loaders:
+            found = loader.load(name)
+            if found is not None:
+                return (loader,) + tuple(found)
+        return None
+
+    def find_template_path(self, name):
+        '''
+        Find template filename for given name on template loaders.
+
+        :param str name: name of template (path or name if extension is in :py:cvar:template_extensions)
+        :return str: template filename or None if not found
+        '''
+        for loader in self.loaders:
+            filename = loader.find(name)
+            if filename is not None:
+                return filename
+        return None
+
+    def check_template(self, name):
+        '''
+        Check if template source, or any of its dependencies' (see
+        :py:attr:Template.dependencies), changed since loaded, invalidating
+        them along with their dependents (see :py:meth:invalidate).
+
+        Every template file is checked at most once every
+        :py:cvar:reload_interval seconds.
+
+        :param str name: name of template
+        :return set: invalidated template names
+        '''
+        now = time.time()
+        invalidated = set()
+        visited = set()
+        pending = [name]
+        while pending:
+            current = pending.pop()
+            if current in visited or current in invalidated:
+                continue
+            visited.add(current)
+            state = self._reload_state.get(current)
+            if state and state[2] <= now:
+                state[2] = now + self.reload_interval
+                if state[3].get_version(state[0]) != state[1]:
+                    invalidated.update(self.invalidate(current))
+                    continue
+            template = self.templates.get(current)
+            if template:
+                pending.extend(template.dependencies)
+        return invalidated
+
+    def invalidate(self, name):
+        '''
+        Remove template from cache, along with all cached templates depending
+        on it (see :py:attr:Template.dependencies).
+
+        :param str name: name of template
+        :return set: invalidated template names
+        '''
+        invalidated = set()
+        pending = [name]
+        while pending:
+            current = pending.pop()
+            if current in invalidated:
+                continue
+            invalidated.add(current)
+            self.templates.pop(current, None)
+            self._reload_state.pop(current, None)
+            pending.extend(
+                dependent
+                for dependent, template in self.templates.items()
+                if current in template.dependencies
+                )
+        return invalidated
+
+    def get_package_template(self, name):
+        '''
+        Get template object from compiled packages (see :py:attr:packages).
+
+        :param str name: name of template
+        :return Template: template object or None if not found
+        '''
+        if self._package_indexes is None:
+            self._package_indexes = [
+                (package, importlib.import_module(package).templates)
+                for package in self.packages
+                ]
+        for package, index in self._package_indexes:
+            if name in index:
+                return self.template_class.from_module(
+                    "%s.%s" % (package, index[name]), self)
+        return None
+
+    def iter_template_names(self):
+        '''
+        Iterate over names of all templates found on template loaders (see
+        :py:meth:TemplateLoader.iter_template_names), both with and without
+        extension.
+
+        :yields str: template names
+        '''
+        for loader in self.loaders:
+            for name in loader.iter_template_names():
+                yield name
+
+    def warmup(self, processes=None):
+        '''
+        Compile all templates found on template loaders (see
+        :py:meth:iter_template_names) not loaded yet, translating and
+        compiling them on a pool of worker processes, then add them to
+        :py:attr:templates in dependency order (see
+        :py:attr:Template.dependencies) so templates come before their
+        dependents. Compiled templates are also written to bytecode cache,
+        if enabled.
+
+        :param int processes: number of worker processes, defaults to CPU
+                              count, templates are compiled in this process
+                              if 1 or less
+        :returns OrderedDict: template names, in order of addition followed
+                              by failed ones, to dicts with compilation time
+                              in seconds and error (or None)
+        '''
+        sources = collections.OrderedDict() # filename: (names, code, loader, version)
+        for name in self.iter_template_names():
+            if name in self.templates:
+                continue
+            found = self.find_template_source(name)
+            if found is None:
+                continue
+            loader, filename, code, version = found
+            if filename in sources:
+                sources[filename][0].append(name)
+            else:
+                sources[filename] = ([name], code, loader, version)
+
+        tasks = [
+            (self.template_class, code, filename)
+            for filename, (names, code, loader, version) in sources.items()
+            ]
+        if len(tasks) < 2 or processes is not None and processes <= 1:
+            results = [compile_template_state(task) for task in tasks]
+        else:
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = pool.map(compile_template_state, tasks)
+            finally:
+                pool.close()
+                pool.join()
+
+        failed = collections.OrderedDict()
+        compiled = collections.OrderedDict() # name: (template, loader, version)
+        times = {}
+        for (filename, (names, code, loader, version)), (data, elapsed, error) in zip(
+          sources.items(), results):
+            state = None if error else marshal.loads(data)
+            for name in names:
+                if error:
+                    failed[name] = {"time": elapsed, "error": error}
+                    continue
+                template = self.template_class(code, filename, self, state)
+                compiled[name] = (template, loader, version)
+                times[name] = elapsed
+            if state is not None and self.bytecode_cache is not None:
+                self.bytecode_cache.dump(template)
+
+        report = collections.OrderedDict()
+        pending = list(compiled)
+        while pending:
+            names = frozenset(pending)
+            ready = [
+                name for name in pending
+                if names.isdisjoint(compiled[name][0].dependencies)
+                ] or pending # circular dependencies
+            for name in ready:
+                self.add_template(name, *compiled[name])
+                report[name] = {"time": times[name], "error": None}
+            pending = [name for name in pending if not name in report]
+        report.update(failed)
+        return report
+
+    def freeze(self, contexts=0, variants=None, strict=True, processes=None):
+        '''
+        Prepare manager to be inherited by forked worker processes (as
+        preloading web servers do), so most of its memory pages are kept
+        shared on copy-on-write:
+
+        * All templates found on loaders are compiled (see :py:meth:warmup),
+          along with given code variants and flattened templates if
+          :py:attr:flatten is enabled.
+        * Given number of idle contexts is created on every template pool.
+        * Template cache bounds are removed, so templates are neither
+          evicted nor reordered, and auto reload is disabled.
+        * Garbage is collected, and remaining objects are moved to permanent
+          generation (see :py:func:gc.freeze, python 3.7 or newer), so
+          garbage collections on workers do not write to them.
+
+        Later loads of templates not loaded yet raise
+        :py:cvar:frozen_error_class, or are logged if not strict. Note that
+        reference counts are still written when objects are used, so pages
+        holding used objects become private anyway on python older than 3.12.
+
+        :param int contexts: number of idle contexts created for every
+                             template and code variant
+        :param iterable variants: code variants to compile and create
+                                  contexts for (see :py:meth:Template.get_variant),
+                                  defaults to :py:attr:Template.output_variant
+        :param bool strict: False to log later loads instead of failing
+        :param int processes: number of warmup worker processes
+        :returns OrderedDict: warmup report (see :py:meth:warmup), also
+                              including errors of flattened templates
+        '''
+        self.templates.maxsize = self.templates.maxmemory = None
+        report = self.warmup(processes)
+        self.auto_reload = False
+        self._reload_state.clear()
+        for name, template in list(self.templates.items()):
+            try:
+                if self.flatten:
+                    template = self.get_flattened_template(name)
+                if template.static:
+                    continue
+                for variant in variants or (template.output_variant,):
+                    template.get_pool(variant).prewarm(contexts)
+            except Exception as e:
+                report[name] = dict(report.get(name, {"time": 0}), error=e)
+        self.frozen = True
+        self.frozen_strict = strict
+        gc.collect()
+        if hasattr(gc, "freeze"):
+            gc.freeze()
+        return report
+
+    def compile_package(self, path):
+        '''
+        Translate all templates from template loaders to an importable
+        python package at given path, with a module per template, to be used
+        with :py:attr:packages. Modules record their build signature (see
+        :py:meth:Template.get_build_signature).
+
+        :param str path: package directory, created if not exists
+        :returns dict: template names to module names
+        '''
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        index = {}
+        modules = {}
+        for name in self.iter_template_names():
+            template = self.get_template(name)
+            if template.filename in modules:
+                index[name] = modules[template.filename]
+                continue
+            module = "template_%d_%s" % (
+                len(modules), re.sub(r"\W", "_", name).lower())
+            with open(os.path.join(path, module + ".py"), "wb") as f:
+                f.write(template.get_module_source().encode("utf-8"))
+            index[name] = modules[template.filename] = module
+        with open(os.path.join(path, "__init__.py"), "w") as f:
+            f.write(
+                "# -*- coding: UTF-8 -*-\n"
+                "# Generated by stpl2 TemplateManager.compile_package\n"
+                "build = %r\n"
+                "templates = {\n" % self.template_class.get_build_signature()
+                )
+            for name in sorted(index):
+                f.write("    %r: %r,\n" % (name, index[name]))
+            f.write("}\n")
+        return index
+
+    def memory_usage(self):
+        '''
+        Estimate memory used by cached templates, including their pooled
+        contexts.
+
+        :returns dict: template names and sizes in bytes
+        '''
+        return self.templates.memory_usage()
+
+    def get_flattened_template(self, name):
+        '''
+        Get flattened template (see :py:class:TemplateLinker) for given name,
+        linked once and relinked when any of its member templates changes.
+        If template cannot be linked, template itself is returned.
+
+        :param str name: name of template
+        :return Template: flattened template object
+        '''
+        template = self.get_template(name)
+        flattened = template.flattened
+        if flattened is not None and flattened is not template:
+            for member, member_template in flattened.linked_members:
+                if self.templates.get(member) is not member_template:
+                    flattened = None
+                    break
+        if flattened is None:
+            flattened = self.linker_class(self).link_template(name) or template
+            if flattened is not template and name in self.memoized:
+                flattened.set_memoize(**self.memoized[name])
+            template.flattened = flattened
+        return flattened
+
+    def profile(self, **options):
+        '''
+        Get a template line profiler for this manager templates (see
+        :py:class:TemplateProfiler), started when used as context manager.
+
+        :param options: additional profiler options
+        :returns TemplateProfiler: profiler
+        '''
+        return self.profiler_class(self, **options)
+
+    def set_memoize(self, name, enabled=True, **options):
+        '''
+        Enable or disable render output memoization for given template (see
+        :py:meth:Template.set_memoize), kept for reloaded templates.
+
+        :param str name: name of template
+        :param bool enabled: False to disable memoization
+        :param options: ttl, keys and maxsize options
+        '''
+        if enabled:
+            self.memoized[name] = options
+        else:
+            self.memoized.pop(name, None)
+        template = self.templates.get(name)
+        if template is not None:
+            for current in set((template, template.flattened)):
+                if current is not None:
+                    current.set_memoize(enabled, **options)
+
+    def get_stats(self):
+        '''
+        Get snapshot of manager counters (see
+        :py:meth:TemplateManagerStats.snapshot) if :py:attr:stats is enabled,
+        along with counters of every loaded template (see
+        :py:meth:Template.get_stats), suitable for exporting to metrics
+        systems.
+
+        :returns dict: counters, with template counters by name on
+                       "templates", and flattened template counters on
+                       "flattened" if any
+        '''
+        stats = {} if self.stats is None else self.stats.snapshot()
+        stats["templates"] = templates = {}
+        for name, template in list(self.templates.items()):
+            templates[name] = template_stats = template.get_stats()
+            flattened = template.flattened
+            if flattened is not None and flattened is not template:
+                template_stats["flattened"] = flattened.get_stats()
+        return stats
+
+    def memoize_stats(self):
+        '''
+        Get render memoization counters of loaded templates with memoization
+        enabled (see :py:meth:Template.memoize_stats).
+
+        :returns dict: counters by template name
+        '''
+        stats = {}
+        for name in self.memoized:
+            template = self.templates.get(name)
+            if template is not None:
+                if self.flatten and template.flattened is not None:
+                    template = template.flattened
+                stats[name] = template.memoize_stats()
+        return stats
 
     def render(self, name, env=None):
         '''
@@ -1137,10 +4859,57 @@ class TemplateManager(object):
         :param dict env: optional variable dictionary
         :yield str: string with lines from rendered template
         '''
+        if self.flatten:
+            return self.get_flattened_template(name).render(env)
         return self.get_template(name).render(env)
 
+    def render_async(self, name, env=None):
+        '''
+        Render template corresponding to given name or path asynchronously
+        (see :py:meth:Template.render_async). Templates not yet loaded are
+        loaded using event loop's default executor.
+
+        :param str name: name or path for template
+        :param dict env: optional variable dictionary
+        :returns: asynchronous iterator of strings
+        '''
+        return render_manager_template(self, name, env)
+
+    def is_template_loaded(self, name):
+        '''
+        Get if template for given name (flattened if :py:attr:flatten is
+        enabled) can be retrieved without accessing any file.
+
+        :param str name: name or path for template
+        :returns bool: True if template is loaded
+        '''
+        template = self.templates.get(name)
+        if template is None:
+            return False
+        if self.auto_reload:
+            state = self._reload_state.get(name)
+            if state is not None and state[2] <= time.time():
+                return False
+        if self.flatten and template.flattened is None:
+            return False
+        return True
+
+    def render_string(self, name, env=None):
+        '''
+        Render template corresponding to given name or path as string (see
+        :py:meth:Template.render_string).
+
+        :param str name: name or path for template
+        :param dict env: optional variable dictionary
+        :return str: rendered template
+        '''
+        if self.flatten:
+            return self.get_flattened_template(name).render_string(env)
+        return self.get_template(name).render_string(env)
+
     def reset(self):
         '''
         Clear template cache.
         '''
         self.templates.clear()
+        self._reload_state.clear()
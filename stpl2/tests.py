@@ -4,16 +4,43 @@
 import unittest
 import tempfile
 import shutil
+import sys
+import gc
+import time
+import weakref
+import zlib
+import zipfile
+import threading
 import os.path
 
 from .internal import *
 
+if async_supported:
+    import asyncio
+
+
+def consume_async(loop, iterator):
+    '''
+    Consume async iterator on given event loop, without python 3.6 syntax
+    so this module can be compiled on older pythons.
+    '''
+    lines = []
+    iterator = iterator.__aiter__()
+    while True:
+        try:
+            lines.append(loop.run_until_complete(iterator.__anext__()))
+        except StopAsyncIteration:
+            return lines
+
 if py3k:
+    from io import StringIO
     xrange = range
 
     def to_native(text):
         return text
 else:
+    from StringIO import StringIO
+
     def to_native(text):
         return text.encode('utf-8')
 
@@ -70,6 +97,28 @@ class TestCodeTranslator(unittest.TestCase):
         args = CodeTranslator.token_params('(mixed, key=value, params)', 3)
         self.assertEqual(args, (['mixed', 'params'], {'key':'value'}, ''))
 
+    def testVars(self):
+        spans = lambda line: [
+            line[start:end] for start, end in self.translator.iter_var_spans(line)]
+        self.assertEqual(spans('{{ "}}" }} {{ a }}\n'), ['{{ "}}" }}', '{{ a }}'])
+        self.assertEqual(spans('{{ \'it\\\'s\' }}\n'), ['{{ \'it\\\'s\' }}'])
+        self.assertEqual(spans('{{ it\'s }} {{ b }}\n'), ['{{ it\'s }}', '{{ b }}'])
+        self.assertEqual(spans('{{ "}}" {{ a\n'), ['{{ "}}'])
+        self.assertEqual(spans('{{ a }\n'), [])
+        # Unclosed variables with many string literals
+        line = '{{ a }} {{ %s\n' % ' '.join(['"b" \'c\''] * 1000)
+        self.assertEqual(spans(line), ['{{ a }}'])
+        self.translator.reset()
+        self.assertEqual(self.translator.translate_vars('%' + line), '%%%s' + line[7:])
+
+    def testCheckIndent(self):
+        self.assertTrue(self.translator.check_indent('if a:\n'))
+        self.assertTrue(self.translator.check_indent('if a: # comment\n'))
+        self.assertTrue(self.translator.check_indent('if a == ":":\n'))
+        self.assertTrue(self.translator.check_indent('for b in {"c:"}:\n'))
+        self.assertFalse(self.translator.check_indent('if a: b()\n'))
+        self.assertFalse(self.translator.check_indent('if a == ":": b()\n'))
+
 
 class TestTemplateBase(unittest.TestCase):
     template_class = None
@@ -99,6 +148,30 @@ class TestTemplate(TestTemplateBase):
             '{{\'{{a}}',
             ''])
 
+    def testLineMap(self):
+        template = self.template_class('A\n% for i in range(2):\n{{ i }}\n% end\n')
+        pycode = template.pycode.splitlines()
+        line_map = template.get_line_map()
+        self.assertEqual(len(line_map), len(pycode))
+        self.assertEqual(line_map[pycode.index(next(line for line in pycode if 'for i' in line))], 2)
+        self.assertEqual(list(template.get_line_map('string')), list(
+            Template.build_line_map(template.get_pycode('string'))))
+        restored = self.template_class(template.code, compiled_state=template.get_compiled_state())
+        self.assertEqual(list(restored.get_line_map()), list(line_map))
+
+    def testPycode(self):
+        template = self.template_class('A\n% for i in range(2):\n{{ i }}\n% end\n')
+        # Generated code is translated again on demand
+        self.assertIsNone(template.get_compiled_state()[0])
+        self.assertEqual(template.pycode, ''.join(
+            template.translate_class().translate_code(template.code)))
+        self.assertIn('_append((', template.get_pycode('string'))
+        # Compressed code, from states of previous versions
+        state = (zlib.compress(b'# code'),) + template.get_compiled_state()[1:]
+        restored = self.template_class(template.code, compiled_state=state)
+        self.assertEqual(restored.pycode, '# code')
+        self.assertEqual(restored.render_string(), 'A\n0\n1\n')
+
     def testEmpty(self):
         self.assertEqual(self.execute(""), "")
         self.assertEqual(self.execute("% block a\n% end"), "")
@@ -171,6 +244,575 @@ class TestTemplate(TestTemplateBase):
         code = "% extends something"
         self.assertRaises(TemplateContextError, self.execute, code)
 
+    def testNamespace(self):
+        code = (
+            "{{ defined('a') }} {{ defined('len') }} {{ defined('b') }}\n"
+            "{{ get('a') }} {{ get('b', 2) }} {{ setdefault('c', 3) }} {{ c }}\n"
+            "{{ len(a) }}"
+            )
+        template = self.template_class(code)
+        for i in range(2): # pooled context
+            self.assertEqual(''.join(template.render({'a': 'x'})),
+                             'True True False\nx 2 3 3\n1')
+        self.assertEqual(''.join(template.render({'a': 'x', 'len': lambda v: 'y'})),
+                         'True True False\nx 2 3 3\ny')
+
+
+class TestEscape(unittest.TestCase):
+    class Markup(str):
+        def __html__(self):
+            return self
+
+    class Custom(object):
+        def __str__(self):
+            return '<custom & "quoted">'
+
+    values = (
+        0, -1, 2**70, 1.5, float('inf'), True, False, None, '', 'plain',
+        '<tag attr="value">', "it's & that", u'\u00f1 <\u00e1>', Custom(),
+        ['<list>'], {'a': '&'}, (1,), 1j,
+        )
+
+    if py3k:
+        @staticmethod
+        def reference(data):
+            import html
+            return html.escape('%s' % data)
+    else:
+        @staticmethod
+        def reference(data):
+            import cgi
+            return cgi.escape('%s' % data, quote=True).replace("'", "&apos;")
+
+    def testIdentical(self):
+        for value in self.values:
+            self.assertEqual(escape_html_safe(value), self.reference(value))
+            self.assertIs(type(escape_html_safe(value)), type(self.reference(value)))
+
+    def testMarkup(self):
+        markup = self.Markup('<b>bold</b>')
+        self.assertEqual(escape_html_safe(markup), '<b>bold</b>')
+        self.assertEqual(
+            ''.join(Template('{{ a }} {{ b }}').render({'a': markup, 'b': '<b>'})),
+            '<b>bold</b> &lt;b&gt;')
+
+
+class TestStaticTemplate(unittest.TestCase):
+    def testDetection(self):
+        static = ("", "Static\n100%\n", "a\n\nb")
+        dynamic = ("{{ a }}", "% pass", "a<% pass %>b", "% include a",
+                   "% block a\n% end", "<% pass %>")
+        for code in static:
+            self.assertTrue(Template(code).static, code)
+        for code in dynamic:
+            self.assertFalse(Template(code).static, code)
+
+    def testRender(self):
+        class DynamicTemplate(Template):
+            def compile(self):
+                Template.compile(self)
+                self.static = False
+
+        for code in ("", "Static\n100%\n", "a\n\nb"):
+            template = Template(code)
+            self.assertEqual(
+                list(template.render()),
+                list(DynamicTemplate(code).render()))
+            self.assertEqual(template.pool_stats()['created'], 0)
+
+    def testInclude(self):
+        manager = TemplateManager()
+        manager.templates['static'] = Template("Static\n", manager=manager)
+        manager.templates['page'] = Template(
+            "% include static\n{{ include('static') }}", manager=manager)
+        self.assertEqual(''.join(manager.render('page')), 'Static\nStatic\n')
+        self.assertFalse(manager.templates['static'].in_use)
+
+    def testStaticFile(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            template = Template("Static \u00f1\n")
+            path = template.get_static_file(tmpdir)
+            self.assertEqual(os.path.dirname(path), tmpdir)
+            with open(path, "rb") as f:
+                self.assertEqual(f.read().decode("utf-8"), template.static_output)
+            self.assertEqual(template.get_static_file(tmpdir), path)
+            self.assertRaises(TemplateValueError, Template("{{ 1 }}").get_static_file)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class TestRenderString(unittest.TestCase):
+    def setUp(self):
+        self.manager = TemplateManager()
+        for name, code in TestTemplateLinker.sources.items():
+            self.manager.templates[name] = Template(code, manager=self.manager)
+
+    def assertRenderString(self, name, env=None):
+        self.assertEqual(
+            self.manager.render_string(name, env),
+            ''.join(self.manager.render(name, env)))
+
+    def testRender(self):
+        for name in TestTemplateLinker.sources:
+            if name != 'layout':  # rebase-only template
+                self.assertRenderString(name, {'a': 1})
+        self.assertEqual(
+            self.manager.get_template('template').get_pool('string').stats()['created'],
+            1)
+
+    def testStatic(self):
+        template = Template("Static\n")
+        self.assertEqual(template.render_string(), "Static\n")
+        self.assertEqual(template.pool_stats()['created'], 0)
+
+    def testGeneratorFallback(self):
+        self.manager.templates['yield'] = Template(
+            'a\n<% yield "b" %>\n% include header\n', manager=self.manager)
+        self.assertRenderString('yield', {'a': 1})
+        template = self.manager.templates['yield']
+        self.assertIsNone(template.get_variant('string'))
+        self.assertIs(template.get_pool('string'), template.get_pool())
+
+    def testFlatten(self):
+        manager = TemplateManager(flatten=True)
+        manager.templates.update(self.manager.templates)
+        self.assertEqual(manager.render_string('template', {'a': 1}),
+                         self.manager.render_string('template', {'a': 1}))
+
+    def testTemplateRuntimeError(self):
+        self.manager.templates['b'] = Template('\n% a = b', manager=self.manager)
+        self.manager.templates['c'] = Template('% include b', manager=self.manager)
+        for name in ('b', 'c'):
+            try:
+                self.manager.render_string(name)
+            except TemplateRuntimeError as e:
+                self.assertEqual(e.lineno, 2)
+                self.assertIn('_append', '\n'.join(e.pycode))
+            else:
+                self.fail('TemplateRuntimeError not raised')
+            self.assertFalse(self.manager.templates[name].in_use)
+
+
+@unittest.skipUnless(async_supported, "requires python 3.6")
+class TestRenderAsync(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.manager = TemplateManager(self.tmpdir)
+        for name, code in TestTemplateLinker.sources.items():
+            self.manager.templates[name] = Template(code, manager=self.manager)
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        shutil.rmtree(self.tmpdir)
+
+    def execute(self, iterator):
+        return ''.join(consume_async(self.loop, iterator))
+
+    def testRender(self):
+        for name in TestTemplateLinker.sources:
+            if name != 'layout':  # rebase-only template
+                self.assertEqual(
+                    self.execute(self.manager.render_async(name, {'a': 1})),
+                    ''.join(self.manager.render(name, {'a': 1})))
+        self.assertEqual(self.execute(Template("Static\n").render_async()), "Static\n")
+
+    def testAwait(self):
+        def value():
+            future = self.loop.create_future()
+            future.set_result('<b>')
+            return future
+        template = Template('{{ a() }} {{ !a() }} {{ b }}\n')
+        self.assertEqual(
+            self.execute(template.render_async({'a': value, 'b': 1})),
+            '&lt;b&gt; <b> 1\n')
+
+    def testLoad(self):
+        with open(os.path.join(self.tmpdir, 'disk.tpl'), 'w') as f:
+            f.write('Disk\n% include header\n')
+        self.assertFalse(self.manager.is_template_loaded('disk'))
+        self.assertEqual(
+            self.execute(self.manager.render_async('disk', {'a': 1})), 'Disk\n1\n')
+        self.assertTrue(self.manager.is_template_loaded('disk'))
+
+    def testTemplateRuntimeError(self):
+        self.manager.templates['b'] = Template('\n% a = b', manager=self.manager)
+        self.manager.templates['c'] = Template('% include b', manager=self.manager)
+        for name in ('b', 'c'):
+            try:
+                self.execute(self.manager.render_async(name))
+            except TemplateRuntimeError as e:
+                self.assertEqual(e.lineno, 2)
+            else:
+                self.fail('TemplateRuntimeError not raised')
+            self.assertFalse(self.manager.templates[name].in_use)
+
+
+@unittest.skipUnless(bytes_supported, "requires python 3.5")
+class TestBytesOutput(unittest.TestCase):
+    def setUp(self):
+        self.manager = TemplateManager(output_encoding='utf-8')
+        self.reference = TemplateManager()
+        for manager in (self.manager, self.reference):
+            for name, code in TestTemplateLinker.sources.items():
+                manager.templates[name] = Template(code, manager=manager)
+            manager.templates['static'] = Template('Static \u00f1\n', manager=manager)
+            manager.templates['mixed'] = Template(
+                '\u00f1 {{ a }} 100%\n{{ !b }} {{ !c }}\n% include static\n',
+                manager=manager)
+
+    def testRender(self):
+        env = {'a': '<\u00e1>', 'b': b'<raw>', 'c': '\u00e9'}
+        for name in self.reference.templates:
+            if name != 'layout':  # rebase-only template
+                lines = list(self.manager.render(name, env))
+                for line in lines:
+                    self.assertIsInstance(line, bytes)
+                self.assertEqual(
+                    b''.join(lines).decode('utf-8'),
+                    ''.join(self.reference.render(name, env)).replace("b'<raw>'", '<raw>'))
+
+    def testLiterals(self):
+        template = self.manager.templates['mixed']
+        self.assertIn(repr('\u00f1 %s 100%%\n'.encode('utf-8')), template.get_pycode('bytes'))
+
+    def testEncoding(self):
+        class Latin1Template(Template):
+            output_encoding = 'latin-1'
+        template = Latin1Template('\u00f1 {{ a }}\n')
+        self.assertEqual(b''.join(template.render({'a': '\u00e1'})), b'\xf1 \xe1\n')
+        self.assertEqual(list(Latin1Template('\u00f1\n').render()), [b'\xf1\n'])
+        self.assertRaises(TemplateValueError, CodeTranslator, 'bytes', 'utf-16')
+
+    def testBuffering(self):
+        class BytesBufferingTemplate(BufferingTemplate):
+            output_encoding = 'utf-8'
+            buffersize = 4
+        template = BytesBufferingTemplate('% for i in range(5):\n{{ i }}\n% end\n')
+        self.assertEqual(list(template.render()), [b'0\n1\n', b'2\n3\n', b'4\n'])
+
+    def testTemplateRuntimeError(self):
+        self.manager.templates['b'] = Template('\n% a = b', manager=self.manager)
+        try:
+            list(self.manager.render('b'))
+        except TemplateRuntimeError as e:
+            self.assertEqual(e.lineno, 2)
+        else:
+            self.fail('TemplateRuntimeError not raised')
+
+
+class TestFragmentCache(unittest.TestCase):
+    def setUp(self):
+        self.manager = TemplateManager()
+        self.calls = []
+        self.manager.globals['call'] = self.calls.append
+        self.manager.templates['page'] = Template(
+            'Page\n'
+            '% for i in range(2):\n'
+            '% cache "nav", i, ttl=ttl\n'
+            '% call(i)\n'
+            'Nav {{ i }} {{ a }}\n'
+            '% end\n'
+            '% end\n'
+            '% cache("empty")\n'
+            '% end\n'
+            'End {{ a }}\n',
+            manager=self.manager)
+
+    def render(self, a=1, ttl=None):
+        return ''.join(self.manager.render('page', {'a': a, 'ttl': ttl}))
+
+    def testCache(self):
+        self.assertEqual(self.render(), 'Page\nNav 0 1\nNav 1 1\nEnd 1\n')
+        self.assertEqual(self.calls, [0, 1])
+        self.assertEqual(self.render(2), 'Page\nNav 0 1\nNav 1 1\nEnd 2\n')
+        self.assertEqual(self.calls, [0, 1])
+        namespace = self.manager.templates['page'].fragment_namespace
+        self.assertEqual(self.manager.fragment_cache.get((namespace, ("nav", 1))), 'Nav 1 1\n')
+        self.manager.fragment_cache.delete((namespace, ("nav", 1)))
+        self.assertEqual(self.render(2), 'Page\nNav 0 1\nNav 1 2\nEnd 2\n')
+        self.assertEqual(self.calls, [0, 1, 1])
+
+    def testVariants(self):
+        reference = self.render()
+        self.assertEqual(self.manager.render_string('page', {'a': 2, 'ttl': None}),
+                         reference.replace('End 1', 'End 2'))
+        if bytes_supported:
+            manager = TemplateManager(output_encoding='utf-8', fragment_cache=self.manager.fragment_cache)
+            manager.globals['call'] = self.calls.append
+            manager.templates['page'] = Template(self.manager.templates['page'].code, manager=manager)
+            self.assertEqual(b''.join(manager.render('page', {'a': 1, 'ttl': None})), reference.encode('utf-8'))
+        self.assertEqual(self.calls, [0, 1])
+        self.manager.fragment_cache.clear()
+        self.assertEqual(self.manager.render_string('page', {'a': 1, 'ttl': 60}), reference)
+        self.assertEqual(self.calls, [0, 1, 0, 1])
+
+    def testStreaming(self):
+        self.manager.templates['stream'] = Template(
+            '% cache "stream"\nFirst\n% call(0)\nSecond\n% end\n', manager=self.manager)
+        lines = self.manager.render('stream')
+        self.assertEqual(next(lines), 'First\n')
+        self.assertEqual(self.calls, [])
+        lines.close()
+        namespace = self.manager.templates['stream'].fragment_namespace
+        self.assertIsNone(self.manager.fragment_cache.get((namespace, "stream")))
+
+    def testFlatten(self):
+        manager = TemplateManager(flatten=True)
+        manager.globals['call'] = self.calls.append
+        manager.templates['header'] = Template('% cache "header"\n% call("h")\nHeader\n% end\n', manager=manager)
+        manager.templates['page'] = Template('% include header\n% cache "page"\n% call("p")\nPage\n% end\n', manager=manager)
+        for i in range(2):
+            self.assertEqual(''.join(manager.render('page')), 'Header\nPage\n')
+        self.assertIsNot(manager.get_flattened_template('page'), manager.get_template('page'))
+        self.assertEqual(self.calls, ['h', 'p'])
+
+    def testNamespace(self):
+        self.manager.templates['other'] = Template(
+            '% cache "nav", 0\nOther\n% end\n', manager=self.manager)
+        self.assertEqual(self.render(), 'Page\nNav 0 1\nNav 1 1\nEnd 1\n')
+        self.assertEqual(''.join(self.manager.render('other')), 'Other\n')
+        self.assertEqual(self.render(), 'Page\nNav 0 1\nNav 1 1\nEnd 1\n')
+
+    def testZeroTTL(self):
+        for i in range(2):
+            self.assertEqual(self.render(ttl=0), 'Page\nNav 0 1\nNav 1 1\nEnd 1\n')
+        self.assertEqual(self.calls, [0, 1, 0, 1])
+
+    def testExpiration(self):
+        cache = FragmentCache(maxsize=2)
+        cache.set('z', 'Z')
+        cache.set('z', 'Z', ttl=0)
+        self.assertIsNone(cache.get('z'))
+        cache.set('a', 'A', ttl=-1)
+        cache.set('b', 'B', ttl=60)
+        cache.set('c', 'C')
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual((cache.get('b'), cache.get('c')), ('B', 'C'))
+        cache.get('b')
+        cache.set('d', 'D')
+        self.assertEqual((cache.get('b'), cache.get('c')), ('B', None))
+
+    def testSyntax(self):
+        self.assertRaises(TemplateValueError, Template, '% cache\n% end\n')
+        self.assertRaises(TemplateSyntaxError, Template, '% cache "a"\nA\n')
+
+    def testTemplateRuntimeError(self):
+        self.manager.templates['error'] = Template(
+            '% cache "error"\n% undefined()\n% end\n', manager=self.manager)
+        try:
+            self.render() and ''.join(self.manager.render('error'))
+        except TemplateRuntimeError as e:
+            self.assertEqual(e.lineno, 2)
+        else:
+            self.fail('TemplateRuntimeError not raised')
+        namespace = self.manager.templates['error'].fragment_namespace
+        self.assertIsNone(self.manager.fragment_cache.get((namespace, "error")))
+
+
+class TestMemoize(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.template = Template('% call(a)\nA {{ a }}\n')
+        self.template.set_memoize()
+
+    def render(self, **env):
+        env.setdefault('call', self.calls.append)
+        return ''.join(self.template.render(env))
+
+    def testMemoize(self):
+        # bound list methods are unhashable before python 3.8
+        def call(value):
+            self.calls.append(value)
+        self.assertEqual(self.render(a=1, call=call), 'A 1\n')
+        self.assertEqual(self.render(a=1, call=call), 'A 1\n')
+        self.assertEqual(self.render(a=2, call=call), 'A 2\n')
+        self.assertEqual(self.calls, [1, 2])
+        self.assertEqual(self.render(a=[1]), 'A [1]\n')
+        self.assertEqual(self.template.memoize_stats(), {
+            'enabled': True, 'size': 2, 'hits': 1, 'misses': 2, 'bypasses': 1})
+        self.template.set_memoize(False)
+        self.assertEqual(self.render(a=1, call=call), 'A 1\n')
+        self.assertEqual(self.calls, [1, 2, [1], 1])
+        self.assertFalse(self.template.memoize_stats()['enabled'])
+
+    def testOptions(self):
+        self.template.set_memoize(keys=('a',), maxsize=1)
+        for a in (1, 1, 2, 1, [1], [1]):
+            self.render(a=a)
+        self.assertEqual(self.calls, [1, 2, 1, [1], [1]])
+        self.template.set_memoize(ttl=-1)
+        self.render(a=1, call=self.calls.append)
+        self.render(a=1, call=self.calls.append)
+        self.assertEqual(self.calls[-2:], [1, 1])
+
+    def testEqualValues(self):
+        def call(value):
+            self.calls.append(value)
+        for a in (1, True, 1.0, 1):
+            self.assertEqual(self.render(a=a, call=call), 'A %s\n' % a)
+        self.template.set_memoize(keys=('a',))
+        for a in (1, True, 1.0, True):
+            self.assertEqual(self.render(a=a), 'A %s\n' % a)
+        self.assertEqual(self.calls, [1, True, 1.0, 1, True, 1.0])
+
+    def testPartialRender(self):
+        call = self.calls.append
+        lines = self.template.render({'a': 1, 'call': call})
+        self.assertEqual(next(lines), 'A 1\n')
+        lines.close()
+        self.template.set_memoize(keys=('a',))
+        self.assertRaises(TemplateRuntimeError, self.render, a=1, call=None)
+        self.assertEqual(self.render(a=1, call=call), 'A 1\n')
+        self.assertEqual(self.calls, [1, 1])
+        self.assertEqual(self.template.memoize_stats()['size'], 1)
+
+    def testManager(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(tmpdir, 'page.tpl'), 'w') as f:
+                f.write('% call(a)\nPage {{ a }}\n')
+            for flatten in (False, True):
+                manager = TemplateManager(tmpdir, flatten=flatten)
+                manager.globals['call'] = self.calls.append
+                manager.set_memoize('page', keys=('a',))
+                for i in range(2):
+                    self.assertEqual(''.join(manager.render('page', {'a': 1})), 'Page 1\n')
+                manager.invalidate('page')
+                self.assertEqual(''.join(manager.render('page', {'a': 1})), 'Page 1\n')
+                self.assertEqual(manager.memoize_stats()['page']['misses'], 1)
+                manager.set_memoize('page', False)
+                self.assertEqual(''.join(manager.render('page', {'a': 1})), 'Page 1\n')
+                self.assertEqual(manager.memoize_stats(), {})
+                self.assertEqual(self.calls, [1, 1, 1])
+                del self.calls[:]
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class TestStats(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        with open(os.path.join(self.tmpdir, 'page.tpl'), 'w') as f:
+            f.write('% include footer\nPage {{ a }}\n')
+        with open(os.path.join(self.tmpdir, 'footer.tpl'), 'w') as f:
+            f.write('Footer\n')
+        self.events = []
+        self.manager = TemplateManager(self.tmpdir)
+        self.manager.stats.hooks.append(
+            lambda event, template, data: self.events.append((event, data)))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testStats(self):
+        for i in range(2):
+            self.assertEqual(''.join(self.manager.render('page', {'a': 1})), 'Footer\nPage 1\n')
+        self.assertEqual(self.manager.render_string('page', {'a': 1}), 'Footer\nPage 1\n')
+        self.assertRaises(TemplateRuntimeError, lambda: ''.join(self.manager.render('page')))
+        stats = self.manager.get_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (4, 2))
+        self.assertGreater(stats['load_time'], 0)
+        page = stats['templates']['page']
+        self.assertEqual(page['compilations'], 2) # stream and string variants
+        self.assertEqual((page['renders'], page['failures']), (4, 1))
+        self.assertEqual(page['output_size'], len('Footer\nPage 1\n') * 3 + len('Footer\n'))
+        self.assertEqual(sum(count for bound, count in page['durations']), 4)
+        self.assertIsNone(page['durations'][-1][0])
+        self.assertEqual(page['pools']['stream']['created'], 1)
+        self.assertEqual(page['pools']['string']['created'], 1)
+        self.assertEqual(
+            [event for event, data in self.events],
+            ['compile', 'load', 'compile', 'load', 'render', 'render', 'compile', 'render', 'render'])
+        self.assertEqual(self.events[1][1]['name'], 'page')
+        self.assertEqual(self.events[-1][1]['failed'], True)
+
+    def testDisabled(self):
+        manager = TemplateManager(self.tmpdir, instrument=False)
+        self.assertEqual(''.join(manager.render('page', {'a': 1})), 'Footer\nPage 1\n')
+        self.assertIsNone(manager.stats)
+        self.assertIsNone(manager.get_template('page').stats)
+        stats = manager.get_stats()
+        self.assertEqual(list(stats), ['templates'])
+        self.assertEqual(stats['templates']['page'], {'pools': {'stream': {
+            'idle': 1, 'hits': 0, 'misses': 1, 'created': 1, 'discarded': 0}}})
+
+    def testStandalone(self):
+        template = Template('A {{ a }}\n')
+        self.assertEqual(''.join(template.render({'a': 1})), 'A 1\n')
+        self.assertEqual(template.get_stats()['renders'], 1)
+        if async_supported:
+            loop = asyncio.new_event_loop()
+            try:
+                self.assertEqual(
+                    consume_async(loop, template.render_async({'a': 2})), ['A 2\n'])
+            finally:
+                loop.close()
+            self.assertEqual(template.get_stats()['renders'], 2)
+
+
+class TestTemplateProfiler(unittest.TestCase):
+    use_monitoring = False
+
+    def setUp(self):
+        self.manager = TemplateManager(flatten=True)
+        self.manager.templates['header'] = Template(
+            '<h1>{{ title }}</h1>\n', manager=self.manager)
+        self.manager.templates['page'] = Template(
+            '% include header\n'
+            '% for i in range(n):\n'
+            '<li>{{ i }}</li>\n'
+            '% end\n'
+            'Total {{ n }}\n', manager=self.manager)
+
+    def profile(self, env):
+        trace = sys.gettrace()
+        with self.manager.profile(use_monitoring=self.use_monitoring) as profiler:
+            output = ''.join(self.manager.render('page', env))
+        self.assertIs(sys.gettrace(), trace)
+        return profiler, output
+
+    def testResults(self):
+        profiler, output = self.profile({'n': 10, 'title': 'Title'})
+        self.assertEqual(output, '<h1>Title</h1>\n%sTotal 10\n' % ''.join(
+            '<li>%d</li>\n' % i for i in range(10)))
+        self.assertIsNot(self.manager.get_flattened_template('page'), self.manager.get_template('page'))
+        results = dict(
+            ((label, lineno), (hits, line))
+            for label, lineno, hits, seconds, line in profiler.get_results())
+        self.assertEqual(results[('page', 3)], (10, '<li>{{ i }}</li>'))
+        self.assertEqual(results[('page', 2)][0], 11)
+        self.assertEqual(results[('page', 5)][0], 1)
+        self.assertEqual(results[('header', 1)], (1, '<h1>{{ title }}</h1>'))
+        self.assertNotIn(('page', 4), results)
+
+    def testReport(self):
+        profiler, output = self.profile({'n': 2, 'title': 'Title'})
+        stream = StringIO()
+        profiler.print_report(stream=stream)
+        lines = stream.getvalue().splitlines()
+        self.assertIn('Location', lines[0])
+        self.assertTrue(any(line.endswith('page:3  <li>{{ i }}</li>') for line in lines))
+        stream = StringIO()
+        profiler.print_report(limit=1, stream=stream)
+        self.assertEqual(len(stream.getvalue().splitlines()), 2)
+        self.assertFalse(profiler.running)
+
+    def testErrorLine(self):
+        self.manager.templates['error'] = Template('A\n{{ undefined }}\n% pass\n')
+        try:
+            ''.join(self.manager.templates['error'].render())
+        except TemplateRuntimeError as e:
+            self.assertEqual(e.lineno, 2)
+        else:
+            self.fail('TemplateRuntimeError not raised')
+
+
+@unittest.skipUnless(hasattr(sys, 'monitoring'), 'sys.monitoring is not available')
+class TestTemplateProfilerMonitoring(TestTemplateProfiler):
+    use_monitoring = True
+
 
 class TestBufferingTemplate(TestTemplateBase):
     template_class = BufferingTemplate
@@ -186,6 +828,128 @@ class TestBufferingTemplate(TestTemplateBase):
         self.assertEqual(len(next(data)), 2) # linesep excess
         self.assertRaises(StopIteration, next, data)
 
+    def testChunkSizes(self):
+        class ChunkTemplate(BufferingTemplate):
+            min_buffersize = 4
+            max_buffersize = 6
+        code = "% for line in lines:\n{{ !line }}\n% end\n"
+        lines = ["a", "bcdef", "", "g" * 20, "hi", "j"]
+        chunks = list(ChunkTemplate(code).render({"lines": lines}))
+        self.assertEqual("".join(chunks), "".join(line + "\n" for line in lines))
+        for chunk in chunks[:-1]:
+            self.assertTrue(4 <= len(chunk) <= 6, chunks)
+        # invalid sizes raise where given, not when iterating
+        self.assertRaises(
+            TemplateValueError,
+            type("InvalidTemplate", (ChunkTemplate,), {"min_buffersize": 7}), code)
+        self.assertRaises(
+            TemplateValueError,
+            type("InvalidTemplate", (BufferingTemplate,), {"buffersize": 0}), code)
+        template = ChunkTemplate(code)
+        template.max_buffersize = 3
+        self.assertRaises(TemplateValueError, template.render, {"lines": lines})
+
+    def testLargeOutput(self):
+        data = "abcdefgh" * 100000
+        chunks = list(BufferingTemplate("{{ !data }}").render({"data": data}))
+        self.assertEqual("".join(chunks), data)
+        self.assertEqual(set(len(chunk) for chunk in chunks[:-1]), set([BufferingTemplate.buffersize]))
+
+
+class TestTemplateContextPool(unittest.TestCase):
+    def setUp(self):
+        self.template = Template("{{ a }}")
+
+    def testPool(self):
+        pool = self.template._pool
+        pool.maxsize = 1
+        self.assertEqual(self.template.prewarm(4), 1)
+        self.assertEqual(len(pool), 1)
+        iterators = [self.template.render({'a': i}) for i in range(3)]
+        self.assertEqual([next(i) for i in iterators], ['0', '1', '2'])
+        for i in iterators:
+            self.assertRaises(StopIteration, next, i)
+        self.assertEqual(self.template.pool_stats(), {
+            'idle': 1, 'hits': 1, 'misses': 2, 'created': 3, 'discarded': 2})
+        pool.clear()
+        self.assertEqual(len(pool), 0)
+
+    def testThreads(self):
+        pool = self.template._pool
+        pool.maxsize = 4
+        active = set()
+        errors = []
+
+        def render():
+            for i in range(300):
+                context = pool.acquire()
+                if id(context) in active:
+                    errors.append(context)
+                active.add(id(context))
+                active.discard(id(context))
+                pool.release(context)
+        threads = [threading.Thread(target=render) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertLessEqual(len(pool), 4 + 8)
+
+    @unittest.skipUnless(bytes_supported, "requires python 3.5")
+    def testOutputVariant(self):
+        class BytesTemplate(Template):
+            output_encoding = 'utf-8'
+        template = BytesTemplate("{{ a }}")
+        self.assertEqual(template.prewarm(3), 3)
+        self.assertEqual(list(template.render({'a': 1})), [b'1'])
+        self.assertEqual(template.pool_stats(), {
+            'idle': 3, 'hits': 1, 'misses': 0, 'created': 3, 'discarded': 0})
+        self.assertEqual(len(template._pool), 0)
+
+    def testDiscard(self):
+        manager = TemplateManager()
+        manager.templates['a'] = Template('% include b\n{{ a }}\n', manager=manager)
+        manager.templates['b'] = Template('{{ b }}\n', manager=manager)
+        template = manager.templates['a']
+        template._pool.maxsize = 1
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            iterators = [template.render({'a': i, 'b': i}) for i in range(2)]
+            for i in iterators:
+                next(i)
+            contexts = list(map(weakref.ref, template._pool._contexts))
+            self.assertTrue(template.in_use)
+            self.assertEqual([''.join(i) for i in iterators], ['0\n', '1\n'])
+            # discarded context is freed at once, included one is pooled again
+            self.assertEqual(len([ref for ref in contexts if ref() is not None]), 1)
+            self.assertFalse(template.in_use)
+            self.assertEqual(len(manager.templates['b']._pool), 1)
+            template._pool.clear()
+            self.assertEqual([ref for ref in contexts if ref() is not None], [])
+        finally:
+            if enabled:
+                gc.enable()
+
+    def testThreadCache(self):
+        pool = self.template._pool
+        pool.thread_cache = 1
+        def render(i):
+            results[i] = ''.join(self.template.render({'a': i}))
+        results = {}
+        threads = [threading.Thread(target=render, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, {0: '0', 1: '1', 2: '2', 3: '3'})
+        self.assertEqual(''.join(self.template.render({'a': 4})), '4')
+        self.assertEqual(''.join(self.template.render({'a': 5})), '5')
+        stats = self.template.pool_stats()
+        self.assertEqual(stats['created'], stats['misses'])
+        self.assertEqual(stats['hits'], 1)
+
 
 class TestTemplateManager(unittest.TestCase):
     def setUp(self):
@@ -342,6 +1106,27 @@ class TestTemplateManager(unittest.TestCase):
         self.assertEqual(self.lines('template', {'a':1, 'b':2}),
             ['', '', '1', '2', ''])
 
+    def testGlobals(self):
+        self.manager.globals['title'] = lambda v: v.title()
+        self.manager.templates['a'] = Template("{{ title(a) }}", manager=self.manager)
+        self.assertEqual(self.execute('a', {'a': 'hello'}), 'Hello')
+        self.assertEqual(self.execute('a', {'a': 'hello', 'title': len}), '5')
+
+    def testGlobalsChanged(self):
+        self.manager.globals['title'] = lambda v: v.title()
+        self.manager.templates['b'] = Template("{{ title(a) }}-{{ str(a) }}", manager=self.manager)
+        self.manager.templates['a'] = Template("% include b\n{{ title(a) }}", manager=self.manager)
+        self.assertEqual(self.execute('a', {'a': 'hello'}), 'Hello-helloHello')
+        self.manager.globals['title'] = lambda v: v.upper()
+        self.manager.globals['str'] = lambda v: v[::-1]
+        self.assertEqual(self.execute('a', {'a': 'hello'}), 'HELLO-ollehHELLO')
+        self.manager.templates['c'] = Template("% extends a\n", manager=self.manager)
+        self.assertEqual(self.execute('c', {'a': 'hello'}), 'HELLO-ollehHELLO')
+        del self.manager.globals['str']
+        self.manager.globals = {'title': len}
+        self.assertEqual(self.execute('a', {'a': 'hello'}), '5-hello5')
+        self.assertEqual(self.execute('c', {'a': 'hello'}), '5-hello5')
+
     def testLookup(self):
         with open(os.path.join(self.tmpdir, "testmplate.stpl"), "w") as f:
             f.write('''
@@ -369,6 +1154,715 @@ class TestTemplateManager(unittest.TestCase):
         self.assertRaises(TemplateRuntimeError, self.execute, 'f')
         self.manager.templates['g'] = Template('% a<b\n% include c', manager=self.manager)
         self.assertRaises(TemplateRuntimeError, self.execute, 'g')
+        try:
+            self.execute('d')
+        except TemplateRuntimeError as e:
+            self.assertIs(e.template, self.manager.templates['b'])
+            self.assertEqual((e.lineno, e.code), (1, ['% a = b']))
+            self.assertIn('a = b', e.pycode[e.pylineno])
+
+    def testWarmup(self):
+        sources = {
+            'base.tpl': '% block a\nBase\n% end\n',
+            'page.tpl': '% extends base\n% block a\n% include footer\n% end\n',
+            'footer.tpl': 'Footer\n',
+            'broken.tpl': '% if True\n',
+            }
+        for filename, code in sources.items():
+            with open(os.path.join(self.tmpdir, filename), 'w') as f:
+                f.write(code)
+        self.manager.templates['loaded'] = Template('Loaded', manager=self.manager)
+        for processes in (1, 2):
+            self.manager.reset()
+            report = self.manager.warmup(processes)
+            names = list(report)
+            self.assertEqual(set(names), set(
+                name for filename in sources
+                for name in (filename, filename[:-4])))
+            self.assertLess(names.index('base'), names.index('page'))
+            self.assertLess(names.index('footer'), names.index('page'))
+            self.assertEqual(names[-2:], ['broken', 'broken.tpl'])
+            self.assertIsInstance(report['broken']['error'], SyntaxError)
+            self.assertIsNone(report['page']['error'])
+            self.assertGreaterEqual(report['page']['time'], 0)
+            self.assertNotIn('broken', self.manager.templates)
+            self.assertIn('page.tpl', self.manager.templates)
+            self.assertEqual(self.execute('page'), 'Footer\n')
+
+    def testWarmupClock(self):
+        with open(os.path.join(self.tmpdir, 'page.tpl'), 'w') as f:
+            f.write('Page\n')
+        # compilation times do not follow wall clock changes
+        clock = iter(range(10 ** 6, 0, -1000))
+        wall_time = time.time
+        time.time = lambda: float(next(clock))
+        try:
+            report = self.manager.warmup(1)
+        finally:
+            time.time = wall_time
+        self.assertGreaterEqual(report['page']['time'], 0)
+
+    def testFreeze(self):
+        sources = {
+            'base.tpl': '% block a\nBase\n% end\n',
+            'page.tpl': '% extends base\n% block a\n{{ a }}\n% end\n',
+            'static.tpl': 'Static\n',
+            }
+        for filename, code in sources.items():
+            with open(os.path.join(self.tmpdir, filename), 'w') as f:
+                f.write(code)
+        self.manager = TemplateManager(
+            self.tmpdir, auto_reload=True, max_templates=1, flatten=True)
+        try:
+            report = self.manager.freeze(contexts=2, variants=('stream', 'string'))
+        finally:
+            if hasattr(gc, 'unfreeze'):
+                gc.unfreeze()
+        self.assertEqual(len(report), 6)
+        self.assertFalse([name for name, result in report.items() if result['error']])
+        self.assertEqual(len(self.manager.templates), 6)
+        self.assertFalse(self.manager.auto_reload)
+        page = self.manager.get_flattened_template('page')
+        self.assertIsNot(page, self.manager.get_template('page'))
+        for variant in ('stream', 'string'):
+            self.assertEqual(page.get_pool(variant).stats()['idle'], 2)
+        self.assertEqual(self.execute('page', {'a': 1}), '1\n')
+        self.assertEqual(self.manager.render_string('page', {'a': 2}), '2\n')
+        with open(os.path.join(self.tmpdir, 'late.tpl'), 'w') as f:
+            f.write('Late\n')
+        self.assertRaises(TemplateFrozenError, self.manager.get_template, 'late')
+        self.assertRaises(TemplateNotFoundError, self.manager.get_template, 'late')
+        self.manager.frozen_strict = False
+        if hasattr(self, 'assertLogs'):
+            with self.assertLogs('stpl2', 'WARNING'):
+                self.assertEqual(self.execute('late'), 'Late\n')
+
+
+class TestAutoReload(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.manager = TemplateManager(self.tmpdir, auto_reload=True)
+        self.manager.reload_interval = 0
+        self.write("base", "% block a\nBase\n% end\n")
+        self.write("page", "% extends base\n% block a\n% include footer\n% end\n")
+        self.write("footer", "Footer\n")
+        self.write("other", "Other\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, code):
+        with open(os.path.join(self.tmpdir, name + ".tpl"), "w") as f:
+            f.write(code)
+
+    def execute(self, name):
+        return ''.join(self.manager.render(name))
+
+    def testReload(self):
+        self.assertEqual(self.execute("page"), "Footer\n")
+        self.assertEqual(self.execute("other"), "Other\n")
+        base = self.manager.get_template("base")
+        other = self.manager.get_template("other")
+        self.write("footer", "Changed footer\n")
+        self.assertEqual(self.execute("page"), "Changed footer\n")
+        self.assertIs(self.manager.get_template("base"), base)
+        self.assertIs(self.manager.get_template("other"), other)
+
+    def testInvalidate(self):
+        self.execute("page")
+        self.execute("other")
+        self.assertEqual(self.manager.invalidate("base"), set(("base", "page")))
+        self.assertEqual(sorted(self.manager.templates), ["footer", "other"])
+
+    def testInterval(self):
+        self.manager.reload_interval = 3600
+        self.execute("page")
+        self.write("footer", "Changed footer\n")
+        self.assertEqual(self.execute("page"), "Footer\n")
+        self.manager.reload_interval = 0
+        self.manager._reload_state["footer"][2] = 0
+        self.assertEqual(self.manager.check_template("footer"), set(("footer", "page")))
+        self.assertEqual(self.execute("page"), "Changed footer\n")
+
+
+class TestTemplateLoaders(unittest.TestCase):
+    sources = {
+        'page.tpl': '% include footer\n',
+        'footer.tpl': 'Footer\n',
+        'sub/other.stpl': 'Other\n',
+        }
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.modules = set(sys.modules)
+        self.path = list(sys.path)
+
+    def tearDown(self):
+        for name in set(sys.modules) - self.modules:
+            del sys.modules[name]
+        sys.path[:] = self.path
+        shutil.rmtree(self.tmpdir)
+
+    def write_zip(self, path, sources, prefix=''):
+        archive = zipfile.ZipFile(path, 'w')
+        try:
+            for name, code in sources.items():
+                archive.writestr(prefix + name, code.encode('utf-8'))
+        finally:
+            archive.close()
+
+    def check(self, manager):
+        self.assertEqual(manager.render_string('page'), 'Footer\n')
+        self.assertEqual(manager.render_string('sub/other'), 'Other\n')
+        self.assertRaises(TemplateNotFoundError, manager.get_template, 'missing')
+        self.assertEqual(sorted(manager.iter_template_names()), [
+            'footer', 'footer.tpl', 'page', 'page.tpl', 'sub/other', 'sub/other.stpl'])
+
+    def testDictLoader(self):
+        sources = dict(self.sources)
+        manager = TemplateManager(loaders=[DictLoader(sources)], auto_reload=True)
+        manager.reload_interval = 0
+        self.check(manager)
+        self.assertEqual(manager.get_template('footer').filename, '<footer.tpl>')
+        sources['footer.tpl'] = 'Changed footer\n'
+        self.assertEqual(manager.render_string('page'), 'Changed footer\n')
+
+    def write_files(self, directory, sources):
+        for name, code in sources.items():
+            path = os.path.join(directory, *name.split('/'))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(code)
+
+    def testFileSystemIndex(self):
+        first = os.path.join(self.tmpdir, 'first')
+        second = os.path.join(self.tmpdir, 'second')
+        self.write_files(first, self.sources)
+        self.write_files(second, {'footer': 'Bare\n', 'extra.stpl': 'Extra\n'})
+        if hasattr(os, 'symlink'):
+            os.symlink(first, os.path.join(first, 'loop'))
+        self.check(TemplateManager([first], index_interval=60))
+        loaders = [DictLoader({}), FileSystemLoader([first]), FileSystemLoader([first], index_interval=5)]
+        TemplateManager(loaders=loaders, index_interval=60)
+        self.assertEqual([loader.index_interval for loader in loaders[1:]], [60, 5])
+        plain = FileSystemLoader([first, second])
+        indexed = FileSystemLoader([first, second], index_interval=60)
+        names = [
+            'page', 'page.tpl', 'footer', 'footer.tpl', 'extra', 'extra.stpl',
+            'sub/other', 'sub/other.stpl', 'sub', 'missing', 'sub/../page',
+            './page', '../first/page', os.path.join(first, 'page.tpl'),
+            os.path.join(first, 'missing')]
+        for name in names:
+            self.assertEqual(indexed.find(name), plain.find(name), name)
+        self.assertTrue(indexed.misses.get('missing'))
+        self.assertEqual(indexed.misses.maxsize, FileSystemLoader.max_misses)
+        # changes are noticed on next rebuild only
+        self.write_files(first, {'missing.tpl': 'Found\n'})
+        os.remove(os.path.join(second, 'extra.stpl'))
+        self.assertIsNone(indexed.find('missing'))
+        self.assertIsNone(indexed.load('extra'))
+        indexed.refresh_index()
+        for name in names:
+            self.assertEqual(indexed.find(name), plain.find(name), name)
+        self.assertIsNone(indexed.misses.get('missing'))
+
+    def testZipLoader(self):
+        path = os.path.join(self.tmpdir, 'app.pyz')
+        self.write_zip(path, self.sources, 'pkg/templates/')
+        loader = ZipLoader(os.path.join(path, 'pkg', 'templates'))
+        self.assertEqual(loader.archive, path)
+        self.assertEqual(loader.prefix, 'pkg/templates/')
+        manager = TemplateManager(loaders=[loader], auto_reload=True)
+        manager.reload_interval = 0
+        self.check(manager)
+        self.assertEqual(
+            manager.get_template('footer').filename,
+            os.path.join(path, 'pkg/templates/footer.tpl'))
+        self.write_zip(path, dict(self.sources, **{'footer.tpl': 'Changed\n'}), 'pkg/templates/')
+        os.utime(path, (0, 0)) # same size, ensure modification time changes
+        self.assertEqual(manager.render_string('page'), 'Changed\n')
+        # Unchanged members are not reloaded when archive changes
+        page = manager.get_template('page')
+        self.write_zip(path, dict(self.sources, **{'footer.tpl': 'Changed again\n'}), 'pkg/templates/')
+        self.assertEqual(manager.render_string('footer'), 'Changed again\n')
+        self.assertIsNot(manager.get_template('page'), page)
+        self.assertIs(manager.get_template('sub/other'), manager.get_template('sub/other'))
+
+    def testResourceLoader(self):
+        directory = os.path.join(self.tmpdir, 'stpl2_test_resources')
+        for name, code in dict(self.sources, **{'__init__.py': ''}).items():
+            path = os.path.join(directory, 'templates' if name != '__init__.py' else '', name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(code)
+        sys.path.insert(0, self.tmpdir)
+        manager = TemplateManager(loaders=[ResourceLoader('stpl2_test_resources', 'templates')])
+        self.assertEqual(manager.render_string('page'), 'Footer\n')
+        self.assertTrue(os.path.isfile(manager.get_template('page').filename))
+        if resource_files is not None: # names are not listed by pkgutil
+            self.check(manager)
+
+    def testResourceLoaderZip(self):
+        path = os.path.join(self.tmpdir, 'app.pyz')
+        self.write_zip(path, self.sources, 'stpl2_test_zipped/templates/')
+        archive = zipfile.ZipFile(path, 'a')
+        archive.writestr('stpl2_test_zipped/__init__.py', b'')
+        archive.close()
+        sys.path.insert(0, path)
+        manager = TemplateManager(loaders=[ResourceLoader('stpl2_test_zipped', 'templates')])
+        self.assertEqual(manager.render_string('page'), 'Footer\n')
+
+    def testChain(self):
+        with open(os.path.join(self.tmpdir, 'footer.tpl'), 'w') as f:
+            f.write('File footer\n')
+        manager = TemplateManager(loaders=[
+            DictLoader({'page': '% include footer\n'}),
+            FileSystemLoader(self.tmpdir),
+            DictLoader(self.sources),
+            ])
+        self.assertEqual(manager.render_string('page'), 'File footer\n')
+        self.assertEqual(manager.find_template_path('sub/other'), '<sub/other.stpl>')
+        report = manager.warmup(1) # page and footer already loaded
+        self.assertEqual(sorted(report), [
+            'footer.tpl', 'page.tpl', 'sub/other', 'sub/other.stpl'])
+        self.assertEqual(manager.get_template('footer.tpl').code, 'File footer\n')
+
+
+class TestTemplateLinker(unittest.TestCase):
+    sources = {
+        'base1': '''
+            This is base1
+            % block block1
+            This is base1 block1
+            % end
+            % for i in range(2):
+            % block block2
+            This is base1 block2 {{ a }}
+            % end
+            % end
+            % include footer
+            ''',
+        'base2': '''
+            % extends base1
+            This is base2
+            % block block1
+            This is base2 block1
+            % end
+            ''',
+        'template': '''
+            % extends(name=base2)
+            % block block1
+            This is template block {{ a }}
+            % include header
+            % end
+            % block "block2"
+            % block.super
+            but I am inheriting
+            % end
+            ''',
+        'header': '{{ a }}\n',
+        'footer': 'Footer\n% include header\n',
+        'page': '% rebase layout\nPage {{ a }}\n',
+        'layout': 'Layout\n% base\n% include footer\n',
+        'conflict': '% for a in range(2):\n% include header\n% end\n',
+        'expression': '{{ include("header") }}\n% include header\n% x = block\n',
+        }
+
+    def setUp(self):
+        self.manager = TemplateManager(flatten=True)
+        self.reference = TemplateManager()
+        for manager in (self.manager, self.reference):
+            for name, code in self.sources.items():
+                manager.templates[name] = Template(code, manager=manager)
+
+    def assertFlattened(self, name, env=None, flattened=True):
+        template = self.manager.get_flattened_template(name)
+        self.assertEqual(template is not self.manager.get_template(name), flattened)
+        if flattened:
+            self.assertEqual(template.includes, ())
+            self.assertEqual(template.extends, None)
+            self.assertEqual(template.rebase, None)
+        self.assertEqual(''.join(self.manager.render(name, env)),
+                         ''.join(self.reference.render(name, env)))
+
+    def testExtends(self):
+        self.assertFlattened('template', {'a': 1})
+
+    def testRebase(self):
+        self.assertFlattened('page', {'a': 1})
+
+    def testInclude(self):
+        self.assertFlattened('footer', {'a': 1})
+
+    def testFallback(self):
+        # Conflicting variable names: include kept
+        self.assertFlattened('conflict', {'a': 1}, False)
+        self.assertFlattened('expression', {'a': 1}, False)
+
+    def testInvalidation(self):
+        template = self.manager.get_flattened_template('template')
+        self.assertIs(self.manager.get_flattened_template('template'), template)
+        self.manager.templates['header'] = Template('Changed {{ a }}\n', manager=self.manager)
+        self.reference.templates['header'] = Template('Changed {{ a }}\n', manager=self.reference)
+        self.assertIsNot(self.manager.get_flattened_template('template'), template)
+        self.assertFlattened('template', {'a': 1})
+
+    def testErrorMapping(self):
+        self.manager.templates['header'] = Template('\n{{ b }}\n', manager=self.manager)
+        try:
+            ''.join(self.manager.render('page', {'a': 1}))
+        except TemplateRuntimeError as e:
+            self.assertEqual(e.lineno, 2)
+            self.assertEqual(e.code, ['', '{{ b }}'])
+        else:
+            self.fail("TemplateRuntimeError not raised")
+
+    def testErrorOrigin(self):
+        # include text is not spliced into parent string chunks
+        for manager in (self.manager, self.reference):
+            manager.templates['included'] = Template('i1\ni2 {{ missing }}\n', manager=manager)
+            manager.templates['parent'] = Template('p1\n% include included\np3\n', manager=manager)
+        self.assertIsNot(self.manager.get_flattened_template('parent'),
+                         self.manager.get_template('parent'))
+        for manager in (self.manager, self.reference):
+            try:
+                ''.join(manager.render('parent'))
+            except TemplateRuntimeError as e:
+                self.assertIsInstance(e.error, NameError)
+                self.assertEqual(e.lineno, 2)
+                self.assertEqual(e.code, ['i1', 'i2 {{ missing }}'])
+            else:
+                self.fail("TemplateRuntimeError not raised")
+
+    def testNamespaceAccess(self):
+        # templates using namespace functions are kept as includes
+        for manager in (self.manager, self.reference):
+            manager.templates['setter'] = Template('% setdefault("y", 1)\nSetter\n', manager=manager)
+            manager.templates['getter'] = Template('% include setter\n{{ get("y", "unset") }}\n', manager=manager)
+        self.assertFlattened('getter', flattened=False)
+        self.assertEqual(''.join(self.manager.render('getter')), 'Setter\nunset\n')
+
+
+class TestTemplateCache(unittest.TestCase):
+    def setUp(self):
+        self.manager = TemplateManager(max_templates=2)
+        self.templates = self.manager.templates
+        self.sources = {
+            'page': '% include footer\nPage\n',
+            'footer': '{{ "Footer" }}\n',
+            'other': '{{ "Other" }}\n',
+            'another': '{{ "Another" }}\n',
+            }
+
+    def add(self, name):
+        self.templates[name] = Template(self.sources[name], manager=self.manager)
+
+    def testLRU(self):
+        self.add('footer')
+        self.add('other')
+        self.templates['footer'] # touch
+        self.add('another')
+        self.assertEqual(sorted(self.templates), ['another', 'footer'])
+
+    def testInUse(self):
+        self.add('page')
+        self.add('footer')
+        self.assertEqual(''.join(self.manager.render('page')), 'Footer\nPage\n')
+        self.assertTrue(self.templates['footer'].in_use)
+        self.assertFalse(self.templates['page'].in_use)
+        self.add('other')
+        self.assertEqual(sorted(self.templates), ['footer', 'other'])
+        gc.collect() # page contexts are reference cycles
+        self.assertFalse(self.templates['footer'].in_use)
+        # rendering templates are in use
+        generator = self.templates['other'].render()
+        next(generator)
+        self.add('another')
+        self.assertEqual(sorted(self.templates), ['another', 'other'])
+        generator.close()
+
+    def testInUseDiscarded(self):
+        self.templates.maxsize = 3
+        self.manager.templates['page'] = Template('{{ a }}\n', manager=self.manager)
+        self.manager.templates['page']._pool.maxsize = 1
+        self.add('footer')
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            iterators = [self.manager.render('page', {'a': i}) for i in range(2)]
+            for i in iterators:
+                next(i)
+            for i in iterators:
+                list(i)
+            self.assertFalse(self.templates['page'].in_use)
+            self.templates['footer'] # touch
+            self.add('other')
+            self.add('another')
+            self.assertEqual(sorted(self.templates), ['another', 'footer', 'other'])
+        finally:
+            if enabled:
+                gc.enable()
+
+    def testThreads(self):
+        names = ['t%d' % i for i in range(40)]
+        manager = TemplateManager(
+            loaders=[DictLoader(dict((name, '{{ a }}\n') for name in names))],
+            max_templates=5)
+        errors = []
+        def render(offset):
+            try:
+                for i in range(200):
+                    name = names[(offset + i * 7) % len(names)]
+                    self.assertEqual(manager.render_string(name, {'a': i}), '%d\n' % i)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=render, args=(i,)) for i in range(8)]
+        interval = sys.getswitchinterval() if py3k else None
+        if py3k:
+            sys.setswitchinterval(1e-6)
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            if py3k:
+                sys.setswitchinterval(interval)
+        self.assertEqual(errors, [])
+        self.assertLessEqual(len(manager.templates), 5 + 8)
+
+    def testMemory(self):
+        self.templates.maxsize = None
+        for name in ('page', 'footer', 'other'):
+            self.add(name)
+        usage = self.manager.memory_usage()
+        self.assertEqual(sorted(usage), ['footer', 'other', 'page'])
+        self.assertTrue(all(size > 0 for size in usage.values()))
+        ''.join(self.manager.render('other'))
+        self.assertTrue(self.manager.memory_usage()['other'] > usage['other'])
+        self.templates.maxmemory = sum(self.manager.memory_usage().values()) - 1
+        self.assertEqual(self.templates.shrink(), ['page'])
+
+    def testUnboundedLookup(self):
+        self.templates.maxsize = None
+        self.add('footer')
+        self.add('other')
+        lock, self.templates._lock = self.templates._lock, None # not used
+        try:
+            self.assertIs(self.templates['footer'], self.templates.get('footer'))
+            self.assertIsNone(self.templates.get('missing'))
+            self.assertEqual(''.join(self.manager.render('footer')), 'Footer\n')
+        finally:
+            self.templates._lock = lock
+        self.assertEqual(list(self.templates), ['footer', 'other'])
+
+    def testMemoryTotal(self):
+        calls = []
+
+        class CountingTemplate(Template):
+            def memory_usage(self):
+                calls.append(self)
+                return 10
+
+        self.templates.maxsize = None
+        self.templates.maxmemory = 35
+        for i in range(20):
+            self.templates['t%d' % i] = CountingTemplate('%d\n' % i)
+        # sizes are estimated once, when added
+        self.assertEqual(len(calls), 20)
+        self.assertEqual(sorted(self.templates), ['t17', 't18', 't19'])
+        del self.templates['t18']
+        self.templates.pop('t17')
+        self.templates['t19'] = CountingTemplate('19\n')
+        self.templates['a'] = CountingTemplate('a\n')
+        self.templates['b'] = CountingTemplate('b\n')
+        self.assertEqual(sorted(self.templates), ['a', 'b', 't19'])
+        self.assertEqual(self.templates.shrink(), [])
+        self.templates['c'] = CountingTemplate('c\n')
+        self.assertEqual(sorted(self.templates), ['a', 'b', 'c'])
+        self.assertEqual(len(calls), 24)
+
+
+class TestBytecodeCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.tmpdir, "cache")
+        with open(os.path.join(self.tmpdir, "template.tpl"), "w") as f:
+            f.write("% include other\n{{ a }}\n")
+        with open(os.path.join(self.tmpdir, "other.tpl"), "w") as f:
+            f.write("Other\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def manager(self, template_class=Template):
+        class Manager(TemplateManager):
+            pass
+        Manager.template_class = template_class
+        return Manager(self.tmpdir, cache_directory=self.cachedir)
+
+    def testCache(self):
+        manager = self.manager()
+        self.assertEqual(''.join(manager.render('template', {'a': 1})), 'Other\n1\n')
+        self.assertEqual(len(os.listdir(self.cachedir)), 2)
+
+        class NoTranslateTemplate(Template):
+            def compile(self):
+                raise AssertionError("Template should be loaded from cache")
+
+        manager = self.manager(NoTranslateTemplate)
+        template = manager.get_template('template')
+        self.assertEqual(template.includes, ('other',))
+        self.assertEqual(template.extends, None)
+        self.assertEqual(''.join(manager.render('template', {'a': 1})), 'Other\n1\n')
+        self.assertEqual(template.pycode, manager.templates['template'].pycode)
+
+    def testUnwritable(self):
+        os.mkdir(self.cachedir)
+        os.chmod(self.cachedir, 0o500)
+        try:
+            if not os.access(self.cachedir, os.W_OK): # not running as root
+                manager = self.manager()
+                self.assertEqual(
+                    ''.join(manager.render('template', {'a': 1})), 'Other\n1\n')
+                self.assertEqual(os.listdir(self.cachedir), [])
+        finally:
+            os.chmod(self.cachedir, 0o700)
+        # Cache directory path being a file
+        os.rmdir(self.cachedir)
+        with open(self.cachedir, 'w') as f:
+            f.write('file')
+        manager = self.manager()
+        self.assertFalse(manager.bytecode_cache.dump(Template('a\n')))
+        self.assertEqual(''.join(manager.render('template', {'a': 1})), 'Other\n1\n')
+
+    def testInvalidation(self):
+        manager = self.manager()
+        manager.get_template('template')
+        # Corrupt entries are rebuilt
+        for name in os.listdir(self.cachedir):
+            with open(os.path.join(self.cachedir, name), "wb") as f:
+                f.write(BytecodeCache.header + b"garbage")
+        manager = self.manager()
+        self.assertEqual(''.join(manager.render('template', {'a': 1})), 'Other\n1\n')
+        # Entries with corrupt payload are recompiled and rewritten
+        path = os.path.join(self.cachedir, manager.bytecode_cache.get_key(
+            manager.get_template('other')) + BytecodeCache.extension)
+        with open(path, "rb") as f:
+            data = bytearray(f.read())
+        data[-10] ^= 0xff
+        with open(path, "wb") as f:
+            f.write(bytes(data))
+        compiled = []
+
+        class RecordTemplate(Template):
+            def compile(self):
+                compiled.append(self.filename)
+                Template.compile(self)
+
+        manager = self.manager(RecordTemplate)
+        self.assertEqual(''.join(manager.render('template', {'a': 1})), 'Other\n1\n')
+        self.assertEqual(compiled, [manager.get_template('other').filename])
+        del compiled[:]
+        self.manager(RecordTemplate).get_template('other')
+        self.assertEqual(compiled, [])
+        # Changed sources get new entries
+        with open(os.path.join(self.tmpdir, "other.tpl"), "w") as f:
+            f.write("Changed\n")
+        manager = self.manager()
+        self.assertEqual(''.join(manager.render('template', {'a': 1})), 'Changed\n1\n')
+        self.assertEqual(len(os.listdir(self.cachedir)), 3)
+        manager.bytecode_cache.clear()
+        self.assertEqual(os.listdir(self.cachedir), [])
+
+
+class TestCompilePackage(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.srcdir = os.path.join(self.tmpdir, "templates")
+        os.makedirs(os.path.join(self.srcdir, "sub"))
+        self.files = {
+            "base.tpl": "% block body\nBase\n% end\n",
+            "sub/page.stpl": "% extends base\n% block body\n{{ a }}\n% end\n",
+            "error.tpl": "Line\n{{ a }}\n{{ b }}\n",
+            }
+        for name, code in self.files.items():
+            with open(os.path.join(self.srcdir, name), "w") as f:
+                f.write(code)
+        self.package = "stpl2_compiled_%d" % id(self)
+        self.manager = TemplateManager(self.srcdir)
+        self.index = self.manager.compile_package(
+            os.path.join(self.tmpdir, self.package))
+        sys.path.insert(0, self.tmpdir)
+
+    def tearDown(self):
+        sys.path.remove(self.tmpdir)
+        for name in list(sys.modules):
+            if name.startswith(self.package):
+                del sys.modules[name]
+        shutil.rmtree(self.tmpdir)
+
+    def testIndex(self):
+        self.assertEqual(
+            sorted(self.index),
+            ["base", "base.tpl", "error", "error.tpl",
+             "sub/page", "sub/page.stpl"])
+        self.assertEqual(self.index["base"], self.index["base.tpl"])
+
+    def testRender(self):
+        class NoTranslateTemplate(Template):
+            def compile(self):
+                raise AssertionError("Template should be loaded from package")
+
+        class Manager(TemplateManager):
+            template_class = NoTranslateTemplate
+
+        manager = Manager(packages=self.package)
+        for name in self.index:
+            template = manager.get_template(name)
+            source = self.manager.get_template(name)
+            self.assertEqual(template.code, source.code)
+            self.assertEqual(template.pycode, source.pycode)
+            self.assertEqual(template.filename, source.filename)
+            self.assertEqual(template.includes, source.includes)
+            self.assertEqual(template.extends, source.extends)
+        self.assertEqual(''.join(manager.render("sub/page", {"a": 1})), "1\n")
+        self.assertRaises(TemplateNotFoundError, manager.get_template, "missing")
+
+    def testBuildMismatch(self):
+        path = os.path.join(self.tmpdir, self.package, self.index["base"] + ".py")
+        with open(path) as f:
+            source = f.read()
+        with open(path, "w") as f:
+            f.write(source.replace(Template.get_build_signature(), "stpl2 0.0"))
+        compiled = []
+
+        class RecordTemplate(Template):
+            def compile(self):
+                compiled.append(self.filename)
+                Template.compile(self)
+
+        class Manager(TemplateManager):
+            template_class = RecordTemplate
+
+        manager = Manager(packages=self.package)
+        self.assertEqual(''.join(manager.render("sub/page", {"a": 1})), "1\n")
+        self.assertEqual(''.join(manager.render("base")), "Base\n")
+        self.assertEqual(compiled, [self.manager.get_template("base").filename])
+
+    def testErrorMapping(self):
+        manager = TemplateManager(packages=[self.package])
+        errors = []
+        for m in (self.manager, manager):
+            try:
+                ''.join(m.render("error", {"a": 1}))
+            except TemplateRuntimeError as e:
+                errors.append((str(e), e.lineno))
+        self.assertEqual(len(errors), 2)
+        self.assertEqual(errors[0], errors[1])
+        self.assertEqual(errors[1][1], 3)
 
 
 if __name__ == '__main__':